@@ -28,6 +28,7 @@ import argparse
 from impacket.examples import logger
 from impacket import version
 from impacket.ese import ESENT_DB
+from impacket.examples.eseexport import ESETableExporter, FORMATS
 
 
 def dumpPage(ese, pageNum):
@@ -58,6 +59,20 @@ def exportTable(ese, tableName):
                print("%-30s: %r" % (j, record[j]))
         i += 1
 
+def streamTable(ese, options):
+    columns = options.columns.split(',') if options.columns is not None else None
+    exporter = ESETableExporter(ese, options.table, columns, options.format, options.checkpoint,
+                                options.checkpoint_interval)
+    if options.output is not None:
+        stats = exporter.export(options.output, options.progress)
+    elif options.checkpoint is not None:
+        raise Exception('-checkpoint needs -output')
+    else:
+        exporter.exportRows(sys.stdout, progressInterval=options.progress)
+        stats = exporter.getStats()
+    logging.info('%d rows exported in %.2f seconds (%.2f rows/s)' % (stats['rows'], stats['elapsed'],
+                                                                     stats['rows_per_second']))
+
 def main():
     print(version.BANNER)
 
@@ -80,6 +95,17 @@ def main():
     # export page
     export_parser = subparsers.add_parser('export', help='dumps the catalog info for the DB')
     export_parser.add_argument('-table', action='store', required=True, help='table to dump')
+    export_parser.add_argument('-columns', action='store', help='comma separated list of columns to export '
+                               '(default all)')
+    export_parser.add_argument('-format', choices=('text',) + FORMATS, default='text',
+                               help='output format (default text)')
+    export_parser.add_argument('-output', action='store', help='output file for json/csv (default stdout)')
+    export_parser.add_argument('-checkpoint', action='store', help='checkpoint file for json/csv. It keeps the '
+                               'export state, so an interrupted export is resumed when run again')
+    export_parser.add_argument('-checkpoint-interval', action='store', type=int, default=1000,
+                               help='rows between checkpoints (default 1000)')
+    export_parser.add_argument('-progress', action='store', type=int, help='log progress and rows/s every '
+                               'PROGRESS seconds')
 
     if len(sys.argv)==1:
         parser.print_help()
@@ -97,7 +123,10 @@ def main():
         elif options.action.upper() == 'DUMP':
             dumpPage(ese, int(options.page))
         elif options.action.upper() == 'EXPORT':
-            exportTable(ese, options.table)
+            if options.format == 'text':
+                exportTable(ese, options.table)
+            else:
+                streamTable(ese, options)
         else:
             raise Exception('Unknown action %s ' % options.action)
     except Exception as e:
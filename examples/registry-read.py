@@ -22,6 +22,7 @@
 from __future__ import division
 from __future__ import print_function
 import sys
+import logging
 import argparse
 import ntpath
 from binascii import unhexlify, hexlify
@@ -117,6 +118,26 @@ def enumKey(reg, searchKey, isRecursive, indent='  '):
 def walk(reg, keyName):
     return reg.walk(keyName)
 
+def export(reg, keyName, outputFormat, outputFile, rootName):
+    if not isinstance(reg, winregistry.saveRegistryParser):
+        logging.error('Only binary hives can be exported')
+        return
+
+    if outputFormat == 'reg':
+        if outputFile is not None:
+            # regedit wants UTF-16LE with a BOM and CRLF line endings
+            fd = open(outputFile, 'w', encoding='utf-16le', newline='\r\n')
+            fd.write('\ufeff')
+        else:
+            fd = sys.stdout
+        keys = winregistry.exportRegFile(reg, fd, keyName, rootName)
+    else:
+        fd = open(outputFile, 'w') if outputFile is not None else sys.stdout
+        keys = winregistry.exportJsonLines(reg, fd, keyName)
+    if fd is not sys.stdout:
+        fd.close()
+    logging.info('%d keys exported' % keys)
+
 
 def main():
     print(version.BANNER)
@@ -148,6 +169,14 @@ def main():
     walk_parser = subparsers.add_parser('walk', help='walks the registry from the name node down')
     walk_parser.add_argument('-name', action='store', required=True, help='registry class name to start walking down from')
 
+    # An export command
+    export_parser = subparsers.add_parser('export', help='exports a key and everything below it as a .reg file or JSON lines')
+    export_parser.add_argument('-name', action='store', default='\\', help='registry key to export (default the root key)')
+    export_parser.add_argument('-format', choices=['reg', 'json'], default='reg', help='output format (default reg)')
+    export_parser.add_argument('-output', action='store', help='output file (default stdout)')
+    export_parser.add_argument('-root', action='store', help='path the keys are written under in .reg files, '
+                               'e.g. HKEY_LOCAL_MACHINE\\SYSTEM (default the hive root key name)')
+
     if len(sys.argv)==1:
         parser.print_help()
         sys.exit(1)
@@ -169,6 +198,8 @@ def main():
         getClass(reg, options.name)
     elif options.action.upper() == 'WALK':
         walk(reg, options.name)
+    elif options.action.upper() == 'EXPORT':
+        export(reg, options.name, options.format, options.output, options.root)
 
     reg.close()
 
@@ -114,6 +114,7 @@ class DumpSecrets:
         self.__pwdLastSet = options.pwd_last_set
         self.__printUserStatus = options.user_status
         self.__resumeFileName = options.resumefile
+        self.__workers = options.workers
         self.__canProcessSAMLSA = True
         self.__kdcHost = options.dc_ip
         self.__remoteSSWMI = options.use_remoteSSWMI
@@ -321,7 +322,7 @@ class DumpSecrets:
                                                pwdLastSet=self.__pwdLastSet, resumeSession=self.__resumeFileName,
                                                outputFileName=self.__outputFileName, justUser=self.__justUser,
                                                skipUser=self.__skipUser, ldapFilter=self.__ldapFilter,
-                                               printUserStatus=self.__printUserStatus)
+                                               printUserStatus=self.__printUserStatus, workers=self.__workers)
                 try:
                     self.__NTDSHashes.dump()
                 except Exception as e:
@@ -405,6 +406,8 @@ if __name__ == '__main__':
     parser.add_argument('-security', action='store', help='SECURITY hive to parse')
     parser.add_argument('-sam', action='store', help='SAM hive to parse')
     parser.add_argument('-ntds', action='store', help='NTDS.DIT file to parse')
+    parser.add_argument('-workers', action='store', type=int, default=1, help='Number of processes parsing and '
+                        'decrypting the NTDS.DIT file in parallel (only available when parsing local files). Default: 1')
     parser.add_argument('-resumefile', action='store', help='resume file name to resume NTDS.DIT session dump (only '
                         'available to DRSUAPI approach). This file will also be used to keep updating the session\'s '
                         'state')
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Crawls the shares of one or more SMB servers concurrently and writes
+#   every file/directory found as a JSON line.
+#
+#   Example:
+#   smbcrawler.py -targets-file hosts.txt -workers 50 -exclude '*\windows\*' domain/user:pass
+#
+# Reference for:
+#   SMB SMB2_QUERY_DIRECTORY
+#
+
+from __future__ import division
+from __future__ import print_function
+import argparse
+import json
+import logging
+import sys
+
+from impacket.examples import logger
+from impacket.examples.utils import parse_identity
+from impacket.examples.smbcrawler import SMBCrawler, DEFAULT_EXCLUDED_SHARES
+from impacket import version
+
+
+if __name__ == '__main__':
+    print(version.BANNER, file=sys.stderr)
+
+    parser = argparse.ArgumentParser(add_help=True, description="Crawls SMB shares of multiple targets.")
+
+    parser.add_argument('identity', action='store', help='[domain/]username[:password]')
+    parser.add_argument('-targets', action='store', nargs='*', default=[], metavar='TARGET',
+                        help='Target names or addresses')
+    parser.add_argument('-targets-file', action='store', metavar='FILE', help='File with one target per line')
+    parser.add_argument('-output', action='store', metavar='FILE',
+                        help='Write JSON lines to this file (default stdout)')
+    parser.add_argument('-workers', action='store', type=int, default=10,
+                        help='Number of targets crawled concurrently (default 10)')
+    parser.add_argument('-pipeline', action='store', type=int, default=4,
+                        help='Directories queried concurrently per connection (default 4)')
+    parser.add_argument('-shares', action='store', nargs='*', metavar='SHARE', help='Only crawl these shares')
+    parser.add_argument('-exclude-shares', action='store', nargs='*', metavar='SHARE',
+                        default=list(DEFAULT_EXCLUDED_SHARES), help='Shares not crawled (default IPC$ PRINT$)')
+    parser.add_argument('-include', action='append', metavar='PATTERN',
+                        help='Only report paths matching this pattern (case insensitive, can be repeated)')
+    parser.add_argument('-exclude', action='append', metavar='PATTERN',
+                        help='Don\'t report paths matching this pattern (case insensitive, can be repeated)')
+    parser.add_argument('-progress', action='store', type=int, metavar='SECONDS',
+                        help='Log progress counters every SECONDS')
+    parser.add_argument('-ts', action='store_true', help='Adds timestamp to every logging output')
+    parser.add_argument('-debug', action='store_true', help='Turn DEBUG output ON')
+
+    group = parser.add_argument_group('connection')
+    group.add_argument('-port', choices=['139', '445'], nargs='?', default='445', metavar="destination port",
+                       help='Destination port to connect to SMB Server')
+    group.add_argument('-timeout', action='store', type=int, default=60, help='Socket timeout (default 60)')
+
+    group = parser.add_argument_group('authentication')
+    group.add_argument('-hashes', action="store", metavar="LMHASH:NTHASH", help='NTLM hashes, format is LMHASH:NTHASH')
+    group.add_argument('-no-pass', action="store_true", help='don\'t ask for password (useful for -k)')
+    group.add_argument('-k', action="store_true",
+                       help='Use Kerberos authentication. Grabs credentials from ccache file '
+                            '(KRB5CCNAME) based on target parameters. If valid credentials '
+                            'cannot be found, it will use the ones specified in the command '
+                            'line')
+    group.add_argument('-aesKey', action="store", metavar="hex key", help='AES key to use for Kerberos Authentication '
+                                                                            '(128 or 256 bits)')
+    group.add_argument('-dc-ip', action='store', metavar="ip address",
+                       help='IP Address of the domain controller. If omitted it will use the domain part (FQDN) '
+                            'specified in the identity parameter')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    options = parser.parse_args()
+
+    logger.init(options.ts, options.debug)
+
+    domain, username, password, lmhash, nthash, options.k = parse_identity(options.identity, options.hashes,
+                                                                           options.no_pass, options.aesKey, options.k)
+
+    targets = list(options.targets)
+    if options.targets_file is not None:
+        with open(options.targets_file) as fd:
+            targets.extend(line.strip() for line in fd if line.strip() != '')
+
+    if len(targets) == 0:
+        logging.critical('No targets specified')
+        sys.exit(1)
+
+    crawler = SMBCrawler(username, password, domain, lmhash, nthash, options.aesKey, options.k, options.dc_ip,
+                         int(options.port), options.timeout, options.workers, options.shares,
+                         options.exclude_shares, options.include, options.exclude, options.pipeline)
+
+    if options.output is not None:
+        fd = open(options.output, 'w')
+    else:
+        fd = sys.stdout
+
+    try:
+        stats = crawler.dump(targets, fd, options.progress)
+        logging.info('Done: %s' % json.dumps(stats))
+    except KeyboardInterrupt:
+        logging.info('Interrupted: %s' % json.dumps(crawler.getStats()))
+    finally:
+        if fd is not sys.stdout:
+            fd.close()
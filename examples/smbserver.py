@@ -56,6 +56,8 @@ if __name__ == '__main__':
     parser.add_argument('-dropssp', action='store_true', default=False, help='Disable NTLM ESS/SSP during negotiation')
     parser.add_argument('-6','--ipv6', action='store_true',help='Listen on IPv6')
     parser.add_argument('-smb2support', action='store_true', default=False, help='SMB2 Support (experimental!)')
+    parser.add_argument('-eventloop', action='store_true', default=False, help='Handle all the connections from a single '
+                        'event loop instead of a thread per connection')
     parser.add_argument('-outputfile', action='store', default=None, help='Output file to log smbserver output messages')
 
     if len(sys.argv)==1:
@@ -78,7 +80,13 @@ if __name__ == '__main__':
     if 'interface_address' not in options:
         options.interface_address = '::' if options.ipv6 else '0.0.0.0'
 
-    server = smbserver.SimpleSMBServer(listenAddress=options.interface_address, listenPort=int(options.port), ipv6=options.ipv6)
+    if options.eventloop is True:
+        smbserverclass = smbserver.AsyncSMBSERVER
+    else:
+        smbserverclass = smbserver.SMBSERVER
+
+    server = smbserver.SimpleSMBServer(listenAddress=options.interface_address, listenPort=int(options.port),
+                                       smbserverclass=smbserverclass, ipv6=options.ipv6)
 
     if options.outputfile:
         logging.info('Switching output to file %s' % options.outputfile)
@@ -2047,7 +2047,7 @@ class DCERPCServer(Thread):
     """
     #constructor to use with rpcrelayserver
     def __init__(self, client_socket=None):
-        if client_socket:
+        if client_socket is not None:
             self._clientSock = client_socket
             self._listenUUIDS = {}
             self._boundUUID = b''
@@ -2067,8 +2067,6 @@ class DCERPCServer(Thread):
             self._max_frag       = None
             self._max_xmit_size = 4280
             self.__log = LOG
-            self._sock = socket.socket()
-            self._sock.bind((self._listenAddress,self._listenPort))
 
     def set_client_socket(self, client_socket):
         self._clientSock =client_socket
@@ -2089,18 +2087,37 @@ class DCERPCServer(Thread):
         self._listenUUIDS[uuidtup_to_bin(ifaceUUID)]['CallBacks'] = callbacks
         self.log("Callback added for UUID %s V:%s" % ifaceUUID, level=logging.DEBUG)
 
-    def setListenAddress(self,addr):
-        self._listenAddress=addr
+    def __bind(self):
+        if self._sock is not None:
+            self._sock.close()
         self._sock = socket.socket()
         self._sock.bind((self._listenAddress, self._listenPort))
 
+    def __getSocket(self):
+        # Unless an address or port was set, the listening socket is only bound when needed, so servers answered
+        # in-process (see openPipe) never do it
+        if self._sock is None:
+            self.__bind()
+        return self._sock
+
+    def setListenAddress(self,addr):
+        self._listenAddress=addr
+        self.__bind()
+
     def setListenPort(self, portNum):
         self._listenPort = portNum
-        self._sock = socket.socket()
-        self._sock.bind((self._listenAddress,self._listenPort))
+        self.__bind()
 
     def getListenPort(self):
-        return self._sock.getsockname()[1]
+        return self.__getSocket().getsockname()[1]
+
+    def openPipe(self):
+        """
+        Opens an in-process endpoint for this server, see DCERPCServerPipe. The server doesn't need to be started.
+
+        :return: a new DCERPCServerPipe instance.
+        """
+        return DCERPCServerPipe(self)
 
     def recv(self):
         finished = False
@@ -2136,9 +2153,10 @@ class DCERPCServer(Thread):
         return response_data
     
     def run(self):
-        self._sock.listen(10)
+        sock = self.__getSocket()
+        sock.listen(10)
         while True:
-            self._clientSock, address = self._sock.accept()
+            self._clientSock, address = sock.accept()
             try:
                 while True:
                     data = self.recv()
@@ -2265,3 +2283,58 @@ class DCERPCServer(Thread):
             packet['type'] = MSRPC_FAULT
 
         return packet
+
+
+class DCERPCServerPipe:
+    """
+    In-process endpoint of a DCERPCServer. It exposes the socket methods used by the SMB server for named pipes
+    (send, sendall, recv and close), so pipes can be served without a listening thread and a loopback connection.
+
+    Every complete PDU written is answered synchronously, its response being available right away to recv().
+    The bind state is kept per pipe, while the interface callbacks are the ones of the server.
+
+    :param DCERPCServer server: the server whose interfaces are exposed.
+    """
+    class _Buffer(bytearray):
+        # Stands for the client socket of the per pipe DCERPCServer, whose answers are just stored
+        def send(self, data):
+            self.extend(data)
+            return len(data)
+
+    def __init__(self, server):
+        self.__input = bytearray()
+        self.__output = DCERPCServerPipe._Buffer()
+        self.__server = DCERPCServer(client_socket=self.__output)
+        self.__server._listenUUIDS = server._listenUUIDS
+
+    def send(self, data):
+        self.__input.extend(data)
+        # Enough to know the fragment length?
+        while len(self.__input) >= 10:
+            fragLen = unpack('<H', bytes(self.__input[8:10]))[0]
+            if fragLen < MSRPCHeader._SIZE:
+                # Nothing would ever be consumed, the stream can't be resynchronized
+                del self.__input[:]
+                raise DCERPCException('Invalid fragment length %d' % fragLen)
+            if len(self.__input) < fragLen:
+                break
+            pdu = bytes(self.__input[:fragLen])
+            del self.__input[:fragLen]
+            try:
+                answer = self.__server.processRequest(pdu)
+                if answer is not None:
+                    self.__server.send(answer)
+            except Exception as e:
+                LOG.debug('DCERPCServerPipe: %s' % e)
+        return len(data)
+
+    sendall = send
+
+    def recv(self, bufsize):
+        data = bytes(self.__output[:bufsize])
+        del self.__output[:bufsize]
+        return data
+
+    def close(self):
+        del self.__input[:]
+        del self.__output[:]
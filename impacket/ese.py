@@ -28,10 +28,12 @@
 
 from __future__ import division
 from __future__ import print_function
+import mmap
 from impacket import LOG
 from collections import OrderedDict
 from impacket.structure import Structure, hexdump
-from struct import unpack
+from array import array
+from struct import pack, unpack, unpack_from, iter_unpack, Struct
 from binascii import hexlify
 from six import b
 
@@ -151,6 +153,20 @@ TAGGED_DATA_TYPE_COMPRESSED    = 2
 TAGGED_DATA_TYPE_STORED        = 4
 TAGGED_DATA_TYPE_MULTI_VALUE   = 8
 TAGGED_DATA_TYPE_WHO_KNOWS     = 10
+# Two values, the first byte is the size of the first one
+TAGGED_DATA_TYPE_MULTI_VALUE_OFFSET = 0x10
+
+# Multi-value offsets flag, the value is stored in the long value tree
+MULTI_VALUE_LONG_VALUE = 0x8000
+
+# Key normalization prefixes
+KEY_PREFIX_NULL        = 0x00
+KEY_PREFIX_ZERO_LENGTH = 0x40
+KEY_PREFIX_DATA        = 0x7f
+
+# Variable size binary values are normalized in chunks of this size, each one followed by its length (plus one
+# if more chunks follow)
+KEY_BINARY_CHUNK_SIZE = 8
 
 # Code pages
 CODEPAGE_UNICODE = 1200
@@ -170,6 +186,13 @@ TABLE_CURSOR = {
     'FatherDataPageNumber': 0,
     'CurrentPageData' : b'',
     'CurrentTag' : 0,
+    'CurrentPageNumber' : 0,
+    'StopPageNumber' : 0,
+    'Projection' : None,
+    'IndexName' : None,
+    'RootPageNumber' : 0,
+    'StopKey' : None,
+    'StreamLongValues' : False,
 }
 
 class ESENT_JET_SIGNATURE(Structure):
@@ -426,6 +449,343 @@ class ESENT_CATALOG_DATA_DEFINITION_ENTRY(Structure):
         Structure.__init__(self,data)
 
 
+def ensureBytes(name):
+    # Table and column names are kept as bytes
+    if isinstance(name, bytes) is not True:
+        return b(name)
+    return name
+
+def getValueDecoder(name, record):
+    # Returns a function converting the raw data of a column to its python value
+    if record['ColumnType'] == JET_coltypText or record['ColumnType'] == JET_coltypLongText:
+        if record['CodePage'] not in StringCodePages:
+            raise Exception('Unknown codepage 0x%x' % record['CodePage'])
+        stringDecoder = StringCodePages[record['CodePage']]
+
+        def decodeString(value):
+            try:
+                return value.decode(stringDecoder)
+            except Exception:
+                LOG.debug('Fixing Record[%r][%d]: %r' % (name, record['ColumnType'], value))
+                return value.decode(stringDecoder, 'replace')
+        return decodeString
+
+    unpackData = ColumnTypeSize[record['ColumnType']]
+    if unpackData is None:
+        return hexlify
+    unpackFrom = Struct(unpackData[1]).unpack
+    return lambda value: unpackFrom(value)[0]
+
+def splitMultiValue(data, itemFlag):
+    """
+    Splits the data of a multi-valued tagged column into a list of (value, isLongValue) items. Long values hold
+    the reference to be resolved through the long value tree.
+    """
+    if itemFlag & TAGGED_DATA_TYPE_MULTI_VALUE_OFFSET:
+        firstSize = data[0]
+        return [(data[1:1+firstSize], False), (data[1+firstSize:], False)]
+
+    # An array of offsets, the first one being the array size
+    numValues = (unpack('<H', data[:2])[0] & 0x7fff) // 2
+    offsets = unpack('<%dH' % numValues, data[:2*numValues])
+    values = []
+    for i, offset in enumerate(offsets):
+        end = offsets[i+1] & 0x7fff if i + 1 < numValues else len(data)
+        values.append((data[offset & 0x7fff:end], offset & MULTI_VALUE_LONG_VALUE > 0))
+    return values
+
+class ESENT_LONG_VALUE:
+    """
+    Value stored in a table's long value tree. Chunks are read from the tree as the value is consumed, so big
+    values can be processed without holding them in memory.
+
+    :param int size: the value size.
+    :param chunks: iterator over the value chunks, in order.
+    """
+    def __init__(self, size, chunks):
+        self.size = size
+        self.__chunks = chunks
+        self.__buffer = b''
+        self.__remaining = size
+
+    def __nextChunk(self):
+        if len(self.__buffer) > 0:
+            chunk, self.__buffer = self.__buffer, b''
+            return chunk
+        if self.__remaining <= 0:
+            return b''
+        chunk = next(self.__chunks, b'')[:self.__remaining]
+        self.__remaining -= len(chunk)
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.__nextChunk()
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        """
+        Reads up to size bytes (all the remaining ones if size is negative), like a file object.
+        """
+        if size < 0:
+            return b''.join(self)
+        data = []
+        while size > 0:
+            chunk = self.__nextChunk()
+            if len(chunk) == 0:
+                break
+            if len(chunk) > size:
+                chunk, self.__buffer = chunk[:size], chunk[size:]
+            data.append(chunk)
+            size -= len(chunk)
+        return b''.join(data)
+
+class ESENT_ROW(tuple):
+    """
+    Row returned by cursors opened with a list of columns. It's a tuple with the values in the order the columns
+    were asked for, that can also be indexed by column name (like the records returned otherwise).
+    """
+    __slots__ = ()
+    columnIndex = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, (bytes, str)):
+            key = self.columnIndex[ensureBytes(key)]
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if ensureBytes(key) in self.columnIndex:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.columnIndex.keys())
+
+class ESENT_PROJECTION:
+    """
+    Decodes just a subset of the columns of a table. Where every column sits in the record and how its value is
+    converted is worked out once, so decoding a row only touches the columns asked for.
+
+    :param OrderedDict columns: the table columns, as kept in the catalog.
+    :param list names: the names of the columns to decode.
+    :param bool flagsAlwaysPresent: whether tagged data always has the flags byte (Windows 7 and later, big pages).
+    :param longValueReader: function returning the ESENT_LONG_VALUE of a long value reference, needed to resolve
+        values stored in the long value tree.
+    :param bool streamLongValues: whether long values are returned as ESENT_LONG_VALUE readers, instead of being
+        read and decoded.
+    """
+    def __init__(self, columns, names, flagsAlwaysPresent=False, longValueReader=None, streamLongValues=False):
+        self.names = [ensureBytes(name) for name in names]
+        self.__longValueReader = longValueReader
+        self.__streamLongValues = streamLongValues
+        self.rowClass = type('ESENT_ROW', (ESENT_ROW,), {'__slots__': (), 'columnIndex': dict(
+            (name, position) for position, name in enumerate(self.names))})
+        self.__flagsAlwaysPresent = flagsAlwaysPresent
+
+        # Fixed size values are stored one after the other, by identifier, right after the header
+        fixedOffsets = {}
+        offset = 4
+        for column in sorted(columns.values(), key=lambda column: column['Record']['Identifier']):
+            if column['Record']['Identifier'] <= 127:
+                fixedOffsets[column['Record']['Identifier']] = offset
+                offset += column['Record']['SpaceUsage']
+
+        self.fixed = []
+        self.variable = []
+        self.tagged = []
+        for position, name in enumerate(self.names):
+            if name not in columns:
+                # Not in this database's schema, it's always empty
+                LOG.debug('Unknown column %s' % name.decode('utf-8', 'replace'))
+                continue
+            record = columns[name]['Record']
+            identifier = record['Identifier']
+            decoder = getValueDecoder(name, record)
+            if identifier <= 127:
+                self.fixed.append((position, identifier, fixedOffsets[identifier], record['SpaceUsage'], decoder))
+            elif identifier <= 255:
+                self.variable.append((position, identifier, decoder))
+            else:
+                self.tagged.append((position, identifier, decoder))
+
+    def decode(self, data):
+        values = [None] * len(self.names)
+        lastFixedSize, lastVariableDataType, variableSizeOffset = unpack('<BBH', data[:4])
+
+        for position, identifier, offset, size, decoder in self.fixed:
+            if identifier <= lastFixedSize:
+                values[position] = decoder(data[offset:offset+size])
+
+        # Every variable size entry holds where its value ends, the higher bit meaning it's empty
+        numVariable = max(lastVariableDataType - 127, 0)
+        variableEnds = unpack('<%dH' % numVariable, data[variableSizeOffset:variableSizeOffset+2*numVariable])
+        variableDataOffset = variableSizeOffset + 2*numVariable
+        for position, identifier, decoder in self.variable:
+            index = identifier - 128
+            if index < numVariable and variableEnds[index] & 0x8000 == 0:
+                start = variableEnds[index-1] & 0x7fff if index > 0 else 0
+                values[position] = decoder(data[variableDataOffset+start:variableDataOffset+variableEnds[index]])
+
+        taggedDataOffset = variableDataOffset + (variableEnds[-1] & 0x7fff if numVariable > 0 else 0)
+        if len(self.tagged) > 0 and taggedDataOffset < len(data):
+            taggedItems = self.__getTaggedItems(data, taggedDataOffset)
+            for position, identifier, decoder in self.tagged:
+                if identifier not in taggedItems:
+                    continue
+                start, end, flagsPresent = taggedItems[identifier]
+                if flagsPresent:
+                    itemFlag = data[start]
+                    start += 1
+                else:
+                    itemFlag = 0
+                if itemFlag & TAGGED_DATA_TYPE_COMPRESSED:
+                    LOG.error('Unsupported tag column: %s, flag:0x%x' % (self.names[position], itemFlag))
+                elif itemFlag & (TAGGED_DATA_TYPE_MULTI_VALUE | TAGGED_DATA_TYPE_MULTI_VALUE_OFFSET):
+                    values[position] = [self.__decodeValue(value, isLongValue, decoder) for value, isLongValue in
+                                        splitMultiValue(data[start:end], itemFlag)]
+                else:
+                    values[position] = self.__decodeValue(data[start:end], itemFlag & TAGGED_DATA_TYPE_STORED > 0,
+                                                          decoder)
+
+        return self.rowClass(values)
+
+    def __decodeValue(self, value, isLongValue, decoder):
+        if isLongValue is False:
+            return decoder(value)
+        try:
+            longValue = self.__longValueReader(value)
+            if self.__streamLongValues is True:
+                return longValue
+            value = longValue.read()
+        except Exception as e:
+            # A missing or broken long value doesn't make the whole row fail, its reference is returned instead
+            LOG.debug('Exception:', exc_info=True)
+            LOG.error('Cannot read long value %s (%s)' % (hexlify(value).decode('utf-8'), e))
+            return hexlify(value)
+        return decoder(value)
+
+    def __getTaggedItems(self, data, taggedDataOffset):
+        # The tagged data starts with an array of (identifier, offset) pairs, the first offset being the array size
+        arraySize = unpack('<H', data[taggedDataOffset+2:taggedDataOffset+4])[0] & 0x3fff
+        entries = list(iter_unpack('<HH', data[taggedDataOffset:taggedDataOffset+arraySize]))
+        taggedItems = {}
+        for i, (identifier, offset) in enumerate(entries):
+            start = taggedDataOffset + (offset & 0x3fff)
+            if i + 1 < len(entries):
+                end = taggedDataOffset + (entries[i+1][1] & 0x3fff)
+            else:
+                end = len(data)
+            taggedItems[identifier] = (start, end, self.__flagsAlwaysPresent or offset & 0x4000)
+        return taggedItems
+
+class ESENT_FILE:
+    """
+    Storage backend reading the database through a file object (seek and read). It's used for remote files, and
+    for local ones that can't be mapped.
+
+    :param fd: the opened file object.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+
+    def read(self, offset, length):
+        self.fd.seek(offset, 0)
+        data = self.fd.read(length)
+        while len(data) < length:
+            chunk = self.fd.read(length - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def getSize(self):
+        self.fd.seek(0, 2)
+        return self.fd.tell()
+
+    def close(self):
+        self.fd.close()
+
+class ESENT_MMAP_FILE(ESENT_FILE):
+    """
+    Storage backend for local files, mapped in memory so pages are just sliced out of the map.
+
+    :param fd: the opened file object.
+    """
+    def __init__(self, fd):
+        ESENT_FILE.__init__(self, fd)
+        self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, offset, length):
+        return self.map[offset:offset+length]
+
+    def getSize(self):
+        return len(self.map)
+
+    def close(self):
+        self.map.close()
+        ESENT_FILE.close(self)
+
+def normalizeKeyColumn(columnType, value, descending=False):
+    """
+    Returns the normalized (i.e. sortable as bytes) key segment for a column value, as stored in the B-trees.
+    Text columns are keyed by Windows sort keys (LCMapString) that can't be built here, their keys have to be
+    grabbed from the database itself.
+
+    :param int columnType: the column type, one of JET_coltyp*.
+    :param value: the column value, None for NULL.
+    :param bool descending: whether the column is descending in the index.
+    """
+    if value is None:
+        segment = bytes((KEY_PREFIX_NULL,))
+    elif columnType == JET_coltypBit:
+        segment = bytes((KEY_PREFIX_DATA, 0xff if value else 0x00))
+    elif columnType in (JET_coltypUnsignedByte, JET_coltypUnsignedShort, JET_coltypUnsignedLong):
+        size = {JET_coltypUnsignedByte: 1, JET_coltypUnsignedShort: 2, JET_coltypUnsignedLong: 4}[columnType]
+        segment = bytes((KEY_PREFIX_DATA,)) + value.to_bytes(size, 'big')
+    elif columnType in (JET_coltypShort, JET_coltypLong, JET_coltypLongLong, JET_coltypCurrency):
+        # Big endian, with the sign bit flipped so negative values sort first
+        size = {JET_coltypShort: 2, JET_coltypLong: 4, JET_coltypLongLong: 8, JET_coltypCurrency: 8}[columnType]
+        segment = bytes((KEY_PREFIX_DATA,)) + (value + (1 << (size*8-1))).to_bytes(size, 'big')
+    elif columnType in (JET_coltypIEEESingle, JET_coltypIEEEDouble, JET_coltypDateTime):
+        packed = bytearray(pack('>f' if columnType == JET_coltypIEEESingle else '>d', value))
+        if packed[0] & 0x80:
+            packed = bytearray(byte ^ 0xff for byte in packed)
+        else:
+            packed[0] ^= 0x80
+        segment = bytes((KEY_PREFIX_DATA,)) + bytes(packed)
+    elif columnType == JET_coltypGUID:
+        segment = bytes((KEY_PREFIX_DATA,)) + value[10:16] + value[8:10] + value[6:8] + value[4:6] + value[0:4]
+    elif columnType in (JET_coltypBinary, JET_coltypLongBinary):
+        if len(value) == 0:
+            segment = bytes((KEY_PREFIX_ZERO_LENGTH,))
+        else:
+            segment = bytearray((KEY_PREFIX_DATA,))
+            for offset in range(0, len(value), KEY_BINARY_CHUNK_SIZE):
+                chunk = value[offset:offset+KEY_BINARY_CHUNK_SIZE]
+                segment += chunk + b'\x00' * (KEY_BINARY_CHUNK_SIZE - len(chunk))
+                if offset + KEY_BINARY_CHUNK_SIZE < len(value):
+                    segment.append(KEY_BINARY_CHUNK_SIZE + 1)
+                else:
+                    segment.append(len(chunk))
+            segment = bytes(segment)
+    else:
+        raise Exception('Key normalization not supported for %s columns' % ColumnTypeToName.get(columnType, columnType))
+
+    if descending is True:
+        segment = bytes(byte ^ 0xff for byte in segment)
+    return segment
+
+def openLocalFile(fileName):
+    fd = open(fileName, 'rb')
+    try:
+        return ESENT_MMAP_FILE(fd)
+    except (ValueError, OSError) as e:
+        # Empty files, or filesystems not supporting it
+        LOG.debug('Cannot map %s (%s), reading it instead' % (fileName, e))
+        return ESENT_FILE(fd)
+
 def getUnixTime(t):
     t -= 116444736000000000
     t //= 10000000
@@ -436,8 +796,37 @@ class ESENT_PAGE:
         self.__DBHeader = db
         self.data = data
         self.record = None
+        # Decoded tag directory, offsets are absolute within data
+        self.tagOffsets = array('I')
+        self.tagSizes = array('H')
+        self.tagFlags = array('B')
+        # As of Windows 7 (version 0x620 revision 0x11), pages bigger than 8K keep the tag flags in the data
+        self.__largePageFormat = self.__DBHeader['Version'] == 0x620 and self.__DBHeader['FileFormatRevision'] >= 17 \
+                                 and self.__DBHeader['PageSize'] > 8192
         if data is not None:
             self.record = ESENT_PAGE_HEADER(self.__DBHeader['Version'], self.__DBHeader['FileFormatRevision'], self.__DBHeader['PageSize'], data)
+            self.__decodeTags()
+
+    def __decodeTags(self):
+        # The tag directory grows backwards from the end of the page, four bytes per tag. It's decoded just once,
+        # so getTag() is a lookup instead of a walk over the whole directory
+        numTags = self.record['FirstAvailablePageTag']
+        baseOffset = len(self.record)
+        tags = list(iter_unpack('<HH', self.data[len(self.data)-4*numTags:]))
+        tags.reverse()
+
+        if self.__largePageFormat:
+            for valueSize, valueOffset in tags:
+                valueSize &= 0x7fff
+                valueOffset = baseOffset + (valueOffset & 0x7fff)
+                self.tagOffsets.append(valueOffset)
+                self.tagSizes.append(valueSize)
+                self.tagFlags.append(self.data[valueOffset+1] >> 5 if valueSize > 1 else 0)
+        else:
+            for valueSize, valueOffset in tags:
+                self.tagOffsets.append(baseOffset + (valueOffset & 0x1fff))
+                self.tagSizes.append(valueSize & 0x1fff)
+                self.tagFlags.append((valueOffset & 0xe000) >> 13)
 
     def printFlags(self):
         flags = self.record['PageFlags']
@@ -465,30 +854,14 @@ class ESENT_PAGE:
     def dump(self):
         baseOffset = len(self.record)
         self.record.dump()
-        tags = self.data[-4*self.record['FirstAvailablePageTag']:]
-
         print("FLAGS: ")
         self.printFlags()
 
         print()
 
-        for i in range(self.record['FirstAvailablePageTag']):
-            tag = tags[-4:]
-            if self.__DBHeader['Version'] == 0x620 and self.__DBHeader['FileFormatRevision'] > 11 and self.__DBHeader['PageSize'] > 8192:
-                valueSize = unpack('<H', tag[:2])[0] & 0x7fff
-                valueOffset = unpack('<H',tag[2:])[0] & 0x7fff
-                hexdump((self.data[baseOffset+valueOffset:][:6]))
-                pageFlags = ord(self.data[baseOffset+valueOffset:][1]) >> 5
-                #print "TAG FLAG: 0x%x " % (unpack('<L', self.data[baseOffset+valueOffset:][:4]) ) >> 5
-                #print "TAG FLAG: 0x " , ord(self.data[baseOffset+valueOffset:][0])
-            else:
-                valueSize = unpack('<H', tag[:2])[0] & 0x1fff
-                pageFlags = (unpack('<H', tag[2:])[0] & 0xe000) >> 13
-                valueOffset = unpack('<H',tag[2:])[0] & 0x1fff
-                
-            print("TAG %-8d offset:0x%-6x flags:0x%-4x valueSize:0x%x" % (i,valueOffset,pageFlags,valueSize))
-            #hexdump(self.getTag(i)[1])
-            tags = tags[:-4]
+        for i in range(len(self.tagOffsets)):
+            print("TAG %-8d offset:0x%-6x flags:0x%-4x valueSize:0x%x" % (i, self.tagOffsets[i]-baseOffset,
+                                                                          self.tagFlags[i], self.tagSizes[i]))
 
         if self.record['PageFlags'] & FLAGS_ROOT > 0:
             rootHeader = ESENT_ROOT_HEADER(self.getTag(0)[1])
@@ -540,41 +913,53 @@ class ESENT_PAGE:
                     hexdump(leafEntry['EntryData'])
 
     def getTag(self, tagNum):
-        if self.record['FirstAvailablePageTag'] < tagNum:
+        if tagNum >= len(self.tagOffsets):
             raise Exception('Trying to grab an unknown tag 0x%x' % tagNum)
 
-        tags = self.data[-4*self.record['FirstAvailablePageTag']:]
-        baseOffset = len(self.record)
-        for i in range(tagNum):
-            tags = tags[:-4]
-
-        tag = tags[-4:]
-
-        if self.__DBHeader['Version'] == 0x620 and self.__DBHeader['FileFormatRevision'] >= 17 and self.__DBHeader['PageSize'] > 8192:
-            valueSize = unpack('<H', tag[:2])[0] & 0x7fff
-            valueOffset = unpack('<H',tag[2:])[0] & 0x7fff
-            tmpData = bytearray(self.data[baseOffset+valueOffset:][:valueSize])
-            pageFlags = tmpData[1] >> 5
-            tmpData[1] = tmpData[1:2][0] & 0x1f
-            tmpData = bytes(tmpData)
-            tagData = tmpData
-        else:
-            valueSize = unpack('<H', tag[:2])[0] & 0x1fff
-            pageFlags = (unpack('<H', tag[2:])[0] & 0xe000) >> 13
-            valueOffset = unpack('<H',tag[2:])[0] & 0x1fff
-            tagData = self.data[baseOffset+valueOffset:][:valueSize]
+        valueOffset = self.tagOffsets[tagNum]
+        tagData = self.data[valueOffset:valueOffset+self.tagSizes[tagNum]]
+        if self.__largePageFormat and len(tagData) > 1:
+            # Strip the flags out of the second byte
+            tagData = tagData[:1] + bytes((tagData[1] & 0x1f,)) + tagData[2:]
 
-        #return pageFlags, self.data[baseOffset+valueOffset:][:valueSize]
-        return pageFlags, tagData
+        return self.tagFlags[tagNum], tagData
+
+    def getKey(self, tagNum):
+        """
+        Returns the full key of a leaf or branch entry, prepending the page's common key (kept at tag 0 of
+        non root pages) if the entry is prefix compressed.
+        """
+        flags, data = self.getTag(tagNum)
+        if flags & TAG_COMMON > 0:
+            commonKeySize, localKeySize = unpack_from('<HH', data)
+            commonKey = b''
+            if self.record['PageFlags'] & FLAGS_ROOT == 0:
+                commonKey = self.getTag(0)[1][:commonKeySize]
+            return commonKey + data[4:4+localKeySize]
+        else:
+            localKeySize = unpack_from('<H', data)[0]
+            return data[2:2+localKeySize]
 
 class ESENT_DB:
-    def __init__(self, fileName, pageSize = 8192, isRemote = False):
+    """
+    ESE database parser
+
+    :param fileName: the database path or, if isRemote is True, a file object with open(), seek(), read() and
+        close() (e.g. secretsdump's RemoteFile).
+    :param int pageSize: the page size, only used until the database header is read.
+    :param bool isRemote: whether fileName is a file object instead of a path.
+    :param int pageCacheSize: the maximum number of parsed pages kept in memory, for both local and remote files.
+    """
+    def __init__(self, fileName, pageSize = 8192, isRemote = False, pageCacheSize = 1024):
         self.__fileName = fileName
         self.__pageSize = pageSize
+        self.__pageCacheSize = pageCacheSize
+        self.__pageCache = OrderedDict()
         self.__DB = None
         self.__DBHeader = None
         self.__totalPages = None
         self.__tables = OrderedDict()
+        self.__projections = {}
         self.__currentTable = None
         self.__isRemote = isRemote
         self.mountDB()
@@ -582,15 +967,15 @@ class ESENT_DB:
     def mountDB(self):
         LOG.debug("Mounting DB...")
         if self.__isRemote is True:
-            self.__DB = self.__fileName
-            self.__DB.open()
+            self.__fileName.open()
+            self.__DB = ESENT_FILE(self.__fileName)
         else:
-            self.__DB = open(self.__fileName,"rb")
+            self.__DB = openLocalFile(self.__fileName)
+        self.__pageCache.clear()
         mainHeader = self.getPage(-1)
         self.__DBHeader = ESENT_DB_HEADER(mainHeader)
         self.__pageSize = self.__DBHeader['PageSize']
-        self.__DB.seek(0,2)
-        self.__totalPages = (self.__DB.tell() // self.__pageSize) -2
+        self.__totalPages = (self.__DB.getSize() // self.__pageSize) -2
         LOG.debug("Database Version:0x%x, Revision:0x%x"% (self.__DBHeader['Version'], self.__DBHeader['FileFormatRevision']))
         LOG.debug("Page Size: %d" % self.__pageSize)
         LOG.debug("Total Pages in file: %d" % self.__totalPages)
@@ -615,6 +1000,21 @@ class ESENT_DB:
                 print("%s%s" % (indent*2, index.decode('utf-8')))
             print("")
 
+    def getColumnNames(self, tableName):
+        """
+        Returns the names of the columns of a table, in catalog order.
+        """
+        return list(self.__tables[ensureBytes(tableName)]['Columns'].keys())
+
+    def getColumnType(self, tableName, columnName):
+        """
+        Returns the type (JET_coltyp*) of a column of a table, None if the table has no such column.
+        """
+        column = self.__tables[ensureBytes(tableName)]['Columns'].get(ensureBytes(columnName))
+        if column is None:
+            return None
+        return column['Record']['ColumnType']
+
     def __addItem(self, entry):
         dataDefinitionHeader = ESENT_DATA_DEFINITION_HEADER(entry['EntryData'])
         catalogEntry = ESENT_CATALOG_DATA_DEFINITION_ENTRY(entry['EntryData'][len(dataDefinitionHeader):])
@@ -690,60 +1090,314 @@ class ESENT_DB:
         LOG.debug("Reading Boot Sector for %s" % self.__volumeName)
 
     def getPage(self, pageNum):
+        # Parsed pages are kept in a LRU cache, catalog and branch pages are walked over and over
+        page = self.__pageCache.get(pageNum)
+        if page is not None:
+            self.__pageCache.move_to_end(pageNum)
+            return page
+
         LOG.debug("Trying to fetch page %d (0x%x)" % (pageNum, (pageNum+1)*self.__pageSize))
-        self.__DB.seek((pageNum+1)*self.__pageSize, 0)
-        data = self.__DB.read(self.__pageSize)
-        while len(data) < self.__pageSize:
-            remaining = self.__pageSize - len(data)
-            data += self.__DB.read(remaining)
+        data = self.__DB.read((pageNum+1)*self.__pageSize, self.__pageSize)
         # Special case for the first page
         if pageNum <= 0:
             return data
-        else:
-            return ESENT_PAGE(self.__DBHeader, data)
+
+        page = ESENT_PAGE(self.__DBHeader, data)
+        if self.__pageCacheSize > 0:
+            self.__pageCache[pageNum] = page
+            if len(self.__pageCache) > self.__pageCacheSize:
+                self.__pageCache.popitem(last=False)
+        return page
 
     def close(self):
+        self.__pageCache.clear()
         self.__DB.close()
 
-    def openTable(self, tableName):
-        # Returns a cursos for later use
+    def __getTableRoot(self, tableName):
+        entry = self.__tables[tableName]['TableEntry']
+        dataDefinitionHeader = ESENT_DATA_DEFINITION_HEADER(entry['EntryData'])
+        catalogEntry = ESENT_CATALOG_DATA_DEFINITION_ENTRY(entry['EntryData'][len(dataDefinitionHeader):])
+        return catalogEntry['FatherDataPageNumber']
+
+    def __getIndexRoot(self, tableName, indexName):
+        indexName = ensureBytes(indexName)
+        if indexName not in self.__tables[tableName]['Indexes']:
+            raise Exception('Unknown index %s for table %s' % (indexName.decode('utf-8'), tableName.decode('utf-8')))
+        entry = self.__tables[tableName]['Indexes'][indexName]
+        dataDefinitionHeader = ESENT_DATA_DEFINITION_HEADER(entry['EntryData'])
+        catalogEntry = ESENT_CATALOG_DATA_DEFINITION_ENTRY(entry['EntryData'][len(dataDefinitionHeader):])
+        return catalogEntry['FatherDataPageNumber']
+
+    def openTable(self, tableName, columns=None, pageRange=None, indexName=None, streamLongValues=False):
+        # Returns a cursos for later use.
+        # If columns (a list of names) is given, getNextRow() decodes just them, returning ESENT_ROW tuples
+        # If pageRange (a (firstPage, stopPage) tuple, see getLeafPageRanges()) is given, the cursor just walks
+        # the leaf pages from firstPage up to, but not including, stopPage
+        # If indexName is given, rows are returned in that index order, and seek() positions the cursor by its keys
+        # If streamLongValues is True, values kept in the long value tree are returned as ESENT_LONG_VALUE readers
 
         if isinstance(tableName, bytes) is not True:
             tableName = b(tableName)
 
         if tableName in self.__tables:
-            entry = self.__tables[tableName]['TableEntry']
-            dataDefinitionHeader = ESENT_DATA_DEFINITION_HEADER(entry['EntryData'])
-            catalogEntry = ESENT_CATALOG_DATA_DEFINITION_ENTRY(entry['EntryData'][len(dataDefinitionHeader):])
-            
-            # Let's position the cursor at the leaf levels for fast reading
-            pageNum = catalogEntry['FatherDataPageNumber']
-            done = False
-            while done is False:
+            fatherDataPageNumber = self.__getTableRoot(tableName)
+            if indexName is not None:
+                rootPageNumber = self.__getIndexRoot(tableName, indexName)
+            else:
+                rootPageNumber = fatherDataPageNumber
+
+            if pageRange is not None:
+                pageNum, stopPageNum = pageRange
                 page = self.getPage(pageNum)
-                if page.record['FirstAvailablePageTag'] <= 1:
-                    # There are no records
-                    done = True
-                for i in range(1, page.record['FirstAvailablePageTag']):
-                    flags, data = page.getTag(i)
-                    if page.record['PageFlags'] & FLAGS_LEAF == 0:
-                        # Branch page, move on to the next page
-                        branchEntry = ESENT_BRANCH_ENTRY(flags, data)
-                        pageNum = branchEntry['ChildPageNumber']
-                        break
-                    else:
+            else:
+                stopPageNum = 0
+                # Let's position the cursor at the leaf levels for fast reading
+                pageNum = rootPageNumber
+                done = False
+                while done is False:
+                    page = self.getPage(pageNum)
+                    if page.record['FirstAvailablePageTag'] <= 1:
+                        # There are no records
                         done = True
-                        break
+                    for i in range(1, page.record['FirstAvailablePageTag']):
+                        flags, data = page.getTag(i)
+                        if page.record['PageFlags'] & FLAGS_LEAF == 0:
+                            # Branch page, move on to the next page
+                            branchEntry = ESENT_BRANCH_ENTRY(flags, data)
+                            pageNum = branchEntry['ChildPageNumber']
+                            break
+                        else:
+                            done = True
+                            break
                 
-            cursor = TABLE_CURSOR
+            cursor = dict(TABLE_CURSOR)
             cursor['TableData'] = self.__tables[tableName]
-            cursor['FatherDataPageNumber'] = catalogEntry['FatherDataPageNumber']
+            cursor['FatherDataPageNumber'] = fatherDataPageNumber
             cursor['CurrentPageData'] = page
             cursor['CurrentTag']  = 0
+            cursor['CurrentPageNumber'] = pageNum
+            cursor['StopPageNumber'] = stopPageNum
+            cursor['IndexName'] = ensureBytes(indexName) if indexName is not None else None
+            cursor['RootPageNumber'] = rootPageNumber
+            cursor['StreamLongValues'] = streamLongValues
+            if columns is not None:
+                cursor['Projection'] = self.getProjection(tableName, columns, streamLongValues)
             return cursor
         else:
             return None
 
+    def getLeafPages(self, tableName):
+        """
+        Returns the numbers of the leaf pages of a table, in key order. Just the branch pages are walked: the
+        children of pages flagged as parents of leaves are taken as leaves without reading them, while every child
+        of the other branch pages is walked in turn.
+        """
+        tableName = ensureBytes(tableName)
+        leafPages = []
+        pending = [self.__getTableRoot(tableName)]
+        while len(pending) > 0:
+            pageNum = pending.pop()
+            page = self.getPage(pageNum)
+            if page.record['PageFlags'] & FLAGS_LEAF > 0:
+                leafPages.append(pageNum)
+                continue
+
+            children = []
+            for i in range(1, page.record['FirstAvailablePageTag']):
+                flags, data = page.getTag(i)
+                children.append(ESENT_BRANCH_ENTRY(flags, data)['ChildPageNumber'])
+            if page.record['PageFlags'] & FLAGS_PARENT > 0:
+                leafPages.extend(children)
+            else:
+                # Depth first, keeping the key order
+                children.reverse()
+                pending.extend(children)
+        return leafPages
+
+    def getLeafPageRanges(self, tableName, count, firstPage=None):
+        """
+        Splits the leaf pages of a table into up to count ranges with about the same number of pages, so they can
+        be scanned independently (e.g. by different processes, each one with its own ESENT_DB).
+
+        :param tableName: the table name.
+        :param int count: the number of ranges wanted.
+        :param int firstPage: if set, the leaf page where the first range starts, pages before it are skipped.
+
+        :return: a list of (firstPage, stopPage) tuples, in key order, to be used as openTable()'s pageRange.
+            stopPage is the first page of the next range, or 0 for the last one.
+        """
+        leafPages = self.getLeafPages(tableName)
+        if firstPage is not None:
+            if firstPage not in leafPages:
+                raise Exception('Page %d is not a leaf page of %s' % (firstPage, tableName))
+            leafPages = leafPages[leafPages.index(firstPage):]
+        if len(leafPages) == 0:
+            return []
+
+        count = max(1, min(count, len(leafPages)))
+        starts = [leafPages[(i * len(leafPages)) // count] for i in range(count)]
+        return list(zip(starts, starts[1:] + [0]))
+
+    def makeKey(self, tableName, values):
+        """
+        Builds an index key (or a key prefix, to be used with seek()) out of column values.
+
+        :param tableName: the table name.
+        :param list values: (columnName, value) or (columnName, value, descending) tuples, in the index order.
+
+        :return: the normalized key, as bytes.
+        """
+        columns = self.__tables[ensureBytes(tableName)]['Columns']
+        key = b''
+        for item in values:
+            columnName, value = item[:2]
+            descending = item[2] if len(item) > 2 else False
+            columnType = columns[ensureBytes(columnName)]['Record']['ColumnType']
+            key += normalizeKeyColumn(columnType, value, descending)
+        return key
+
+    def __seekPage(self, pageNum, key):
+        # Walks down the tree rooted at pageNum, returns the leaf page (and its number) where the first entry
+        # with a key greater or equal than key is, or would be
+        while True:
+            page = self.getPage(pageNum)
+            if page.record['PageFlags'] & FLAGS_LEAF > 0:
+                return pageNum, page
+
+            numTags = page.record['FirstAvailablePageTag']
+            if numTags <= 1:
+                return pageNum, page
+            # Branch keys are the upper bounds of their child pages, the last one (usually empty) covers the rest
+            low, high = 1, numTags - 1
+            while low < high:
+                middle = (low + high) // 2
+                if page.getKey(middle) < key:
+                    low = middle + 1
+                else:
+                    high = middle
+            flags, data = page.getTag(low)
+            pageNum = ESENT_BRANCH_ENTRY(flags, data)['ChildPageNumber']
+
+    @staticmethod
+    def __seekTag(page, key):
+        # Returns the first tag of a leaf page with a key greater or equal than key, FirstAvailablePageTag if none
+        low, high = 1, page.record['FirstAvailablePageTag']
+        while low < high:
+            middle = (low + high) // 2
+            if page.getKey(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def seek(self, cursor, key, stopKey=None):
+        """
+        Positions a cursor (see openTable()) so the next getNextRow() returns the first row whose key, in the
+        cursor's index, is greater or equal than key. Just the branch pages in the way to it are read.
+
+        :param dict cursor: the cursor.
+        :param bytes key: the key (or key prefix) to seek, see makeKey().
+        :param bytes stopKey: if set, getNextRow() stops at the first row whose key is greater than stopKey, keys
+            being compared up to the length of stopKey. So seek(cursor, prefix, prefix) walks all the rows starting
+            with prefix.
+        """
+        pageNum, page = self.__seekPage(cursor['RootPageNumber'], key)
+        cursor['CurrentPageNumber'] = pageNum
+        cursor['CurrentPageData'] = page
+        # getNextRow() moves to the next tag before reading it
+        cursor['CurrentTag'] = self.__seekTag(page, key) - 1
+        cursor['StopPageNumber'] = 0
+        cursor['StopKey'] = stopKey
+
+    def getRow(self, tableName, key, indexName=None, columns=None):
+        """
+        Returns the first row whose key matches key (a key prefix, see makeKey()), None if there's no such row.
+        """
+        cursor = self.openTable(tableName, columns, indexName=indexName)
+        if cursor is None:
+            return None
+        self.seek(cursor, key, key)
+        return self.getNextRow(cursor)
+
+    def __walkTree(self, rootPageNumber, key):
+        # Yields the (key, data) leaf entries of a tree, from the first one with a key greater or equal than key
+        pageNum, page = self.__seekPage(rootPageNumber, key)
+        tagNum = self.__seekTag(page, key)
+        while True:
+            while tagNum < page.record['FirstAvailablePageTag']:
+                flags, data = page.getTag(tagNum)
+                yield page.getKey(tagNum), ESENT_LEAF_ENTRY(flags, data)['EntryData']
+                tagNum += 1
+            if page.record['NextPageNumber'] == 0:
+                return
+            page = self.getPage(page.record['NextPageNumber'])
+            tagNum = 1
+
+    def __getRecordData(self, rootPageNumber, key):
+        # Returns the data of the record with the given primary key
+        entryKey, data = next(self.__walkTree(rootPageNumber, key), (None, None))
+        if entryKey != key:
+            return None
+        return data
+
+    def __openLongValue(self, tableData, reference):
+        if len(tableData['LongValues']) == 0:
+            raise Exception('Long value referenced, but the table has no long value tree')
+        entry = list(tableData['LongValues'].values())[0]
+        dataDefinitionHeader = ESENT_DATA_DEFINITION_HEADER(entry['EntryData'])
+        catalogEntry = ESENT_CATALOG_DATA_DEFINITION_ENTRY(entry['EntryData'][len(dataDefinitionHeader):])
+
+        # The long value id is little endian in the records, big endian in the long value tree keys. The tree has
+        # a root entry (reference count and size) keyed by the id, followed by the chunks keyed by id and offset
+        if isinstance(reference, int):
+            lidKey = pack('>L', reference)
+        else:
+            lidKey = bytes(reference[::-1])
+        entries = self.__walkTree(catalogEntry['FatherDataPageNumber'], lidKey)
+        key, data = next(entries, (None, None))
+        if key != lidKey:
+            raise Exception('Long value %s not found' % hexlify(lidKey).decode('utf-8'))
+        size = unpack_from('<L', data, 4)[0]
+
+        def chunks():
+            for key, data in entries:
+                if len(key) != len(lidKey) + 4 or key[:len(lidKey)] != lidKey:
+                    break
+                yield data
+
+        return ESENT_LONG_VALUE(size, chunks())
+
+    def openLongValue(self, tableName, reference):
+        """
+        Returns an ESENT_LONG_VALUE reader for a value stored in the long value tree of a table.
+
+        :param tableName: the table name.
+        :param reference: the long value id, either an int or the reference as found in the record (bytes).
+        """
+        return self.__openLongValue(self.__tables[ensureBytes(tableName)], reference)
+
+    def getLongValue(self, tableName, reference):
+        """
+        Returns the whole data of a value stored in the long value tree of a table, see openLongValue().
+        """
+        return self.openLongValue(tableName, reference).read()
+
+    def getProjection(self, tableName, columns, streamLongValues=False):
+        """
+        Returns an ESENT_PROJECTION decoding the given columns of a table. Projections are cached per table and
+        list of columns, so opening many cursors costs nothing.
+        """
+        tableName = ensureBytes(tableName)
+        key = (tableName, streamLongValues) + tuple(ensureBytes(column) for column in columns)
+        if key not in self.__projections:
+            flagsAlwaysPresent = self.__DBHeader['Version'] == 0x620 and self.__DBHeader['FileFormatRevision'] >= 17 \
+                                 and self.__DBHeader['PageSize'] > 8192
+            tableData = self.__tables[tableName]
+            self.__projections[key] = ESENT_PROJECTION(tableData['Columns'], key[2:], flagsAlwaysPresent,
+                                                       lambda reference: self.__openLongValue(tableData, reference),
+                                                       streamLongValues)
+        return self.__projections[key]
+
     def __getNextTag(self, cursor):
         page = cursor['CurrentPageData']
 
@@ -756,12 +1410,12 @@ class ESENT_DB:
             # Leaf page
             if page.record['PageFlags'] & FLAGS_SPACE_TREE > 0:
                 raise Exception('FLAGS_SPACE_TREE > 0')
-            elif page.record['PageFlags'] & FLAGS_INDEX > 0:
+            elif page.record['PageFlags'] & FLAGS_INDEX > 0 and cursor['IndexName'] is None:
                 raise Exception('FLAGS_INDEX > 0')
             elif page.record['PageFlags'] & FLAGS_LONG_VALUE > 0:
                 raise Exception('FLAGS_LONG_VALUE > 0')
             else:
-                # Table Value
+                # Table Value, or index entry
                 leafEntry = ESENT_LEAF_ENTRY(flags, data)
                 return leafEntry
 
@@ -776,15 +1430,33 @@ class ESENT_DB:
         if tag is None:
             # No more tags in this page, search for the next one on the right
             page = cursor['CurrentPageData']
-            if page.record['NextPageNumber'] == 0:
+            if page.record['NextPageNumber'] == 0 or page.record['NextPageNumber'] == cursor['StopPageNumber']:
                 # No more pages, chau
                 return None
             else:
+                cursor['CurrentPageNumber'] = page.record['NextPageNumber']
                 cursor['CurrentPageData'] = self.getPage(page.record['NextPageNumber'])
                 cursor['CurrentTag'] = 0
                 return self.getNextRow(cursor, filter_tables = filter_tables)
+
+        if cursor['StopKey'] is not None:
+            stopKey = cursor['StopKey']
+            if cursor['CurrentPageData'].getKey(cursor['CurrentTag'])[:len(stopKey)] > stopKey:
+                # Out of the range, chau
+                return None
+
+        data = tag['EntryData']
+        if cursor['RootPageNumber'] != cursor['FatherDataPageNumber']:
+            # Secondary index entry, its data is the key of the record in the table
+            recordKey = data
+            data = self.__getRecordData(cursor['FatherDataPageNumber'], recordKey)
+            if data is None:
+                raise Exception('Record %s not found' % hexlify(recordKey).decode('utf-8'))
+
+        if cursor['Projection'] is not None and filter_tables is None:
+            return cursor['Projection'].decode(data)
         else:
-            return self.__tagToRecord(cursor, tag['EntryData'], filter_tables = filter_tables)
+            return self.__tagToRecord(cursor, data, filter_tables = filter_tables)
 
     def __tagToRecord(self, cursor, tag, filter_tables = None):
         # So my brain doesn't forget, the data record is composed of:
@@ -907,10 +1579,30 @@ class ESENT_DB:
                     if itemFlag & (TAGGED_DATA_TYPE_COMPRESSED ):
                         LOG.error('Unsupported tag column: %s, flag:0x%x' % (column, itemFlag))
                         record[column] = None
-                    elif itemFlag & TAGGED_DATA_TYPE_MULTI_VALUE:
-                        # ToDo: Parse multi-values properly
-                        LOG.debug('Multivalue detected in column %s, returning raw results' % (column))
-                        record[column] = (hexlify(tag[offsetItem:][:itemSize]),)
+                    elif itemFlag & (TAGGED_DATA_TYPE_MULTI_VALUE | TAGGED_DATA_TYPE_MULTI_VALUE_OFFSET):
+                        decoder = getValueDecoder(column, columnRecord)
+                        values = []
+                        for value, isLongValue in splitMultiValue(tag[offsetItem:][:itemSize], itemFlag):
+                            if isLongValue is True:
+                                value = self.__openLongValue(cursor['TableData'], value)
+                                if cursor['StreamLongValues'] is True:
+                                    values.append(value)
+                                    continue
+                                value = value.read()
+                            values.append(decoder(value))
+                        record[column] = (values,)
+                    elif itemFlag & TAGGED_DATA_TYPE_STORED:
+                        reference = tag[offsetItem:][:itemSize]
+                        try:
+                            record[column] = self.__openLongValue(cursor['TableData'], reference)
+                            if cursor['StreamLongValues'] is True:
+                                record[column] = (record[column],)
+                            else:
+                                record[column] = record[column].read()
+                        except Exception as e:
+                            LOG.debug('Exception:', exc_info=True)
+                            LOG.error('Cannot read long value of column %s (%s)' % (column, e))
+                            record[column] = (hexlify(reference),)
                     else:
                         record[column] = tag[offsetItem:][:itemSize]
 
@@ -922,7 +1614,7 @@ class ESENT_DB:
             # If we understand the data type, we unpack it and cast it accordingly
             # otherwise, we just encode it in hex
             if type(record[column]) is tuple:
-                # A multi value data, we won't decode it, just leave it this way
+                # Multi values and long value readers, already decoded
                 record[column] = record[column][0]
             elif columnRecord['ColumnType'] == JET_coltypText or columnRecord['ColumnType'] == JET_coltypLongText: 
                 # Let's handle strings
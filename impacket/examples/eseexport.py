@@ -0,0 +1,200 @@
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Streaming export of ESE tables (NTDS.DIT, SRUM, WebCache, ...) as JSON lines or CSV.
+#   Rows are written as they are read, just the columns asked for are decoded, and the
+#   position in the table (leaf page and tag) is saved to a checkpoint file every now
+#   and then, so an interrupted export resumes where it was left.
+#
+import csv
+import json
+import os
+import time
+from binascii import hexlify
+
+from impacket import LOG
+from impacket.ese import ensureBytes, JET_coltypGUID
+
+FORMATS = ('json', 'csv')
+
+
+class ESETableExporter:
+    """
+    Exports a table of an ESE database
+
+    :param ESENT_DB db: The opened database.
+    :param str tableName: Table to export.
+    :param list columns: Names of the columns to export, all of them if None.
+    :param str outputFormat: One of FORMATS.
+    :param str checkpointFile: If set, file where the export state is kept, so it can be resumed.
+    :param int checkpointInterval: Number of rows between checkpoints.
+    """
+    def __init__(self, db, tableName, columns=None, outputFormat='json', checkpointFile=None,
+                 checkpointInterval=1000):
+        if outputFormat not in FORMATS:
+            raise Exception('Unknown format %s' % outputFormat)
+        self.__db = db
+        self.__tableName = tableName
+        if columns is None:
+            columns = db.getColumnNames(tableName)
+        self.__columns = [ensureBytes(column) for column in columns]
+        self.__columnNames = [column.decode('utf-8') for column in self.__columns]
+        # GUIDs are the only bytes values that aren't hex encoded by ESENT_DB
+        self.__rawColumns = [db.getColumnType(tableName, column) == JET_coltypGUID for column in self.__columns]
+        self.__format = outputFormat
+        self.__checkpointFile = checkpointFile
+        self.__checkpointInterval = max(1, checkpointInterval)
+        self.__stats = {}
+        self.resetStats()
+
+    def resetStats(self):
+        self.__stats = {'rows': 0, 'errors': 0, 'start_time': time.time()}
+
+    def getStats(self):
+        """
+        Returns a snapshot of the progress counters, plus the elapsed time and the rows/s rate.
+        """
+        stats = dict(self.__stats)
+        stats['elapsed'] = time.time() - stats.pop('start_time')
+        if stats['elapsed'] > 0:
+            stats['rows_per_second'] = stats['rows'] / stats['elapsed']
+        else:
+            stats['rows_per_second'] = 0
+        return stats
+
+    @staticmethod
+    def __convertValue(value, raw=False):
+        # Binary values come hex encoded as bytes, raw ones are encoded here
+        if isinstance(value, bytes):
+            if raw is True:
+                value = hexlify(value)
+            return value.decode('utf-8')
+        elif isinstance(value, list):
+            return [ESETableExporter.__convertValue(item, raw) for item in value]
+        return value
+
+    def __getState(self):
+        return {'table': self.__tableName, 'columns': self.__columnNames, 'format': self.__format}
+
+    def loadCheckpoint(self):
+        """
+        Returns the saved state of a previous export of the same table, columns and format, None if there's none.
+        """
+        if self.__checkpointFile is None or os.path.isfile(self.__checkpointFile) is False:
+            return None
+        with open(self.__checkpointFile, 'r') as fd:
+            checkpoint = json.load(fd)
+        for key, value in self.__getState().items():
+            if checkpoint.get(key) != value:
+                raise Exception('Checkpoint %s is for a different export (%s mismatch)' % (self.__checkpointFile, key))
+        return checkpoint
+
+    def __saveCheckpoint(self, cursor, fd, rows):
+        fd.flush()
+        checkpoint = self.__getState()
+        checkpoint.update({'page': cursor['CurrentPageNumber'], 'tag': cursor['CurrentTag'], 'rows': rows,
+                           'offset': fd.tell()})
+        # Written aside and renamed, so a crash never leaves a broken checkpoint behind
+        tmpFile = self.__checkpointFile + '.tmp'
+        with open(tmpFile, 'w') as checkpointFd:
+            json.dump(checkpoint, checkpointFd)
+        os.replace(tmpFile, self.__checkpointFile)
+
+    def export(self, fileName, progressInterval=None):
+        """
+        Exports the table to a file. If there's a checkpoint of a previous export, the output is truncated to
+        the last row saved and the export goes on from there. The checkpoint is removed once finished.
+
+        :param str fileName: Output file name.
+        :param int progressInterval: If set, progress counters are logged every progressInterval seconds.
+
+        :return: The final progress counters.
+        """
+        checkpoint = self.loadCheckpoint()
+        if checkpoint is not None:
+            LOG.info('Resuming export of %s at row %d' % (self.__tableName, checkpoint['rows']))
+            fd = open(fileName, 'r+', newline='')
+            fd.seek(checkpoint['offset'])
+            fd.truncate()
+            cursor = self.__db.openTable(self.__tableName, self.__columns, pageRange=(checkpoint['page'], 0))
+            cursor['CurrentTag'] = checkpoint['tag']
+            rows = checkpoint['rows']
+        else:
+            fd = open(fileName, 'w', newline='')
+            cursor = None
+            rows = 0
+
+        try:
+            self.exportRows(fd, cursor, rows, progressInterval)
+        finally:
+            fd.close()
+
+        if self.__checkpointFile is not None and os.path.isfile(self.__checkpointFile):
+            os.remove(self.__checkpointFile)
+        return self.getStats()
+
+    def exportRows(self, fd, cursor=None, rows=0, progressInterval=None):
+        """
+        Writes the rows of the table to a file object, from the cursor position if one is given, or from the
+        first row otherwise (writing the CSV header, if any).
+
+        :param file fd: Text file object where the rows are written.
+        :param dict cursor: Cursor opened with the exporter's columns, None to start from the beginning.
+        :param int rows: Number of rows already exported, for the checkpoints.
+        :param int progressInterval: If set, progress counters are logged every progressInterval seconds.
+        """
+        self.resetStats()
+        if cursor is None:
+            cursor = self.__db.openTable(self.__tableName, self.__columns)
+            if cursor is None:
+                raise Exception('Can\'t get a cursor for table: %s' % self.__tableName)
+            if self.__format == 'csv':
+                csv.writer(fd).writerow(self.__columnNames)
+
+        if self.__format == 'csv':
+            writer = csv.writer(fd)
+
+            def writeRow(values):
+                writer.writerow([json.dumps(value) if isinstance(value, list) else value for value in values])
+        else:
+            columnNames = self.__columnNames
+
+            def writeRow(values):
+                fd.write(json.dumps(dict(zip(columnNames, values))) + '\n')
+
+        lastProgress = time.time()
+        while True:
+            try:
+                row = self.__db.getNextRow(cursor)
+            except Exception:
+                LOG.debug('Exception:', exc_info=True)
+                LOG.error('Error while calling getNextRow(), trying the next one')
+                self.__stats['errors'] += 1
+                continue
+
+            if row is None:
+                break
+            try:
+                values = [self.__convertValue(value, raw) for value, raw in zip(row, self.__rawColumns)]
+            except Exception:
+                LOG.debug('Exception:', exc_info=True)
+                LOG.error('Error while converting row %d, skipping it' % rows)
+                self.__stats['errors'] += 1
+                continue
+            writeRow(values)
+            rows += 1
+            self.__stats['rows'] += 1
+
+            if self.__checkpointFile is not None and rows % self.__checkpointInterval == 0:
+                self.__saveCheckpoint(cursor, fd, rows)
+            if progressInterval is not None and time.time() - lastProgress >= progressInterval:
+                lastProgress = time.time()
+                LOG.info('Progress: %s' % json.dumps(self.getStats()))
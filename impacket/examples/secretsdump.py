@@ -61,6 +61,7 @@ import string
 import time
 from binascii import unhexlify, hexlify
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 from struct import unpack, pack
 from six import b, PY2
@@ -81,7 +82,7 @@ from impacket.dcerpc.v5.dcomrt import DCOMConnection, OBJREF, FLAGS_OBJREF_CUSTO
     IRemUnknown2, INTERFACE
 from impacket.ese import ESENT_DB, getUnixTime
 from impacket.dpapi import DPAPI_SYSTEM
-from impacket.smb3structs import FILE_READ_DATA, FILE_SHARE_READ
+from impacket.smbconnection import SMBFile
 from impacket.nt_errors import STATUS_MORE_ENTRIES
 from impacket.structure import Structure
 from impacket.structure import hexdump
@@ -365,20 +366,20 @@ def openFile(fileName, mode='w+', openFileFunc=None):
 
 
 # Classes
-class RemoteFile:
+class RemoteFile(SMBFile):
+    """
+    A file saved under ADMIN$ by RemoteOperations. It's read through the SMBFile block cache, so parsers
+    doing small random reads (ESENT_DB, winregistry) don't send a SMB read per call, and it's deleted when closed.
+    """
     def __init__(self, smbConnection, fileName):
-        self.__smbConnection = smbConnection
-        self.__fileName = fileName
-        self.__tid = self.__smbConnection.connectTree('ADMIN$')
-        self.__fid = None
-        self.__currentOffset = 0
+        SMBFile.__init__(self, smbConnection, 'ADMIN$', fileName)
+        self.__isOpen = False
 
     def open(self):
         tries = 0
         while True:
             try:
-                self.__fid = self.__smbConnection.openFile(self.__tid, self.__fileName, desiredAccess=FILE_READ_DATA,
-                                                   shareMode=FILE_SHARE_READ)
+                SMBFile.open(self)
             except Exception as e:
                 if str(e).find('STATUS_SHARING_VIOLATION') >=0:
                     if tries >= 3:
@@ -390,31 +391,14 @@ class RemoteFile:
                 else:
                     raise e
             else:
+                self.__isOpen = True
                 break
 
-    def seek(self, offset, whence):
-        # Implement whence, for now it's always from the beginning of the file
-        if whence == 0:
-            self.__currentOffset = offset
-
-    def read(self, bytesToRead):
-        if bytesToRead > 0:
-            data =  self.__smbConnection.readFile(self.__tid, self.__fid, self.__currentOffset, bytesToRead)
-            self.__currentOffset += len(data)
-            return data
-        return b''
-
     def close(self):
-        if self.__fid is not None:
-            self.__smbConnection.closeFile(self.__tid, self.__fid)
-            self.__smbConnection.deleteFile('ADMIN$', self.__fileName)
-            self.__fid = None
-
-    def tell(self):
-        return self.__currentOffset
-
-    def __str__(self):
-        return "\\\\%s\\ADMIN$\\%s" % (self.__smbConnection.getRemoteHost(), self.__fileName)
+        if self.__isOpen is True:
+            SMBFile.close(self)
+            self.getSMBConnection().deleteFile('ADMIN$', self.getPathName())
+            self.__isOpen = False
 
 class RemoteOperations:
     def __init__(self, smbConnection, doKerberos, kdcHost=None, ldapConnection=None):
@@ -2551,9 +2535,11 @@ class NTDSHashes:
                  useVSSMethod=False, remoteSSMethodWMINTDS=False, justNTLM=False, pwdLastSet=False, resumeSession=None, outputFileName=None,
                  justUser=None, skipUser=None,ldapFilter=None, printUserStatus=False,
                  perSecretCallback = lambda secretType, secret : _print_helper(secret),
-                 resumeSessionMgr=ResumeSessionMgrInFile):
+                 resumeSessionMgr=ResumeSessionMgrInFile, workers=1):
         self.__bootKey = bootKey
         self.__NTDS = ntdsFile
+        self.__isRemote = isRemote
+        self.__workers = workers
         self.__history = history
         self.__noLMHash = noLMHash
         self.__useVSSMethod = useVSSMethod
@@ -2563,7 +2549,6 @@ class NTDSHashes:
         self.__printUserStatus = printUserStatus
         if self.__NTDS is not None:
             self.__ESEDB = ESENT_DB(ntdsFile, isRemote = isRemote)
-            self.__cursor = self.__ESEDB.openTable('datatable')
         self.__tmpUsers = list()
         self.__PEK = list()
         self.__cryptoCommon = CryptoCommon()
@@ -2596,6 +2581,9 @@ class NTDSHashes:
             self.NAME_TO_INTERNAL['instanceType'] : 1,
 
         }
+        if self.__NTDS is not None:
+            # Just the columns above are decoded, out of the thousands datatable has
+            self.__cursor = self.__ESEDB.openTable('datatable', columns=list(self.__filter_tables_usersecret))
 
     def getResumeSessionFile(self):
         return self.__resumeSession.getFileName()
@@ -2605,7 +2593,7 @@ class NTDSHashes:
         peklist = None
         while True:
             try:
-                record = self.__ESEDB.getNextRow(self.__cursor, filter_tables=self.__filter_tables_usersecret)
+                record = self.__ESEDB.getNextRow(self.__cursor)
             except:
                 LOG.error('Error while calling getNextRow(), trying the next one')
                 continue
@@ -3051,6 +3039,96 @@ class NTDSHashes:
 
         LOG.debug('Leaving NTDSHashes.__decryptHash')
 
+    def __dumpCursor(self, cursor, hashesOutputFile=None, keysOutputFile=None, clearTextOutputFile=None):
+        while True:
+            try:
+                record = self.__ESEDB.getNextRow(cursor)
+            except:
+                LOG.error('Error while calling getNextRow(), trying the next one')
+                continue
+
+            if record is None:
+                break
+            try:
+                if record[self.NAME_TO_INTERNAL['sAMAccountType']] in self.ACCOUNT_TYPES and record[self.NAME_TO_INTERNAL['instanceType']] & 4:    # "The object is writable on this directory"
+                    self.__decryptHash(record, outputFile=hashesOutputFile)
+                    if self.__justNTLM is False:
+                        self.__decryptSupplementalInfo(record, None, keysOutputFile, clearTextOutputFile)
+            except Exception as e:
+                LOG.debug('Exception', exc_info=True)
+                try:
+                    LOG.error(
+                        "Error while processing row for user %s" % record[self.NAME_TO_INTERNAL['name']])
+                    LOG.error(str(e))
+                    pass
+                except:
+                    LOG.error("Error while processing row!")
+                    LOG.error(str(e))
+                    pass
+
+    def __dumpParallel(self, hashesOutputFile=None, keysOutputFile=None, clearTextOutputFile=None):
+        # We finish the leaf page we're at, the following ones are split into ranges processed by a pool of
+        # worker processes, each one opening its own ESENT_DB once. Results are merged in table order, so the
+        # output is the same as a sequential dump
+        firstPage = self.__cursor['CurrentPageData'].record['NextPageNumber']
+        self.__cursor['StopPageNumber'] = firstPage
+        self.__dumpCursor(self.__cursor, hashesOutputFile, keysOutputFile, clearTextOutputFile)
+        if firstPage == 0:
+            return
+
+        # More ranges than workers, so a slow range doesn't leave the others idle
+        pageRanges = self.__ESEDB.getLeafPageRanges('datatable', self.__workers * 4, firstPage)
+        options = {'history': self.__history, 'noLMHash': self.__noLMHash, 'justNTLM': self.__justNTLM,
+                   'pwdLastSet': self.__pwdLastSet, 'printUserStatus': self.__printUserStatus}
+        LOG.debug('Processing %d leaf page ranges with %d workers' % (len(pageRanges), self.__workers))
+
+        with ProcessPoolExecutor(max_workers=self.__workers, initializer=initNTDSWorker,
+                                 initargs=(self.__NTDS, options)) as executor:
+            futures = [executor.submit(dumpNTDSPageRange, self.__PEK, pageRange) for pageRange in pageRanges]
+            for pageRange, future in zip(pageRanges, futures):
+                try:
+                    hashes, kerberosKeys, clearTextPwds = future.result()
+                except Exception as e:
+                    LOG.debug('Exception', exc_info=True)
+                    LOG.error('Worker failed processing pages %d-%d (%s), processing them here' % (pageRange + (e,)))
+                    cursor = self.__ESEDB.openTable('datatable', columns=list(self.__filter_tables_usersecret),
+                                                    pageRange=pageRange)
+                    self.__dumpCursor(cursor, hashesOutputFile, keysOutputFile, clearTextOutputFile)
+                    continue
+
+                for answer in hashes:
+                    self.__perSecretCallback(NTDSHashes.SECRET_TYPE.NTDS, answer)
+                    if hashesOutputFile is not None:
+                        self.__writeOutput(hashesOutputFile, answer + '\n')
+                for answer in kerberosKeys:
+                    self.__kerberosKeys[answer] = None
+                    if keysOutputFile is not None:
+                        self.__writeOutput(keysOutputFile, answer + '\n')
+                for answer in clearTextPwds:
+                    self.__clearTextPwds[answer] = None
+                    if clearTextOutputFile is not None:
+                        self.__writeOutput(clearTextOutputFile, answer + '\n')
+
+    def dumpPageRange(self, pek, pageRange):
+        """
+        Decrypts the secrets found in a range of datatable leaf pages, using an already decrypted PEK list.
+        This is what the workers of a parallel dump run.
+
+        :param list pek: the PEK list, as found by dump().
+        :param tuple pageRange: the (firstPage, stopPage) leaf page range, see ESENT_DB.getLeafPageRanges().
+
+        :return: a (hashes, kerberosKeys, clearTextPwds) tuple with the lists of secrets found, in table order.
+        """
+        hashes = []
+        self.__PEK = pek
+        self.__perSecretCallback = lambda secretType, secret: hashes.append(secret)
+        self.__kerberosKeys = OrderedDict()
+        self.__clearTextPwds = OrderedDict()
+        cursor = self.__ESEDB.openTable('datatable', columns=list(self.__filter_tables_usersecret),
+                                        pageRange=pageRange)
+        self.__dumpCursor(cursor)
+        return hashes, list(self.__kerberosKeys.keys()), list(self.__clearTextPwds.keys())
+
     def dump(self):
         hashesOutputFile = None
         keysOutputFile = None
@@ -3132,31 +3210,10 @@ class NTDSHashes:
                                 pass
 
                     # Now let's keep moving through the NTDS file and decrypting what we find
-                    while True:
-                        try:
-                            record = self.__ESEDB.getNextRow(self.__cursor, filter_tables=self.__filter_tables_usersecret)
-                        except:
-                            LOG.error('Error while calling getNextRow(), trying the next one')
-                            continue
-
-                        if record is None:
-                            break
-                        try:
-                            if record[self.NAME_TO_INTERNAL['sAMAccountType']] in self.ACCOUNT_TYPES and record[self.NAME_TO_INTERNAL['instanceType']] & 4:    # "The object is writable on this directory"
-                                self.__decryptHash(record, outputFile=hashesOutputFile)
-                                if self.__justNTLM is False:
-                                    self.__decryptSupplementalInfo(record, None, keysOutputFile, clearTextOutputFile)
-                        except Exception as e:
-                            LOG.debug('Exception', exc_info=True)
-                            try:
-                                LOG.error(
-                                    "Error while processing row for user %s" % record[self.NAME_TO_INTERNAL['name']])
-                                LOG.error(str(e))
-                                pass
-                            except:
-                                LOG.error("Error while processing row!")
-                                LOG.error(str(e))
-                                pass
+                    if self.__workers > 1 and self.__isRemote is False:
+                        self.__dumpParallel(hashesOutputFile, keysOutputFile, clearTextOutputFile)
+                    else:
+                        self.__dumpCursor(self.__cursor, hashesOutputFile, keysOutputFile, clearTextOutputFile)
             else:
                 LOG.info('Using the DRSUAPI method to get NTDS.DIT secrets')
                 status = STATUS_MORE_ENTRIES
@@ -3380,6 +3437,18 @@ class NTDSHashes:
         if self.__NTDS is not None:
             self.__ESEDB.close()
 
+# NTDSHashes of the parallel dump worker processes, see initNTDSWorker()
+_ntdsWorker = None
+
+def initNTDSWorker(ntdsFile, options):
+    # Initializer of the parallel dump worker processes, the database is opened once per process
+    global _ntdsWorker
+    _ntdsWorker = NTDSHashes(ntdsFile, None, useVSSMethod=True, **options)
+
+def dumpNTDSPageRange(pek, pageRange):
+    # Entry point of the parallel dump workers, runs in a different process
+    return _ntdsWorker.dumpPageRange(pek, pageRange)
+
 class LocalOperations:
     def __init__(self, systemHive):
         self.__systemHive = systemHive
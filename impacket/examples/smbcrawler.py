@@ -0,0 +1,265 @@
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Crawls the shares of many SMB servers concurrently. Every target is handled by
+#   one of a bounded number of worker threads, each one with its own SMBConnection.
+#   Shares are enumerated with listShares() and walked with SMBConnection.walk(),
+#   so entries are streamed back to the caller as soon as they are received.
+#
+#   Results are dictionaries, that can be written as JSON lines with dump().
+#
+import fnmatch
+import json
+import ntpath
+import threading
+import time
+from queue import Queue
+
+from impacket import LOG
+from impacket.smbconnection import SMBConnection, SessionError
+
+# Shares not walked unless explicitly requested
+DEFAULT_EXCLUDED_SHARES = ('IPC$', 'PRINT$')
+
+# Share type (STYPE_*) mask for special shares (printers, devices, IPC)
+STYPE_MASK = 0x000000FF
+# Share type flag of the hidden administrative shares (C$, ADMIN$, ...)
+STYPE_SPECIAL = 0x80000000
+
+
+class SMBCrawler:
+    """
+    Multi-target SMB share crawler
+
+    :param str username: User to authenticate with.
+    :param str password: Password for the user.
+    :param str domain: Domain of the user.
+    :param str lmhash: LM hash, instead of the password.
+    :param str nthash: NT hash, instead of the password.
+    :param str aesKey: AES key for Kerberos authentication.
+    :param bool doKerberos: Use Kerberos authentication.
+    :param str kdcHost: KDC to use with Kerberos authentication.
+    :param int port: Destination port.
+    :param int timeout: Socket timeout for every connection.
+    :param int workers: Maximum number of targets crawled concurrently.
+    :param list shares: If set, only these shares are walked.
+    :param list excludeShares: Shares never walked.
+    :param list include: fnmatch patterns, only entries whose path matches one of them are reported.
+    :param list exclude: fnmatch patterns, entries whose path matches one of them are not reported.
+    :param int pipeline: Number of directories queried concurrently per connection (SMB2/3).
+    """
+    def __init__(self, username='', password='', domain='', lmhash='', nthash='', aesKey='', doKerberos=False,
+                 kdcHost=None, port=445, timeout=60, workers=10, shares=None,
+                 excludeShares=DEFAULT_EXCLUDED_SHARES, include=None, exclude=None, pipeline=1):
+        self.__username = username
+        self.__password = password
+        self.__domain = domain
+        self.__lmhash = lmhash
+        self.__nthash = nthash
+        self.__aesKey = aesKey
+        self.__doKerberos = doKerberos
+        self.__kdcHost = kdcHost
+        self.__port = port
+        self.__timeout = timeout
+        self.__workers = max(1, workers)
+        self.__shares = None if shares is None else [share.upper() for share in shares]
+        self.__excludeShares = [share.upper() for share in excludeShares]
+        self.__include = [pattern.lower() for pattern in include or []]
+        self.__exclude = [pattern.lower() for pattern in exclude or []]
+        self.__pipeline = pipeline
+
+        self.__lock = threading.Lock()
+        self.__stats = {}
+        self.resetStats()
+
+    def resetStats(self):
+        with self.__lock:
+            self.__stats = {'targets': 0, 'targets_done': 0, 'targets_failed': 0, 'shares': 0, 'directories': 0,
+                            'files': 0, 'bytes': 0, 'errors': 0, 'start_time': time.time()}
+
+    def getStats(self):
+        """
+        Returns a snapshot of the progress counters, plus the elapsed time and the entries/s rate.
+        """
+        with self.__lock:
+            stats = dict(self.__stats)
+        stats['elapsed'] = time.time() - stats.pop('start_time')
+        if stats['elapsed'] > 0:
+            stats['entries_per_second'] = (stats['files'] + stats['directories']) / stats['elapsed']
+        else:
+            stats['entries_per_second'] = 0
+        return stats
+
+    def __count(self, key, value=1):
+        with self.__lock:
+            self.__stats[key] += value
+
+    def isShareIncluded(self, shareName, shareType=0):
+        if self.__shares is not None:
+            return shareName.upper() in self.__shares
+        if shareName.upper() in self.__excludeShares:
+            return False
+        # Only disk shares are walked by default, administrative ones just when asked for
+        return shareType & STYPE_MASK == 0 and shareType & STYPE_SPECIAL == 0
+
+    def isPathIncluded(self, path):
+        path = path.replace('/', '\\').lower()
+        if len(self.__include) > 0:
+            if not any(fnmatch.fnmatchcase(path, pattern) for pattern in self.__include):
+                return False
+        return not any(fnmatch.fnmatchcase(path, pattern) for pattern in self.__exclude)
+
+    def getConnection(self, target):
+        smbClient = SMBConnection(target, target, sess_port=self.__port, timeout=self.__timeout)
+        try:
+            if self.__doKerberos is True:
+                smbClient.kerberosLogin(self.__username, self.__password, self.__domain, self.__lmhash,
+                                        self.__nthash, self.__aesKey, self.__kdcHost)
+            else:
+                smbClient.login(self.__username, self.__password, self.__domain, self.__lmhash, self.__nthash)
+        except Exception:
+            smbClient.close()
+            raise
+        return smbClient
+
+    def crawlTarget(self, target):
+        """
+        Walks every share of a single target, yielding one dictionary per entry found.
+        Errors are yielded as dictionaries with an 'error' key.
+        """
+        try:
+            smbClient = self.getConnection(target)
+        except Exception as e:
+            self.__count('errors')
+            yield {'host': target, 'error': str(e)}
+            raise
+
+        try:
+            try:
+                shares = smbClient.listShares()
+            except Exception as e:
+                self.__count('errors')
+                yield {'host': target, 'error': str(e)}
+                raise
+
+            for share in shares:
+                shareName = share['shi1_netname'][:-1]
+                if self.isShareIncluded(shareName, share['shi1_type']) is False:
+                    continue
+                self.__count('shares')
+                try:
+                    for directory, sharedFile in smbClient.walk(shareName, '', pipeline=self.__pipeline):
+                        path = ntpath.join(directory, sharedFile.get_longname())
+                        isDirectory = sharedFile.is_directory() > 0
+                        if isDirectory:
+                            self.__count('directories')
+                        else:
+                            self.__count('files')
+                            self.__count('bytes', sharedFile.get_filesize())
+                        if self.isPathIncluded(path) is False:
+                            continue
+                        yield {'host': target, 'share': shareName, 'path': path, 'directory': isDirectory,
+                               'size': sharedFile.get_filesize(), 'attributes': sharedFile.get_attributes(),
+                               'ctime': sharedFile.get_ctime_epoch(), 'mtime': sharedFile.get_mtime_epoch(),
+                               'atime': sharedFile.get_atime_epoch()}
+                except SessionError as e:
+                    self.__count('errors')
+                    yield {'host': target, 'share': shareName, 'error': str(e)}
+                except Exception as e:
+                    # Most likely the connection is gone, the remaining shares aren't tried
+                    self.__count('errors')
+                    yield {'host': target, 'share': shareName, 'error': str(e)}
+                    raise
+        finally:
+            smbClient.close()
+
+    def __worker(self, targets, results, stop):
+        while True:
+            target = targets.get()
+            if target is None:
+                break
+            if stop.is_set():
+                # The consumer is gone, the remaining targets are just skipped
+                continue
+            try:
+                for result in self.crawlTarget(target):
+                    if stop.is_set():
+                        break
+                    results.put(result)
+                else:
+                    self.__count('targets_done')
+            except Exception as e:
+                LOG.debug('Error crawling %s: %s' % (target, e))
+                self.__count('targets_failed')
+        results.put(None)
+
+    def crawl(self, targets):
+        """
+        Crawls all targets, using up to 'workers' concurrent connections.
+
+        :param iterable targets: Target names or addresses.
+
+        :return: Generator of result dictionaries, in the order they are received.
+        """
+        targetsQueue = Queue()
+        # Bounded, so slow consumers don't make us keep millions of entries in memory
+        results = Queue(maxsize=10000)
+
+        targets = list(targets)
+        self.__count('targets', len(targets))
+        for target in targets:
+            targetsQueue.put(target)
+
+        stop = threading.Event()
+        workers = []
+        for i in range(min(self.__workers, len(targets))):
+            targetsQueue.put(None)
+            worker = threading.Thread(target=self.__worker, args=(targetsQueue, results, stop),
+                                      name='SMBCrawler worker %d' % i)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        running = len(workers)
+        try:
+            while running > 0:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                yield result
+        finally:
+            # If the consumer stopped early, workers still blocked on a full results queue must be let go,
+            # they close their connections and say they're done
+            stop.set()
+            while running > 0:
+                if results.get() is None:
+                    running -= 1
+            for worker in workers:
+                worker.join()
+
+    def dump(self, targets, fd, progressInterval=None):
+        """
+        Crawls all targets writing every result as a JSON line to fd.
+
+        :param iterable targets: Target names or addresses.
+        :param file fd: File object where the JSON lines are written.
+        :param int progressInterval: If set, progress counters are logged every progressInterval seconds.
+
+        :return: The final progress counters.
+        """
+        lastProgress = time.time()
+        for result in self.crawl(targets):
+            fd.write(json.dumps(result) + '\n')
+            if progressInterval is not None and time.time() - lastProgress >= progressInterval:
+                lastProgress = time.time()
+                LOG.info('Progress: %s' % json.dumps(self.getStats()))
+        return self.getStats()
@@ -665,6 +665,8 @@ class NetBIOSSessionPacket:
         self.type = 0x0
         self.flags = 0x0
         self.length = 0x0
+        # Receive buffer backing the trailer, when the packet was built by NetBIOSTCPSession.recv_packet()
+        self._buffer = None
         if data == 0:
             self._trailer = b''
         else:
@@ -688,19 +690,27 @@ class NetBIOSSessionPacket:
 
     def rawData(self):
         if self.type == NETBIOS_SESSION_MESSAGE:
-            data = pack('!BBH', self.type, self.length >> 16, self.length & 0xFFFF) + self._trailer
+            data = pack('!BBH', self.type, self.length >> 16, self.length & 0xFFFF) + self.get_trailer()
         else:
-            data = pack('!BBH', self.type, self.flags, self.length) + self._trailer
+            data = pack('!BBH', self.type, self.flags, self.length) + self.get_trailer()
         return data
 
     def set_trailer(self, data):
         self._trailer = data
+        self._buffer = None
         self.length = len(data)
 
+    def set_trailer_buffer(self, buffer):
+        # Sets the trailer from a receive buffer. It's converted to bytes only if get_trailer() is called
+        self._trailer = None
+        self._buffer = buffer
+
     def get_length(self):
         return self.length
 
     def get_trailer(self):
+        if self._trailer is None:
+            self._trailer = bytes(self._buffer)
         return self._trailer
         
 class NetBIOSSession:
@@ -891,8 +901,12 @@ class NetBIOSTCPSession(NetBIOSSession):
         self.__select_poll = select_poll
         if self.__select_poll:
             self.read_function = self.polling_read
+            self.read_into_function = self.polling_read_into
         else:
             self.read_function = self.non_polling_read
+            self.read_into_function = self.non_polling_read_into
+        # Preallocated buffer for the 4 bytes session packet headers
+        self.__header = bytearray(4)
         NetBIOSSession.__init__(self, myname, remote_name, remote_host, remote_type=remote_type, sess_port=sess_port,
                                 timeout=timeout, local_type=local_type, sock=sock)
 
@@ -915,12 +929,11 @@ class NetBIOSTCPSession(NetBIOSSession):
         self._sock.sendall(p.rawData())
 
     def recv_packet(self, timeout = None):
-        data = self.__read(timeout)
-        NBSPacket = NetBIOSSessionPacket(data)
-        if NBSPacket.get_type() == NETBIOS_SESSION_KEEP_ALIVE:
+        while True:
+            NBSPacket = self.__read(timeout)
+            if NBSPacket.get_type() != NETBIOS_SESSION_KEEP_ALIVE:
+                return NBSPacket
             # Discard packet
-            return self.recv_packet(timeout)
-        return NetBIOSSessionPacket(data)
 
     def _request_session(self, remote_type, local_type, timeout = None):
         p = NetBIOSSessionPacket()
@@ -941,74 +954,103 @@ class NetBIOSTCPSession(NetBIOSSession):
                 pass
 
     def polling_read(self, read_length, timeout):
-        data = b''
+        data = bytearray(read_length)
+        self.polling_read_into(memoryview(data), timeout)
+        return bytes(data)
+
+    def non_polling_read(self, read_length, timeout):
+        data = bytearray(read_length)
+        self.non_polling_read_into(memoryview(data), timeout)
+        return bytes(data)
+
+    def polling_read_into(self, buffer, timeout):
+        """
+        Fills buffer (a writable memoryview) with data from the socket, waiting in select()
+        at most timeout seconds overall.
+        """
         if timeout is None:
             timeout = 3600
 
-        time_left = timeout
-        CHUNK_TIME = 0.025
-        bytes_left = read_length
+        deadline = time.time() + timeout
+        read_length = len(buffer)
+        bytes_read = 0
 
-        while bytes_left > 0:
+        while bytes_read < read_length:
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                raise NetBIOSTimeout
             try:
-                ready, _, _ = select.select([self._sock.fileno()], [], [], 0)
-
-                if not ready:
-                    if time_left <= 0:
-                        raise NetBIOSTimeout
-                    else:
-                        time.sleep(CHUNK_TIME)
-                        time_left -= CHUNK_TIME
-                        continue
-
-                received = self._sock.recv(bytes_left)
-                if len(received) == 0:
-                    raise NetBIOSError('Error while reading from remote', ERRCLASS_OS, None)
-
-                data = data + received
-                bytes_left = read_length - len(data)
+                ready, _, _ = select.select([self._sock.fileno()], [], [], time_left)
             except select.error as ex:
                 if ex.errno != errno.EINTR and ex.errno != errno.EAGAIN:
                     raise NetBIOSError('Error occurs while reading from remote', ERRCLASS_OS, ex.errno)
+                continue
 
-        return bytes(data)
+            if not ready:
+                raise NetBIOSTimeout
 
-    def non_polling_read(self, read_length, timeout):
-        data = b''
+            try:
+                received = self._sock.recv_into(buffer[bytes_read:])
+            except socket.error as ex:
+                if ex.errno == errno.EINTR or ex.errno == errno.EAGAIN:
+                    continue
+                raise NetBIOSError('Error occurs while reading from remote', ERRCLASS_OS, ex.errno)
+
+            if received == 0:
+                raise NetBIOSError('Error while reading from remote', ERRCLASS_OS, None)
+
+            bytes_read += received
+
+        return bytes_read
+
+    def non_polling_read_into(self, buffer, timeout):
+        """
+        Fills buffer (a writable memoryview) with data from the socket, using blocking
+        reads that take at most timeout seconds overall.
+        """
         if timeout is None:
             timeout = 3600
 
-        start_time = time.time()
-        bytes_left = read_length
+        deadline = time.time() + timeout
+        read_length = len(buffer)
+        bytes_read = 0
 
-        while bytes_left > 0:
-            self._sock.settimeout(timeout)
+        while bytes_read < read_length:
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                raise NetBIOSTimeout
+            self._sock.settimeout(time_left)
             try:
-                received = self._sock.recv(bytes_left)
+                received = self._sock.recv_into(buffer[bytes_read:])
             except socket.timeout:
                 raise NetBIOSTimeout
             except Exception as ex:
                 raise NetBIOSError('Error occurs while reading from remote', ERRCLASS_OS, ex.errno)
 
-            if (time.time() - start_time) > timeout:
-                raise NetBIOSTimeout
-
-            if len(received) == 0:
+            if received == 0:
                 raise NetBIOSError('Error while reading from remote', ERRCLASS_OS, None)
 
-            data = data + received
-            bytes_left = read_length - len(data)
+            bytes_read += received
 
-        return bytes(data)
+        return bytes_read
 
     def __read(self, timeout = None):
-        data = self.read_function(4, timeout)
-        type, flags, length = unpack('>ccH', data)
-        if ord(type) == NETBIOS_SESSION_MESSAGE:
-            length |= ord(flags) << 16
+        self.read_into_function(memoryview(self.__header), timeout)
+        type, flags, length = unpack('>BBH', self.__header)
+        if type == NETBIOS_SESSION_MESSAGE:
+            length |= flags << 16
         else:
-            if ord(flags) & 0x01:
+            if flags & 0x01:
                 length |= 0x10000
-        data2 = self.read_function(length, timeout)
 
-        return data + data2
+        body = bytearray(length)
+        if length > 0:
+            self.read_into_function(memoryview(body), timeout)
+
+        NBSPacket = NetBIOSSessionPacket()
+        NBSPacket.type = type
+        NBSPacket.length = length
+        if type != NETBIOS_SESSION_MESSAGE:
+            NBSPacket.flags = flags
+        NBSPacket.set_trailer_buffer(body)
+        return NBSPacket
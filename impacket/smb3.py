@@ -451,16 +451,21 @@ class SMB3:
         # Connection.SupportsPersistentHandles is TRUE, the client MUST set ChannelSequence in the
         # SMB2 header to Session.ChannelSequence
 
+        # Default the credit charge to 1 unless set by the caller
+        if ('CreditCharge' in packet.fields) is False:
+            packet['CreditCharge'] = 1
+
         # Check this is not a CANCEL request. If so, don't consume sequence numbers
         if packet['Command'] is not SMB2_CANCEL:
             packet['MessageID'] = self._Connection['SequenceWindow']
             self._Connection['SequenceWindow'] += 1
+            # A multi-credit request consumes CreditCharge consecutive MessageIDs. Account for them
+            # now, so requests sent before this one is answered (pipelining) get a valid MessageID.
+            # In the SMB 2.0.2 dialect, this field MUST NOT be used and MUST be reserved.
+            if self._Connection['Dialect'] > SMB2_DIALECT_002 and packet['CreditCharge'] > 1:
+                self._Connection['SequenceWindow'] += (packet['CreditCharge'] - 1)
         packet['SessionID'] = self._Session['SessionID']
 
-        # Default the credit charge to 1 unless set by the caller
-        if ('CreditCharge' in packet.fields) is False:
-            packet['CreditCharge'] = 1
-
         # Standard credit request after negotiating protocol
         if self._Connection['SequenceWindow'] > 3:
             packet['CreditRequestResponse'] = 127
@@ -546,12 +551,6 @@ class SMB3:
                 status = packet['Status']
 
         if packet['MessageID'] == packetID or packetID is None:
-            # Let's update the sequenceWindow based on the CreditsCharged
-            # In the SMB 2.0.2 dialect, this field MUST NOT be used and MUST be reserved.
-            # The sender MUST set this to 0, and the receiver MUST ignore it.
-            # In all other dialects, this field indicates the number of credits that this request consumes.
-            if self._Connection['Dialect'] > SMB2_DIALECT_002:
-                self._Connection['SequenceWindow'] += (packet['CreditCharge'] - 1)
             return packet
         else:
             self._Connection['OutstandingResponses'][packet['MessageID']] = packet
@@ -1452,7 +1451,7 @@ class SMB3:
                 bytesWritten += self.write(treeId, fileId, data[bytesWritten:], offset+bytesWritten, bytesToWrite-bytesWritten, waitAnswer)
             return bytesWritten
 
-    def queryDirectory(self, treeId, fileId, searchString = '*', resumeIndex = 0, informationClass = FILENAMES_INFORMATION, maxBufferSize = None, enumRestart = False, singleEntry = False):
+    def queryDirectory(self, treeId, fileId, searchString = '*', resumeIndex = 0, informationClass = FILENAMES_INFORMATION, maxBufferSize = None, enumRestart = False, singleEntry = False, waitAnswer = True):
         if (treeId in self._Session['TreeConnectTable']) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
         if (fileId in self._Session['OpenTable']) is False:
@@ -1481,11 +1480,27 @@ class SMB3:
             packet['CreditCharge'] = ( 1 + (maxBufferSize - 1) // 65536)
 
         packetID = self.sendSMB(packet)
+
+        if waitAnswer is False:
+            return packetID
+
+        return self.queryDirectoryRecv(packetID)
+
+    def queryDirectoryRecv(self, packetID):
+        # Retrieves the answer of a queryDirectory() request sent with waitAnswer = False
         ans = self.recvSMB(packetID)
         if ans.isValidAnswer(STATUS_SUCCESS):
             queryDirectoryResponse = SMB2QueryDirectory_Response(ans['Data'])
             return queryDirectoryResponse['Buffer']
 
+    def getMaxQueryDirectorySize(self):
+        # Largest OutputBufferLength we can ask for in a single SMB2_QUERY_DIRECTORY request.
+        # It MUST NOT exceed MaxTransactSize, and without multi-credit support a request can't go past 64k
+        maxBufferSize = self._Connection['MaxTransactSize']
+        if self._Connection['Dialect'] == SMB2_DIALECT_002 or self._Connection['SupportsMultiCredit'] is False:
+            maxBufferSize = min(65536, maxBufferSize)
+        return maxBufferSize
+
     def echo(self):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_ECHO
@@ -1775,6 +1790,11 @@ class SMB3:
         return path, ctx
 
     def listPath(self, shareName, path, password = None):
+        return list(self.iterPath(shareName, path, password))
+
+    def iterPath(self, shareName, path, password = None, maxBufferSize = None):
+        # Same as listPath, but yields every SharedFile as soon as its SMB2_QUERY_DIRECTORY response
+        # is parsed, instead of accumulating the whole directory in memory
         createContexts = None
 
         if self.isSnapshotRequest(path):
@@ -1788,43 +1808,133 @@ class SMB3:
         if len(path) > 0 and path[0] == '\\':
             path = path[1:]
 
+        if maxBufferSize is None:
+            maxBufferSize = self.getMaxQueryDirectorySize()
+
         treeId = self.connectTree(shareName)
 
         fileId = None
         try:
             # ToDo, we're assuming it's a directory, we should check what the file type is
-            fileId = self.create(treeId, ntpath.dirname(path), FILE_READ_ATTRIBUTES | FILE_READ_DATA, FILE_SHARE_READ |
-                                 FILE_SHARE_WRITE | FILE_SHARE_DELETE,
-                                 FILE_DIRECTORY_FILE | FILE_SYNCHRONOUS_IO_NONALERT, FILE_OPEN, 0,
-                                 createContexts=createContexts)
-            res = ''
-            files = []
-            from impacket import smb
+            fileId = self.__openDirectory(treeId, ntpath.dirname(path), createContexts)
             while True:
                 try:
-                    res = self.queryDirectory(treeId, fileId, ntpath.basename(path), maxBufferSize=65535,
+                    res = self.queryDirectory(treeId, fileId, ntpath.basename(path), maxBufferSize=maxBufferSize,
                                               informationClass=FILE_FULL_DIRECTORY_INFORMATION)
-                    nextOffset = 1
-                    while nextOffset != 0:
-                        fileInfo = smb.SMBFindFileFullDirectoryInfo(smb.SMB.FLAGS2_UNICODE)
-                        fileInfo.fromString(res)
-                        files.append(smb.SharedFile(fileInfo['CreationTime'], fileInfo['LastAccessTime'],
-                                                    fileInfo['LastWriteTime'], fileInfo['LastChangeTime'], fileInfo['EndOfFile'],
-                                                    fileInfo['AllocationSize'], fileInfo['ExtFileAttributes'],
-                                                    fileInfo['FileName'].decode('utf-16le'),
-                                                    fileInfo['FileName'].decode('utf-16le')))
-                        nextOffset = fileInfo['NextEntryOffset']
-                        res = res[nextOffset:]
                 except SessionError as e:
                     if (e.get_error_code()) != STATUS_NO_MORE_FILES:
                         raise
                     break
+                for sharedFile in self.__parseDirectoryEntries(res):
+                    yield sharedFile
         finally:
             if fileId is not None:
                 self.close(treeId, fileId)
             self.disconnectTree(treeId)
 
-        return files
+    def walk(self, shareName, path = '', maxBufferSize = None, pipeline = 1):
+        # Recursively enumerates shareName/path, yielding (directory, SharedFile) tuples for every entry found.
+        # The tree is walked without recursion, so only the directories still pending are kept in memory.
+        # If pipeline > 1, up to that many directories are queried concurrently, sending their
+        # SMB2_QUERY_DIRECTORY requests before waiting for the answers.
+        # Share passwords are SMB1 only, there's no password to pass here
+        path = path.replace('/', '\\')
+        path = ntpath.normpath(path)
+        if path == '.' or path == '\\':
+            path = ''
+        if len(path) > 0 and path[0] == '\\':
+            path = path[1:]
+
+        if maxBufferSize is None:
+            maxBufferSize = self.getMaxQueryDirectorySize()
+        pipeline = max(1, pipeline)
+
+        treeId = self.connectTree(shareName)
+
+        pending = [path]
+        # Directories currently opened, as [directory, fileId, packetID] items
+        active = []
+        try:
+            while len(pending) > 0 or len(active) > 0:
+                while len(pending) > 0 and len(active) < pipeline:
+                    directory = pending.pop()
+                    try:
+                        fileId = self.__openDirectory(treeId, directory)
+                    except SessionError:
+                        # Subdirectories we can't open (e.g. access denied) are skipped, the root is not
+                        if directory == path:
+                            raise
+                        continue
+                    active.append([directory, fileId, None])
+                    active[-1][2] = self.queryDirectory(treeId, fileId, '*', maxBufferSize=maxBufferSize,
+                                                        informationClass=FILE_FULL_DIRECTORY_INFORMATION,
+                                                        waitAnswer=False)
+
+                directory, fileId, packetID = active[0]
+                try:
+                    res = self.queryDirectoryRecv(packetID)
+                except SessionError as e:
+                    # Already answered, there's nothing to drain
+                    active[0][2] = None
+                    if e.get_error_code() != STATUS_NO_MORE_FILES:
+                        # Like the ones we can't open, subdirectories we can't list are skipped, the root is not
+                        if directory == path:
+                            raise
+                    active.pop(0)
+                    self.close(treeId, fileId)
+                    continue
+
+                # Keep the next request for this directory in flight while we process this answer
+                active.append(active.pop(0))
+                active[-1][2] = self.queryDirectory(treeId, fileId, '*', maxBufferSize=maxBufferSize,
+                                                    informationClass=FILE_FULL_DIRECTORY_INFORMATION,
+                                                    waitAnswer=False)
+
+                for sharedFile in self.__parseDirectoryEntries(res):
+                    fileName = sharedFile.get_longname()
+                    if fileName == '.' or fileName == '..':
+                        continue
+                    if sharedFile.is_directory() > 0:
+                        pending.append(ntpath.join(directory, fileName))
+                    yield directory, sharedFile
+        finally:
+            for directory, fileId, packetID in active:
+                try:
+                    # Drain any answer still in flight before closing the handle
+                    if packetID is not None:
+                        self.queryDirectoryRecv(packetID)
+                except SessionError:
+                    pass
+                finally:
+                    self.close(treeId, fileId)
+            self.disconnectTree(treeId)
+
+    def __openDirectory(self, treeId, path, createContexts = None):
+        return self.create(treeId, path, FILE_READ_ATTRIBUTES | FILE_READ_DATA, FILE_SHARE_READ |
+                           FILE_SHARE_WRITE | FILE_SHARE_DELETE,
+                           FILE_DIRECTORY_FILE | FILE_SYNCHRONOUS_IO_NONALERT, FILE_OPEN, 0,
+                           createContexts=createContexts)
+
+    def __parseDirectoryEntries(self, buffer):
+        # Parses a FILE_FULL_DIRECTORY_INFORMATION buffer entry by entry. Every entry is sliced up to
+        # NextEntryOffset, so the whole buffer is not copied again per entry
+        from impacket import smb
+        offset = 0
+        while offset < len(buffer):
+            nextOffset = struct.unpack('<L', buffer[offset:offset+4])[0]
+            if nextOffset == 0:
+                entry = buffer[offset:]
+            else:
+                entry = buffer[offset:offset+nextOffset]
+            fileInfo = smb.SMBFindFileFullDirectoryInfo(smb.SMB.FLAGS2_UNICODE)
+            fileInfo.fromString(entry)
+            fileName = fileInfo['FileName'].decode('utf-16le')
+            yield smb.SharedFile(fileInfo['CreationTime'], fileInfo['LastAccessTime'], fileInfo['LastWriteTime'],
+                                 fileInfo['LastChangeTime'], fileInfo['EndOfFile'], fileInfo['AllocationSize'],
+                                 fileInfo['ExtFileAttributes'], fileName, fileName)
+            if nextOffset == 0:
+                break
+            offset += nextOffset
 
     def mkdir(self, shareName, pathName, password = None):
         # ToDo: Handle situations where share is password protected
@@ -2004,6 +2114,7 @@ class SMB3:
     stor_file                  = storeFile
     retr_file                  = retrieveFile
     list_path                  = listPath
+    iter_path                  = iterPath
 
     def close_session(self):
         if self._NetBIOSSession:
@@ -16,8 +16,13 @@
 # Author: Alberto Solino (@agsolino)
 #
 
+import hashlib
 import ntpath
 import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from impacket import smb, smb3, smb3structs, nmb, nt_errors, LOG
 from impacket.ntlm import compute_lmhash, compute_nthash
@@ -419,6 +424,72 @@ class SMBConnection:
         except (smb.SessionError, smb3.SessionError) as e:
             raise SessionError(e.get_error_code(), e.get_error_packet())
 
+    def iterPath(self, shareName, path, password = None):
+        """
+        Iterates over the files/directories under shareName/path. Unlike listPath, on SMB2/3 every entry
+        is returned as soon as its query directory response is received, using the largest buffer allowed
+        by the server, so big directories are not kept in memory.
+
+        :param str shareName: A valid name for the share where the files/directories are going to be searched.
+        :param str path: A base path relative to shareName.
+        :param optional str password: The password for the share.
+
+        :return: Generator of smb.SharedFile items.
+        :raise SessionError: If encountered an error.
+        """
+
+        try:
+            if self.getDialect() == smb.SMB_DIALECT:
+                for sharedFile in self._SMBConnection.list_path(shareName, path, password):
+                    yield sharedFile
+            else:
+                for sharedFile in self._SMBConnection.iter_path(shareName, path, password):
+                    yield sharedFile
+        except (smb.SessionError, smb3.SessionError) as e:
+            raise SessionError(e.get_error_code(), e.get_error_packet())
+
+    def walk(self, shareName, path = '', password = None, pipeline = 1):
+        """
+        Recursively iterates over the files/directories under shareName/path. Subdirectories that can't be
+        opened are skipped.
+
+        :param str shareName: A valid name for the share where the files/directories are going to be searched.
+        :param optional str path: A base directory relative to shareName.
+        :param optional str password: The password for the share.
+        :param optional int pipeline: Number of directories queried concurrently (SMB2/3 only).
+
+        :return: Generator of (directory, smb.SharedFile) tuples, directory being relative to shareName.
+        :raise SessionError: If encountered an error.
+        """
+
+        if self.getDialect() != smb.SMB_DIALECT:
+            try:
+                for entry in self._SMBConnection.walk(shareName, path, pipeline=pipeline):
+                    yield entry
+            except (smb.SessionError, smb3.SessionError) as e:
+                raise SessionError(e.get_error_code(), e.get_error_packet())
+            return
+
+        path = ntpath.normpath(path.replace('/', '\\')).strip('\\')
+        if path == '.':
+            path = ''
+        pending = [path]
+        while len(pending) > 0:
+            directory = pending.pop()
+            try:
+                files = self.listPath(shareName, ntpath.join(directory, '*'), password)
+            except SessionError:
+                if directory == path:
+                    raise
+                continue
+            for sharedFile in files:
+                fileName = sharedFile.get_longname()
+                if fileName == '.' or fileName == '..':
+                    continue
+                if sharedFile.is_directory() > 0:
+                    pending.append(ntpath.join(directory, fileName))
+                yield directory, sharedFile
+
     def createFile(self, treeId, pathName, desiredAccess=GENERIC_ALL,
                    shareMode=FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
                    creationOption=FILE_NON_DIRECTORY_FILE, creationDisposition=FILE_OVERWRITE_IF,
@@ -993,14 +1064,28 @@ class SMBConnection:
         :raise SessionError: If encountered an error.
         """
         userName, password, domain, lmhash, nthash, aesKey, TGT, TGS = self.getCredentials()
+        doKerberos = self._doKerberos or self._SMBConnection.getKerberos()
         self.negotiateSession(self._preferredDialect)
-        if self._doKerberos is True:
+        if doKerberos is True:
             self.kerberosLogin(userName, password, domain, lmhash, nthash, aesKey, self._kdcHost, TGT, TGS, self._useCache)
         else:
             self.login(userName, password, domain, lmhash, nthash, self._ntlmFallback)
 
         return True
 
+    def echo(self):
+        """
+        Sends an echo request (SMB_COM_ECHO / SMB2_ECHO) to the server, useful to check
+        the connection is still alive or to keep it from being closed due to inactivity.
+
+        :return: True
+        :raise SessionError: If encountered an error.
+        """
+        try:
+            return self._SMBConnection.echo()
+        except (smb.SessionError, smb3.SessionError) as e:
+            raise SessionError(e.get_error_code(), e.get_error_packet())
+
     def setTimeout(self, timeout):
         try:
             return self._SMBConnection.set_timeout(timeout)
@@ -1042,6 +1127,437 @@ class SMBConnection:
         return self.getFile(shareName ,pathName ,callback ,shareAccessMode = FILE_SHARE_READ|FILE_SHARE_WRITE|FILE_SHARE_DELETE,
                                mode = mode, offset=offset, password = password )
 
+class SMBSessionManager:
+    """
+    SMBSessionManager class
+
+    Keeps authenticated SMBConnection objects cached per (host, port, identity, credentials), so callers running many short
+    tasks against the same hosts pay the negotiate and session setup only once. Sessions are checked out with
+    session(), which gives exclusive use of the connection for the duration of the with block:
+
+        manager = SMBSessionManager(keepAliveInterval=60)
+        with manager.session('host', username='user', password='pass') as smbClient:
+            treeId = manager.connectTree(smbClient, 'C$')
+
+    Sessions idle for more than keepAliveInterval seconds are checked with an echo request before being used,
+    and transparently re-established (SMBConnection.reconnect()) if they're gone. keepAlive() does the same for
+    every idle session, and can be run periodically by a background thread with start().
+    When using Kerberos with credentials, the TGT is requested once per identity and reused for every host.
+    Sessions and TGTs are only handed out to callers giving the very same credentials they were obtained with.
+
+    :param optional int keepAliveInterval: Seconds a session can be idle before being checked.
+    :param optional int maxIdleTime: Seconds after which an idle session is closed by keepAlive(). None to keep them.
+    """
+    def __init__(self, keepAliveInterval=60, maxIdleTime=None):
+        self.__keepAliveInterval = keepAliveInterval
+        self.__maxIdleTime = maxIdleTime
+        self.__lock = threading.Lock()
+        self.__sessions = {}
+        self.__connections = {}
+        self.__tickets = {}
+        self.__thread = None
+        self.__stopEvent = threading.Event()
+
+    @staticmethod
+    def __getCredentialsHash(password, lmhash, nthash, aesKey):
+        # Fingerprint of the secrets, so cached sessions and tickets can't be obtained with other credentials
+        digest = hashlib.sha256()
+        for secret in (password, lmhash, nthash, aesKey):
+            if secret is None:
+                secret = b''
+            elif not isinstance(secret, bytes):
+                secret = secret.encode('utf-8')
+            digest.update(len(secret).to_bytes(4, 'little') + secret)
+        return digest.hexdigest()
+
+    def __getTicketKey(self, username, password, domain, lmhash, nthash, aesKey):
+        return domain.upper(), username.lower(), self.__getCredentialsHash(password, lmhash, nthash, aesKey)
+
+    def __getTGT(self, username, password, domain, lmhash, nthash, aesKey, kdcHost):
+        key = self.__getTicketKey(username, password, domain, lmhash, nthash, aesKey)
+        with self.__lock:
+            if key in self.__tickets:
+                return self.__tickets[key]
+
+        from impacket.krb5.kerberosv5 import getKerberosTGT
+        from impacket.krb5.types import Principal
+        from impacket.krb5 import constants
+
+        userName = Principal(username, type=constants.PrincipalNameType.NT_PRINCIPAL.value)
+        tgt, cipher, oldSessionKey, sessionKey = getKerberosTGT(userName, password, domain, lmhash, nthash, aesKey,
+                                                                kdcHost)
+        TGT = {'KDC_REP': tgt, 'cipher': cipher, 'sessionKey': sessionKey}
+        with self.__lock:
+            self.__tickets[key] = TGT
+        return TGT
+
+    def __connect(self, remoteName, remoteHost, sess_port, timeout, preferredDialect, username, password, domain,
+                  lmhash, nthash, aesKey, doKerberos, kdcHost, retry=True):
+        smbClient = SMBConnection(remoteName, remoteHost, sess_port=sess_port, timeout=timeout,
+                                  preferredDialect=preferredDialect)
+        try:
+            if doKerberos is False:
+                smbClient.login(username, password, domain, lmhash, nthash)
+            elif password == '' and lmhash == '' and nthash == '' and (aesKey == '' or aesKey is None):
+                # Nothing to request a TGT with, let's rely on the ccache
+                smbClient.kerberosLogin(username, password, domain, lmhash, nthash, aesKey, kdcHost)
+            else:
+                TGT = self.__getTGT(username, password, domain, lmhash, nthash, aesKey, kdcHost)
+                smbClient.kerberosLogin(username, password, domain, lmhash, nthash, aesKey, kdcHost, TGT=TGT)
+        except Exception:
+            smbClient.close()
+            if doKerberos is False or retry is False:
+                raise
+            # The cached TGT might have expired, try once again with a new one
+            with self.__lock:
+                if self.__tickets.pop(self.__getTicketKey(username, password, domain, lmhash, nthash, aesKey),
+                                      None) is None:
+                    raise
+            return self.__connect(remoteName, remoteHost, sess_port, timeout, preferredDialect, username, password,
+                                  domain, lmhash, nthash, aesKey, doKerberos, kdcHost, False)
+        return smbClient
+
+    def __getEntry(self, remoteName, remoteHost, sess_port, username, password, domain, lmhash, nthash, aesKey,
+                   doKerberos):
+        key = (remoteHost.lower(), sess_port, domain.upper(), username.lower(), doKerberos,
+               self.__getCredentialsHash(password, lmhash, nthash, aesKey))
+        with self.__lock:
+            if key not in self.__sessions:
+                self.__sessions[key] = {'Key': key, 'Lock': threading.Lock(), 'Connection': None,
+                                        'LastUsed': 0, 'Trees': {}}
+            return self.__sessions[key]
+
+    def __closeEntry(self, entry):
+        smbClient = entry['Connection']
+        entry['Connection'] = None
+        entry['Trees'] = {}
+        if smbClient is not None:
+            with self.__lock:
+                self.__connections.pop(id(smbClient), None)
+            try:
+                smbClient.close()
+            except Exception:
+                pass
+
+    def __checkEntry(self, entry):
+        # Makes sure the cached connection is still usable, re-establishing it if not
+        if time.time() - entry['LastUsed'] < self.__keepAliveInterval:
+            return
+        try:
+            entry['Connection'].echo()
+        except Exception as e:
+            LOG.debug('Session %s expired (%s), reconnecting' % (str(entry['Key']), str(e)))
+            entry['Trees'] = {}
+            entry['Connection'].reconnect()
+        entry['LastUsed'] = time.time()
+
+    def getSession(self, remoteName, remoteHost=None, username='', password='', domain='', lmhash='', nthash='',
+                   aesKey='', doKerberos=False, kdcHost=None, sess_port=nmb.SMB_SESSION_PORT, timeout=60,
+                   preferredDialect=None):
+        """
+        Returns an authenticated SMBConnection for the given host and identity, creating it if needed, and
+        locks it for the caller. Every getSession() call must be paired with a releaseSession() one.
+        session() does both.
+
+        :return: An SMBConnection instance.
+        :raise SessionError: If encountered an error.
+        """
+        if remoteHost is None:
+            remoteHost = remoteName
+        entry = self.__getEntry(remoteName, remoteHost, sess_port, username, password, domain, lmhash, nthash, aesKey,
+                                doKerberos)
+        entry['Lock'].acquire()
+        try:
+            if entry['Connection'] is not None:
+                self.__checkEntry(entry)
+            else:
+                smbClient = self.__connect(remoteName, remoteHost, sess_port, timeout, preferredDialect, username,
+                                           password, domain, lmhash, nthash, aesKey, doKerberos, kdcHost)
+                entry['Connection'] = smbClient
+                entry['Trees'] = {}
+                with self.__lock:
+                    self.__connections[id(smbClient)] = entry
+        except Exception:
+            self.__closeEntry(entry)
+            entry['Lock'].release()
+            raise
+
+        return entry['Connection']
+
+    def releaseSession(self, smbClient, discard=False):
+        """
+        Gives back a connection obtained with getSession().
+
+        :param SMBConnection smbClient: The connection.
+        :param optional bool discard: If True the connection is closed and removed from the cache.
+        """
+        with self.__lock:
+            entry = self.__connections.get(id(smbClient))
+        if entry is None:
+            return
+        if discard is True:
+            self.__closeEntry(entry)
+        else:
+            entry['LastUsed'] = time.time()
+        entry['Lock'].release()
+
+    @contextmanager
+    def session(self, remoteName, **kwargs):
+        """
+        Context manager around getSession()/releaseSession(). The connection is discarded if a
+        connection level error (socket or NetBIOS) escapes the with block.
+        """
+        smbClient = self.getSession(remoteName, **kwargs)
+        discard = False
+        try:
+            yield smbClient
+        except (socket.error, nmb.NetBIOSError, nmb.NetBIOSTimeout):
+            discard = True
+            raise
+        finally:
+            self.releaseSession(smbClient, discard)
+
+    def connectTree(self, smbClient, shareName):
+        """
+        Same as SMBConnection.connectTree(), but tree connects are cached along with the session.
+        Don't disconnect the trees returned.
+
+        :return int: Tree ID.
+        """
+        with self.__lock:
+            entry = self.__connections.get(id(smbClient))
+        if entry is None:
+            return smbClient.connectTree(shareName)
+        key = shareName.upper()
+        if key not in entry['Trees']:
+            entry['Trees'][key] = smbClient.connectTree(shareName)
+        return entry['Trees'][key]
+
+    def keepAlive(self):
+        """
+        Sends an echo on every session idle for more than keepAliveInterval seconds (and not in use), and
+        closes the ones idle for more than maxIdleTime seconds or not answering.
+        """
+        with self.__lock:
+            entries = list(self.__sessions.values())
+        for entry in entries:
+            if entry['Lock'].acquire(False) is False:
+                # In use
+                continue
+            try:
+                if entry['Connection'] is None:
+                    continue
+                idle = time.time() - entry['LastUsed']
+                if self.__maxIdleTime is not None and idle >= self.__maxIdleTime:
+                    self.__closeEntry(entry)
+                elif idle >= self.__keepAliveInterval:
+                    try:
+                        entry['Connection'].echo()
+                        entry['LastUsed'] = time.time()
+                    except Exception as e:
+                        LOG.debug('Session %s expired (%s)' % (str(entry['Key']), str(e)))
+                        self.__closeEntry(entry)
+            finally:
+                entry['Lock'].release()
+
+    def start(self):
+        """
+        Starts a background thread calling keepAlive() every keepAliveInterval seconds.
+        """
+        if self.__thread is not None:
+            return
+        self.__stopEvent.clear()
+        self.__thread = threading.Thread(target=self.__keepAliveLoop)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __keepAliveLoop(self):
+        while not self.__stopEvent.wait(self.__keepAliveInterval):
+            try:
+                self.keepAlive()
+            except Exception as e:
+                LOG.debug('Error in keep alive: %s' % str(e))
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__stopEvent.set()
+            self.__thread.join()
+            self.__thread = None
+
+    def close(self):
+        """
+        Stops the keep alive thread and closes every cached session.
+        """
+        self.stop()
+        with self.__lock:
+            entries = list(self.__sessions.values())
+            self.__sessions = {}
+        for entry in entries:
+            with entry['Lock']:
+                self.__closeEntry(entry)
+        with self.__lock:
+            self.__tickets = {}
+
+
+class SMBFile:
+    """
+    SMBFile class
+
+    Read only, seekable file object over a remote file. Data is fetched in blockSize aligned blocks that are kept
+    in a LRU cache, and every miss also reads ahead the following readAhead blocks in the same request (up to the
+    server's MaxReadSize). This way
+    random access parsers (e.g. ese.ESENT_DB or winregistry.Registry with isRemote=True) doing many small reads
+    only pay a round trip per window instead of one per read() call.
+
+    :param SMBConnection smbConnection: An authenticated SMBConnection instance.
+    :param str shareName: The share where the file resides.
+    :param str pathName: The path of the file, relative to shareName.
+    :param optional int blockSize: The size of every cached block.
+    :param optional int readAhead: The number of blocks read ahead on every cache miss.
+    :param optional int cacheSize: The maximum number of blocks kept in the cache.
+    :param optional int shareMode: The share access mode used when opening the file.
+
+    :return: An SMBFile instance, to be opened with open().
+    """
+    def __init__(self, smbConnection, shareName, pathName, blockSize=65536, readAhead=4, cacheSize=256,
+                 shareMode=FILE_SHARE_READ):
+        self.__smbConnection = smbConnection
+        self.__shareName = shareName
+        self.__pathName = pathName
+        self.__blockSize = blockSize
+        self.__readAhead = readAhead
+        self.__cacheSize = max(cacheSize, readAhead + 1)
+        self.__shareMode = shareMode
+        self.__tid = None
+        self.__fid = None
+        self.__fileSize = 0
+        self.__currentOffset = 0
+        self.__cache = OrderedDict()
+        self.__reads = 0
+        self.__maxReadSize = blockSize
+
+    def open(self):
+        """
+        Opens the remote file for reading.
+
+        :return: None
+        :raise SessionError: If encountered an error.
+        """
+        if self.__tid is None:
+            self.__tid = self.__smbConnection.connectTree(self.__shareName)
+        self.__fid = self.__smbConnection.openFile(self.__tid, self.__pathName, desiredAccess=FILE_READ_DATA |
+                                                   FILE_READ_ATTRIBUTES, shareMode=self.__shareMode)
+        self.__fileSize = self.__smbConnection.queryInfo(self.__tid, self.__fid)['EndOfFile']
+        self.__maxReadSize = self.__smbConnection.getIOCapabilities()['MaxReadSize']
+        self.__currentOffset = 0
+        self.__cache.clear()
+
+    def close(self):
+        """
+        Closes the remote file and drops the cached blocks.
+
+        :return: None
+        """
+        if self.__fid is not None:
+            self.__smbConnection.closeFile(self.__tid, self.__fid)
+            self.__fid = None
+        if self.__tid is not None:
+            self.__smbConnection.disconnectTree(self.__tid)
+            self.__tid = None
+        self.__cache.clear()
+
+    def getSMBConnection(self):
+        return self.__smbConnection
+
+    def getShareName(self):
+        return self.__shareName
+
+    def getPathName(self):
+        return self.__pathName
+
+    def getFileSize(self):
+        return self.__fileSize
+
+    def getReadCount(self):
+        """
+        Returns the number of SMB READ requests sent to the server so far. A window is read with a single request,
+        unless blockSize is bigger than the server's MaxReadSize.
+        """
+        return self.__reads
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.__currentOffset = offset
+        elif whence == 1:
+            self.__currentOffset += offset
+        elif whence == 2:
+            self.__currentOffset = self.__fileSize + offset
+        else:
+            raise ValueError('Invalid whence (%d)' % whence)
+        if self.__currentOffset < 0:
+            self.__currentOffset = 0
+        return self.__currentOffset
+
+    def tell(self):
+        return self.__currentOffset
+
+    def read(self, bytesToRead=-1):
+        if bytesToRead is None or bytesToRead < 0:
+            bytesToRead = self.__fileSize - self.__currentOffset
+        endOffset = min(self.__currentOffset + bytesToRead, self.__fileSize)
+        if endOffset <= self.__currentOffset:
+            return b''
+
+        firstBlock = self.__currentOffset // self.__blockSize
+        lastBlock = (endOffset - 1) // self.__blockSize
+
+        data = []
+        for blockIndex in range(firstBlock, lastBlock + 1):
+            block = self.__getBlock(blockIndex, lastBlock)
+            blockOffset = blockIndex * self.__blockSize
+            data.append(block[max(self.__currentOffset, blockOffset) - blockOffset:endOffset - blockOffset])
+
+        data = b''.join(data)
+        self.__currentOffset += len(data)
+        return data
+
+    def __getBlock(self, blockIndex, lastBlock):
+        if blockIndex in self.__cache:
+            self.__cache.move_to_end(blockIndex)
+            return self.__cache[blockIndex]
+
+        # Fetch every missing block up to the ones requested, plus the read ahead window, in one go. The window
+        # is capped to what fits in a single READ
+        totalBlocks = (self.__fileSize + self.__blockSize - 1) // self.__blockSize
+        endBlock = min(lastBlock + self.__readAhead, totalBlocks - 1)
+        maxCount = max(1, self.__maxReadSize // self.__blockSize)
+        count = 1
+        while blockIndex + count <= endBlock and (blockIndex + count) not in self.__cache and count < maxCount:
+            count += 1
+
+        offset = blockIndex * self.__blockSize
+        data = self.__smbConnection.readFile(self.__tid, self.__fid, offset, count * self.__blockSize,
+                                             singleCall=False)
+        # readFile() splits reads bigger than MaxReadSize
+        self.__reads += max(1, -(-len(data) // self.__maxReadSize))
+
+        for i in range(count):
+            self.__cache[blockIndex + i] = data[i * self.__blockSize:(i + 1) * self.__blockSize]
+        while len(self.__cache) > self.__cacheSize:
+            self.__cache.popitem(last=False)
+
+        return data[:self.__blockSize]
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __str__(self):
+        return "\\\\%s\\%s\\%s" % (self.__smbConnection.getRemoteHost(), self.__shareName, self.__pathName)
+
 class SessionError(Exception):
     """
     This is the exception every client should catch regardless of the underlying SMB version used. 
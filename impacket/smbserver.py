@@ -25,6 +25,9 @@
 # estamos en la B
 
 import calendar
+import collections
+import select
+import selectors
 import socket
 import time
 import datetime
@@ -39,6 +42,7 @@ import errno
 import sys
 import random
 import shutil
+import stat
 import string
 import hashlib
 import hmac
@@ -49,9 +53,11 @@ from impacket.dcerpc.v5 import rpcrt
 from six import b, ensure_str
 from six.moves import configparser, socketserver
 from pyasn1.codec.der import encoder, decoder
+from Cryptodome.Cipher import AES
+from Cryptodome.Hash import CMAC
 
 # For signing
-from impacket import smb, nmb, ntlm, uuid
+from impacket import smb, nmb, ntlm, uuid, crypto
 from impacket import smb3structs as smb2
 from impacket.spnego import SPNEGO_NegTokenInit, TypesMech, MechTypes, SPNEGO_NegTokenResp, ASN1_AID, \
     ASN1_SUPPORTED_MECH
@@ -63,7 +69,7 @@ from impacket.nt_errors import STATUS_NO_MORE_FILES, STATUS_NETWORK_NAME_DELETED
     STATUS_FILE_IS_A_DIRECTORY, STATUS_NOT_IMPLEMENTED, STATUS_INVALID_HANDLE, STATUS_OBJECT_NAME_COLLISION, \
     STATUS_NO_SUCH_FILE, STATUS_CANCELLED, STATUS_OBJECT_NAME_NOT_FOUND, STATUS_SUCCESS, STATUS_ACCESS_DENIED, \
     STATUS_NOT_SUPPORTED, STATUS_INVALID_DEVICE_REQUEST, STATUS_FS_DRIVER_REQUIRED, STATUS_INVALID_INFO_CLASS, \
-    STATUS_LOGON_FAILURE, STATUS_OBJECT_PATH_SYNTAX_BAD, STATUS_END_OF_FILE
+    STATUS_LOGON_FAILURE, STATUS_OBJECT_PATH_SYNTAX_BAD, STATUS_END_OF_FILE, STATUS_INFO_LENGTH_MISMATCH
 
 # Setting LOG to current's module name
 LOG = logging.getLogger(__name__)
@@ -72,6 +78,43 @@ LOG = logging.getLogger(__name__)
 STATUS_SMB_BAD_UID = 0x005B0002
 STATUS_SMB_BAD_TID = 0x00050002
 
+# SMB2/3 dialects the server can negotiate, by name
+SMB2_DIALECTS = {
+    '2.0.2': smb2.SMB2_DIALECT_002,
+    '2.1': smb2.SMB2_DIALECT_21,
+    '3.0': smb2.SMB2_DIALECT_30,
+    '3.0.2': smb2.SMB2_DIALECT_302,
+    '3.1.1': smb2.SMB2_DIALECT_311,
+}
+
+# SMB2_PREAUTH_INTEGRITY_CAPABILITIES hash algorithm
+SMB2_PREAUTH_INTEGRITY_SHA512 = 0x0001
+
+# Protocol ids starting every SMB packet
+SMB1_PROTOCOL_ID = b'\xffSMB'
+SMB2_PROTOCOL_ID = b'\xfeSMB'
+
+# Max credits a client can have granted at the same time
+SMB2_MAX_CREDITS = 8192
+
+# FileId used by the related requests of a compound chain to refer to the one opened before
+SMB2_RELATED_FILEID = b'\xff' * 16
+
+# Offset of the FileId field inside the body of the requests that have one
+SMB2_FILEID_OFFSETS = {
+    smb2.SMB2_CLOSE: 8,
+    smb2.SMB2_FLUSH: 8,
+    smb2.SMB2_READ: 16,
+    smb2.SMB2_WRITE: 16,
+    smb2.SMB2_LOCK: 8,
+    smb2.SMB2_IOCTL: 8,
+    smb2.SMB2_QUERY_DIRECTORY: 8,
+    smb2.SMB2_CHANGE_NOTIFY: 8,
+    smb2.SMB2_QUERY_INFO: 24,
+    smb2.SMB2_SET_INFO: 16,
+    smb2.SMB2_OPLOCK_BREAK: 8,
+}
+
 
 # Utility functions
 # and general functions.
@@ -380,21 +423,83 @@ def queryFsInformation(path, filename, level=None, pktFlags=smb.SMB.FLAGS2_UNICO
         return None
 
 
-def findFirst2(path, fileName, level, searchAttributes, pktFlags=smb.SMB.FLAGS2_UNICODE, isSMB2=False):
-    # TODO: Depending on the level, this could be done much simpler
+def scanDirectory(dirName):
+    """
+    Lists a directory with a single pass of os.scandir()
 
-    # Let's choose the right encoding depending on the request
-    if pktFlags & smb.SMB.FLAGS2_UNICODE:
-        encoding = 'utf-16le'
-    else:
-        encoding = 'ascii'
+    :param str dirName: Directory to list.
+
+    :return: List of (name, isDirectory) tuples.
+    """
+    entries = []
+    with os.scandir(dirName) as iterator:
+        for entry in iterator:
+            try:
+                isDirectory = entry.is_dir()
+            except OSError:
+                isDirectory = False
+            entries.append((entry.name, isDirectory))
+    return entries
+
+
+class DirectoryCache:
+    """
+    Listings of the shared directories, reused until the directory modification time changes.
 
+    Directories modified less than racyInterval seconds ago are not cached, since the modification
+    time might not change again if new entries are added within the timestamp granularity.
+
+    :param int maxDirectories: Maximum number of listings kept.
+    :param int racyInterval: Seconds a directory must be left untouched before its listing is cached.
+    """
+    def __init__(self, maxDirectories=256, racyInterval=2):
+        self.__maxDirectories = maxDirectories
+        self.__racyInterval = racyInterval * 1000000000
+        self.__listings = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def listDirectory(self, dirName):
+        """
+        Returns the same as scanDirectory(), from the cache if the directory didn't change.
+        """
+        mtime = os.stat(dirName).st_mtime_ns
+        with self.__lock:
+            listing = self.__listings.get(dirName)
+            if listing is not None and listing[0] == mtime:
+                self.__listings.move_to_end(dirName)
+                return listing[1]
+
+        entries = scanDirectory(dirName)
+        if time.time_ns() - mtime > self.__racyInterval:
+            with self.__lock:
+                self.__listings[dirName] = (mtime, entries)
+                self.__listings.move_to_end(dirName)
+                while len(self.__listings) > self.__maxDirectories:
+                    self.__listings.popitem(last=False)
+        return entries
+
+    def clear(self):
+        with self.__lock:
+            self.__listings.clear()
+
+
+def findFiles(path, fileName, searchAttributes, directoryCache=None):
+    """
+    Returns the paths matching fileName, that can contain wildcards in its last component.
+
+    :param str path: Share path.
+    :param str fileName: Path, relative to the share, to search for.
+    :param int searchAttributes: Directories are only returned if smb.ATTR_DIRECTORY is set.
+    :param DirectoryCache directoryCache: If set, directory listings are taken from it.
+
+    :return: List of paths and error code.
+    """
     fileName = normalize_path(fileName)
     pathName = os.path.join(path, fileName)
 
     if not isInFileJail(path, fileName):
         LOG.error("Path not in current working directory")
-        return [], 0, STATUS_OBJECT_PATH_SYNTAX_BAD
+        return [], STATUS_OBJECT_PATH_SYNTAX_BAD
 
     files = []
 
@@ -413,96 +518,123 @@ def findFirst2(path, fileName, level, searchAttributes, pktFlags=smb.SMB.FLAGS2_
 
     if pattern != '':
         if not os.path.exists(dirName):
-            return None, 0, STATUS_OBJECT_NAME_NOT_FOUND
-
-        for file in os.listdir(dirName):
-            if fnmatch.fnmatch(file.lower(), pattern.lower()):
-                entry = os.path.join(dirName, file)
-                if os.path.isdir(entry):
-                    if searchAttributes & smb.ATTR_DIRECTORY:
-                        files.append(entry)
-                else:
-                    files.append(entry)
+            return None, STATUS_OBJECT_NAME_NOT_FOUND
+
+        if directoryCache is not None:
+            entries = directoryCache.listDirectory(dirName)
+        else:
+            entries = scanDirectory(dirName)
+
+        pattern = pattern.lower()
+        for name, isDirectory in entries:
+            if pattern == '*' or fnmatch.fnmatch(name.lower(), pattern):
+                if isDirectory is False or searchAttributes & smb.ATTR_DIRECTORY:
+                    files.append(os.path.join(dirName, name))
     else:
         if os.path.exists(pathName):
             files.append(pathName)
 
+    return files, STATUS_SUCCESS
+
+
+def findEntry(pathName, level, pktFlags=smb.SMB.FLAGS2_UNICODE):
+    """
+    Builds the find information structure for a single file.
+
+    :param str pathName: Local path of the file.
+    :param int level: SMB_FIND_* or SMB2 file information class.
+    :param int pktFlags: SMB flags, to choose the file name encoding.
+
+    :return: The structure, or None if the level is not supported.
+    """
+    # Let's choose the right encoding depending on the request
+    if pktFlags & smb.SMB.FLAGS2_UNICODE:
+        encoding = 'utf-16le'
+    else:
+        encoding = 'ascii'
+
+    if level == smb.SMB_FIND_FILE_BOTH_DIRECTORY_INFO or level == smb2.SMB2_FILE_BOTH_DIRECTORY_INFO:
+        item = smb.SMBFindFileBothDirectoryInfo(flags=pktFlags)
+    elif level == smb.SMB_FIND_FILE_DIRECTORY_INFO or level == smb2.SMB2_FILE_DIRECTORY_INFO:
+        item = smb.SMBFindFileDirectoryInfo(flags=pktFlags)
+    elif level == smb.SMB_FIND_FILE_FULL_DIRECTORY_INFO or level == smb2.SMB2_FULL_DIRECTORY_INFO:
+        item = smb.SMBFindFileFullDirectoryInfo(flags=pktFlags)
+    elif level == smb.SMB_FIND_INFO_STANDARD:
+        item = smb.SMBFindInfoStandard(flags=pktFlags)
+    elif level == smb.SMB_FIND_FILE_ID_FULL_DIRECTORY_INFO or level == smb2.SMB2_FILE_ID_FULL_DIRECTORY_INFO:
+        item = smb.SMBFindFileIdFullDirectoryInfo(flags=pktFlags)
+    elif level == smb.SMB_FIND_FILE_ID_BOTH_DIRECTORY_INFO or level == smb2.SMB2_FILE_ID_BOTH_DIRECTORY_INFO:
+        item = smb.SMBFindFileIdBothDirectoryInfo(flags=pktFlags)
+    elif level == smb.SMB_FIND_FILE_NAMES_INFO or level == smb2.SMB2_FILE_NAMES_INFO:
+        item = smb.SMBFindFileNamesInfo(flags=pktFlags)
+    else:
+        return None
+
+    (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.stat(pathName)
+    if stat.S_ISDIR(mode):
+        item['ExtFileAttributes'] = smb.ATTR_DIRECTORY
+    else:
+        item['ExtFileAttributes'] = smb.ATTR_NORMAL | smb.ATTR_ARCHIVE
+
+    item['FileName'] = os.path.basename(pathName).encode(encoding)
+
+    if level in [smb.SMB_FIND_FILE_BOTH_DIRECTORY_INFO, smb2.SMB2_FILE_BOTH_DIRECTORY_INFO,
+                 smb.SMB_FIND_FILE_ID_BOTH_DIRECTORY_INFO, smb2.SMB2_FILE_ID_BOTH_DIRECTORY_INFO]:
+        item['EaSize'] = 0
+        item['EndOfFile'] = size
+        item['AllocationSize'] = size
+        item['CreationTime'] = smb.POSIXtoFT(ctime)
+        item['LastAccessTime'] = smb.POSIXtoFT(atime)
+        item['LastWriteTime'] = smb.POSIXtoFT(mtime)
+        item['LastChangeTime'] = smb.POSIXtoFT(mtime)
+        item['ShortName'] = '\x00' * 24
+    elif level in [smb.SMB_FIND_FILE_DIRECTORY_INFO, smb2.SMB2_FILE_DIRECTORY_INFO]:
+        item['EndOfFile'] = size
+        item['AllocationSize'] = size
+        item['CreationTime'] = smb.POSIXtoFT(ctime)
+        item['LastAccessTime'] = smb.POSIXtoFT(atime)
+        item['LastWriteTime'] = smb.POSIXtoFT(mtime)
+        item['LastChangeTime'] = smb.POSIXtoFT(mtime)
+    elif level in [smb.SMB_FIND_FILE_FULL_DIRECTORY_INFO, smb.SMB_FIND_FILE_ID_FULL_DIRECTORY_INFO,
+                   smb2.SMB2_FULL_DIRECTORY_INFO, smb2.SMB2_FILE_ID_FULL_DIRECTORY_INFO]:
+        item['EaSize'] = 0
+        item['EndOfFile'] = size
+        item['AllocationSize'] = size
+        item['CreationTime'] = smb.POSIXtoFT(ctime)
+        item['LastAccessTime'] = smb.POSIXtoFT(atime)
+        item['LastWriteTime'] = smb.POSIXtoFT(mtime)
+        item['LastChangeTime'] = smb.POSIXtoFT(mtime)
+    elif level == smb.SMB_FIND_INFO_STANDARD:
+        item['EaSize'] = size
+        item['CreationDate'] = getSMBDate(ctime)
+        item['CreationTime'] = getSMBTime(ctime)
+        item['LastAccessDate'] = getSMBDate(atime)
+        item['LastAccessTime'] = getSMBTime(atime)
+        item['LastWriteDate'] = getSMBDate(mtime)
+        item['LastWriteTime'] = getSMBTime(mtime)
+
+    if level != smb.SMB_FIND_INFO_STANDARD:
+        # Entries are 8 bytes aligned. Packing is expensive, so just once
+        itemLen = len(item)
+        item['NextEntryOffset'] = itemLen + (8 - (itemLen % 8)) % 8
+
+    return item
+
+
+def findFirst2(path, fileName, level, searchAttributes, pktFlags=smb.SMB.FLAGS2_UNICODE, isSMB2=False,
+               directoryCache=None):
+    files, errorCode = findFiles(path, fileName, searchAttributes, directoryCache)
+    if errorCode != STATUS_SUCCESS:
+        return files, 0, errorCode
+
     searchResult = []
     searchCount = len(files)
-    errorCode = STATUS_SUCCESS
 
     for i in files:
-        if level == smb.SMB_FIND_FILE_BOTH_DIRECTORY_INFO or level == smb2.SMB2_FILE_BOTH_DIRECTORY_INFO:
-            item = smb.SMBFindFileBothDirectoryInfo(flags=pktFlags)
-        elif level == smb.SMB_FIND_FILE_DIRECTORY_INFO or level == smb2.SMB2_FILE_DIRECTORY_INFO:
-            item = smb.SMBFindFileDirectoryInfo(flags=pktFlags)
-        elif level == smb.SMB_FIND_FILE_FULL_DIRECTORY_INFO or level == smb2.SMB2_FULL_DIRECTORY_INFO:
-            item = smb.SMBFindFileFullDirectoryInfo(flags=pktFlags)
-        elif level == smb.SMB_FIND_INFO_STANDARD:
-            item = smb.SMBFindInfoStandard(flags=pktFlags)
-        elif level == smb.SMB_FIND_FILE_ID_FULL_DIRECTORY_INFO or level == smb2.SMB2_FILE_ID_FULL_DIRECTORY_INFO:
-            item = smb.SMBFindFileIdFullDirectoryInfo(flags=pktFlags)
-        elif level == smb.SMB_FIND_FILE_ID_BOTH_DIRECTORY_INFO or level == smb2.SMB2_FILE_ID_BOTH_DIRECTORY_INFO:
-            item = smb.SMBFindFileIdBothDirectoryInfo(flags=pktFlags)
-        elif level == smb.SMB_FIND_FILE_NAMES_INFO or level == smb2.SMB2_FILE_NAMES_INFO:
-            item = smb.SMBFindFileNamesInfo(flags=pktFlags)
-        else:
+        item = findEntry(i, level, pktFlags)
+        if item is None:
             LOG.error("Wrong level %d!" % level)
             return searchResult, searchCount, STATUS_NOT_SUPPORTED
-
-        (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.stat(i)
-        if os.path.isdir(i):
-            item['ExtFileAttributes'] = smb.ATTR_DIRECTORY
-        else:
-            item['ExtFileAttributes'] = smb.ATTR_NORMAL | smb.ATTR_ARCHIVE
-
-        item['FileName'] = os.path.basename(i).encode(encoding)
-
-        if level in [smb.SMB_FIND_FILE_BOTH_DIRECTORY_INFO, smb2.SMB2_FILE_BOTH_DIRECTORY_INFO,
-                     smb.SMB_FIND_FILE_ID_BOTH_DIRECTORY_INFO, smb2.SMB2_FILE_ID_BOTH_DIRECTORY_INFO]:
-            item['EaSize'] = 0
-            item['EndOfFile'] = size
-            item['AllocationSize'] = size
-            item['CreationTime'] = smb.POSIXtoFT(ctime)
-            item['LastAccessTime'] = smb.POSIXtoFT(atime)
-            item['LastWriteTime'] = smb.POSIXtoFT(mtime)
-            item['LastChangeTime'] = smb.POSIXtoFT(mtime)
-            item['ShortName'] = '\x00' * 24
-            item['FileName'] = os.path.basename(i).encode(encoding)
-            padLen = (8 - (len(item) % 8)) % 8
-            item['NextEntryOffset'] = len(item) + padLen
-        elif level in [smb.SMB_FIND_FILE_DIRECTORY_INFO, smb2.SMB2_FILE_DIRECTORY_INFO]:
-            item['EndOfFile'] = size
-            item['AllocationSize'] = size
-            item['CreationTime'] = smb.POSIXtoFT(ctime)
-            item['LastAccessTime'] = smb.POSIXtoFT(atime)
-            item['LastWriteTime'] = smb.POSIXtoFT(mtime)
-            item['LastChangeTime'] = smb.POSIXtoFT(mtime)
-            item['FileName'] = os.path.basename(i).encode(encoding)
-            padLen = (8 - (len(item) % 8)) % 8
-            item['NextEntryOffset'] = len(item) + padLen
-        elif level in [smb.SMB_FIND_FILE_FULL_DIRECTORY_INFO, smb.SMB_FIND_FILE_ID_FULL_DIRECTORY_INFO,
-                       smb2.SMB2_FULL_DIRECTORY_INFO, smb2.SMB2_FILE_ID_FULL_DIRECTORY_INFO]:
-            item['EaSize'] = 0
-            item['EndOfFile'] = size
-            item['AllocationSize'] = size
-            item['CreationTime'] = smb.POSIXtoFT(ctime)
-            item['LastAccessTime'] = smb.POSIXtoFT(atime)
-            item['LastWriteTime'] = smb.POSIXtoFT(mtime)
-            item['LastChangeTime'] = smb.POSIXtoFT(mtime)
-            padLen = (8 - (len(item) % 8)) % 8
-            item['NextEntryOffset'] = len(item) + padLen
-        elif level == smb.SMB_FIND_INFO_STANDARD:
-            item['EaSize'] = size
-            item['CreationDate'] = getSMBDate(ctime)
-            item['CreationTime'] = getSMBTime(ctime)
-            item['LastAccessDate'] = getSMBDate(atime)
-            item['LastAccessTime'] = getSMBTime(atime)
-            item['LastWriteDate'] = getSMBDate(mtime)
-            item['LastWriteTime'] = getSMBTime(mtime)
-        elif level in [smb.SMB_FIND_FILE_NAMES_INFO, smb2.SMB2_FILE_NAMES_INFO]:
-            padLen = (8 - (len(item) % 8)) % 8
-            item['NextEntryOffset'] = len(item) + padLen
         searchResult.append(item)
 
     # No more files
@@ -528,9 +660,15 @@ def queryPathInformation(path, filename, level):
             LOG.error("Path not in current working directory")
             return None, STATUS_OBJECT_PATH_SYNTAX_BAD
 
-        if os.path.exists(pathName):
-            (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.stat(pathName)
-            if os.path.isdir(pathName):
+        try:
+            statResult = os.stat(pathName)
+        except OSError:
+            statResult = None
+
+        if statResult is not None:
+            (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = statResult
+            isDirectory = stat.S_ISDIR(mode)
+            if isDirectory:
                 fileAttributes = smb.ATTR_DIRECTORY
             else:
                 fileAttributes = smb.ATTR_NORMAL | smb.ATTR_ARCHIVE
@@ -553,7 +691,7 @@ def queryPathInformation(path, filename, level):
                 infoRecord = smb.SMBQueryFileStandardInfo()
                 infoRecord['AllocationSize'] = size
                 infoRecord['EndOfFile'] = size
-                if os.path.isdir(pathName):
+                if isDirectory:
                     infoRecord['Directory'] = 1
                 else:
                     infoRecord['Directory'] = 0
@@ -562,7 +700,7 @@ def queryPathInformation(path, filename, level):
                 infoRecord['AllocationSize'] = size
                 infoRecord['EndOfFile'] = size
                 infoRecord['NumberOfLinks'] = 0
-                if os.path.isdir(pathName):
+                if isDirectory:
                     infoRecord['Directory'] = 1
                 else:
                     infoRecord['Directory'] = 0
@@ -575,7 +713,7 @@ def queryPathInformation(path, filename, level):
                 infoRecord['ExtFileAttributes'] = fileAttributes
                 infoRecord['AllocationSize'] = size
                 infoRecord['EndOfFile'] = size
-                if os.path.isdir(pathName):
+                if isDirectory:
                     infoRecord['Directory'] = 1
                 else:
                     infoRecord['Directory'] = 0
@@ -595,7 +733,7 @@ def queryPathInformation(path, filename, level):
                 infoRecord['BasicInformation']['LastAccessTime'] = smb.POSIXtoFT(atime)
                 infoRecord['BasicInformation']['LastWriteTime'] = smb.POSIXtoFT(mtime)
                 infoRecord['BasicInformation']['ChangeTime'] = smb.POSIXtoFT(mtime)
-                if os.path.isdir(pathName):
+                if isDirectory:
                     infoRecord['BasicInformation']['FileAttributes'] = smb.SMB_FILE_ATTRIBUTE_DIRECTORY
                     infoRecord['StandardInformation']['Directory'] = 1
                     infoRecord['EaInformation']['EaSize'] = smb.ATTR_DIRECTORY
@@ -652,6 +790,132 @@ def queryDiskInformation(path):
     return totalUnits, freeUnits
 
 
+def readFileRange(fileHandle, offset, length):
+    # Positional read, so concurrent requests on the same handle don't race on the file offset
+    if hasattr(os, 'pread'):
+        return os.pread(fileHandle, length, offset)
+    os.lseek(fileHandle, offset, 0)
+    return os.read(fileHandle, length)
+
+
+def openNamedPipe(address):
+    # Pipes registered with a DCERPCServer are answered in-process, the other ones are proxied to (host, port)
+    if isinstance(address, DCERPCServer):
+        return address.openPipe()
+    sock = socket.socket()
+    sock.connect(address)
+    return sock
+
+
+def writeFileRange(fileHandle, offset, data):
+    # Positional write (see readFileRange), retried until the whole buffer is on disk. data can be a memoryview
+    # over the received packet, so uploads are not copied again before reaching the file
+    data = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while len(data) > 0:
+            written = os.pwrite(fileHandle, data, offset)
+            data = data[written:]
+            offset += written
+    else:
+        os.lseek(fileHandle, offset, 0)
+        while len(data) > 0:
+            data = data[os.write(fileHandle, data):]
+
+
+def setEndOfFile(fileHandle, endOfFile):
+    # Clients usually set the final size before uploading a file. If it grows, its blocks are reserved in one go,
+    # so the writes that follow don't fragment it or fail halfway with a full disk
+    size = os.fstat(fileHandle).st_size
+    if endOfFile > size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fileHandle, size, endOfFile - size)
+            return
+        except OSError:
+            # Not supported by the underlying filesystem
+            pass
+    os.ftruncate(fileHandle, endOfFile)
+
+
+class SMB2FileRegion:
+    """
+    SMB2 answer whose payload is a range of a file, returned by processRequest() instead of the answer bytes.
+    Transports call send() so the file content goes from the descriptor to the socket with os.sendfile(),
+    without being copied to user space. getData() returns the whole answer for any other transport.
+
+    :param bytes header: Answer bytes preceding the file content (SMB2 header and fixed response part).
+    :param int fileHandle: Descriptor of the file, it's duplicated so the file can be closed meanwhile.
+    :param int offset: Offset of the file content.
+    :param int length: Bytes of file content announced in the header.
+    :param int padLength: Zero bytes sent after the file content.
+
+    The duplicated descriptor is closed once the answer is sent or read, by close(), when used as a context
+    manager or when the object is collected.
+    """
+    def __init__(self, header, fileHandle, offset, length, padLength=0):
+        self.__header = header
+        self.__fileHandle = os.dup(fileHandle)
+        self.__offset = offset
+        self.__length = length
+        self.__padLength = padLength
+        self.__pending = None
+
+    def __len__(self):
+        return len(self.__header) + self.__length + self.__padLength
+
+    def close(self):
+        if self.__fileHandle is not None:
+            os.close(self.__fileHandle)
+            self.__fileHandle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        # Answers dropped without being sent don't leak the descriptor
+        self.close()
+
+    def getData(self):
+        content = readFileRange(self.__fileHandle, self.__offset, self.__length)
+        self.close()
+        # The file could have been truncated after the header was built
+        content += b'\x00' * (self.__length - len(content))
+        return self.__header + content + b'\x00' * self.__padLength
+
+    def send(self, sock):
+        """
+        Sends the answer as a NetBIOS session message. Returns True once it was completely sent, False if
+        the socket can't take more data right now (call it again once it's writable).
+        """
+        if self.__pending is None:
+            length = len(self)
+            self.__pending = memoryview(struct.pack('!BBH', nmb.NETBIOS_SESSION_MESSAGE, (length >> 16) & 0xff,
+                                                    length & 0xffff) + self.__header)
+        try:
+            while len(self.__pending) > 0:
+                self.__pending = self.__pending[sock.send(self.__pending):]
+            while self.__length > 0:
+                sent = os.sendfile(sock.fileno(), self.__fileHandle, self.__offset, self.__length)
+                if sent == 0:
+                    # Truncated file, we still have to send the bytes announced
+                    self.__padLength += self.__length
+                    self.__length = 0
+                    break
+                self.__offset += sent
+                self.__length -= sent
+            if self.__padLength > 0:
+                self.__pending = memoryview(b'\x00' * self.__padLength)
+                self.__padLength = 0
+                while len(self.__pending) > 0:
+                    self.__pending = self.__pending[sock.send(self.__pending):]
+        except (BlockingIOError, InterruptedError):
+            return False
+        self.close()
+        return True
+
+
 # Here we implement the NT transaction handlers
 class NTTRANSCommands:
     def default(self, connId, smbServer, recvPacket, parameters, data, maxDataCount=0):
@@ -849,9 +1113,7 @@ class TRANS2Commands:
                 elif informationLevel == smb.SMB_SET_FILE_END_OF_FILE_INFO:
                     fileHandle = connData['OpenedFiles'][setFileInfoParameters['FID']]['FileHandle']
                     infoRecord = smb.SMBSetFileEndOfFileInfo(data)
-                    if infoRecord['EndOfFile'] > 0:
-                        os.lseek(fileHandle, infoRecord['EndOfFile'] - 1, 0)
-                        os.write(fileHandle, b'\x00')
+                    setEndOfFile(fileHandle, infoRecord['EndOfFile'])
                 else:
                     smbServer.log('Unknown level for set file info! 0x%x' % setFileInfoParameters['InformationLevel'],
                                   logging.ERROR, connData=connData)
@@ -957,12 +1219,12 @@ class TRANS2Commands:
                 searchResult = connData['SIDs'][sid]
                 respParameters = smb.SMBFindNext2Response_Parameters()
                 endOfSearch = 1
-                searchCount = 1
+                searchCount = 0
                 totalData = 0
                 for i in enumerate(searchResult):
                     data = i[1].getData()
                     lenData = len(data)
-                    if (totalData + lenData) >= maxDataCount or (i[0] + 1) >= findNext2Parameters['SearchCount']:
+                    if (totalData + lenData) >= maxDataCount or (i[0] + 1) > findNext2Parameters['SearchCount']:
                         # We gotta stop here and continue on a find_next2
                         endOfSearch = 0
                         connData['SIDs'][sid] = searchResult[i[0]:]
@@ -971,7 +1233,10 @@ class TRANS2Commands:
                     else:
                         searchCount += 1
                         respData += data
-                        totalData += lenData
+
+                        padLen = (8 - (lenData % 8)) % 8
+                        respData += b'\xaa' * padLen
+                        totalData += lenData + padLen
 
                 # Have we reached the end of the search or still stuff to send?
                 if endOfSearch > 0:
@@ -1006,7 +1271,8 @@ class TRANS2Commands:
                                                                               findFirst2Parameters['FileName']),
                                                               findFirst2Parameters['InformationLevel'],
                                                               findFirst2Parameters['SearchAttributes'],
-                                                              pktFlags=recvPacket['Flags2'])
+                                                              pktFlags=recvPacket['Flags2'],
+                                                              directoryCache=smbServer.getDirectoryCache())
 
             if searchCount > 0:
                 respParameters = smb.SMBFindFirst2Response_Parameters()
@@ -1564,9 +1830,8 @@ class SMBCommands:
                     if fileHandle != PIPE_FILE_DESCRIPTOR:
                         # TODO: Handle big size files
                         # If we're trying to write past the file end we just skip the write call (Vista does this)
-                        if os.lseek(fileHandle, 0, 2) >= comWriteParameters['Offset']:
-                            os.lseek(fileHandle, comWriteParameters['Offset'], 0)
-                            os.write(fileHandle, comWriteData['Data'])
+                        if os.fstat(fileHandle).st_size >= comWriteParameters['Offset']:
+                            writeFileRange(fileHandle, comWriteParameters['Offset'], comWriteData['Data'])
                     else:
                         sock = connData['OpenedFiles'][comWriteParameters['Fid']]['Socket']
                         sock.send(comWriteData['Data'])
@@ -1844,9 +2109,8 @@ class SMBCommands:
                         if 'HighOffset' in writeAndX.fields:
                             offset += (writeAndX['HighOffset'] << 32)
                         # If we're trying to write past the file end we just skip the write call (Vista does this)
-                        if os.lseek(fileHandle, 0, 2) >= offset:
-                            os.lseek(fileHandle, offset, 0)
-                            os.write(fileHandle, writeAndXData['Data'])
+                        if os.fstat(fileHandle).st_size >= offset:
+                            writeFileRange(fileHandle, offset, writeAndXData['Data'])
                     else:
                         sock = connData['OpenedFiles'][writeAndX['Fid']]['Socket']
                         sock.send(writeAndXData['Data'])
@@ -2262,8 +2526,7 @@ class SMBCommands:
                                 mode |= os.O_BINARY
                             if str(pathName) in smbServer.getRegisteredNamedPipes():
                                 fid = PIPE_FILE_DESCRIPTOR
-                                sock = socket.socket()
-                                sock.connect(smbServer.getRegisteredNamedPipes()[str(pathName)])
+                                sock = openNamedPipe(smbServer.getRegisteredNamedPipes()[str(pathName)])
                             else:
                                 if readOnly:
                                     mode = os.O_RDONLY
@@ -2851,24 +3114,45 @@ class SMB2Commands:
 
         respSMBCommand = smb2.SMB2Negotiate_Response()
 
-        respSMBCommand['SecurityMode'] = 1
+        respSMBCommand['SecurityMode'] = smb2.SMB2_NEGOTIATE_SIGNING_ENABLED
+        maxDialect = smbServer.getSMB2MaxDialect()
         if isSMB1 is True:
             # Let's first parse the packet to see if the client supports SMB2
             SMBCommand = smb.SMBCommand(recvPacket['Data'][0])
 
             dialects = SMBCommand['Data'].split(b'\x02')
-            if b'SMB 2.002\x00' in dialects or b'SMB 2.???\x00' in dialects:
+            if b'SMB 2.???\x00' in dialects and maxDialect > smb2.SMB2_DIALECT_002:
+                # Multi-protocol negotiate, the client will send us a SMB2 NEGOTIATE with its dialects
+                respSMBCommand['DialectRevision'] = smb2.SMB2_DIALECT_WILDCARD
+            elif b'SMB 2.002\x00' in dialects or b'SMB 2.???\x00' in dialects:
                 respSMBCommand['DialectRevision'] = smb2.SMB2_DIALECT_002
             else:
                 # Client does not support SMB2 fallbacking
                 raise Exception('SMB2 not supported, fallbacking')
         else:
-            respSMBCommand['DialectRevision'] = smb2.SMB2_DIALECT_002
+            dialectCount = struct.unpack('<H', recvPacket['Data'][2:4])[0]
+            dialects = struct.unpack('<%dH' % dialectCount, recvPacket['Data'][36:36 + 2 * dialectCount])
+            dialects = [dialect for dialect in dialects if dialect in SMB2_DIALECTS.values() and dialect <= maxDialect]
+            if len(dialects) == 0:
+                smbServer.log('SMB2_NEGOTIATE: no common dialect', logging.ERROR, connData=connData)
+                return [smb2.SMB2Error()], None, STATUS_NOT_SUPPORTED
+            respSMBCommand['DialectRevision'] = max(dialects)
+
+        dialect = respSMBCommand['DialectRevision']
+        connData['Dialect'] = dialect
         respSMBCommand['ServerGuid'] = b'A' * 16
-        respSMBCommand['Capabilities'] = 0
-        respSMBCommand['MaxTransactSize'] = 65536
-        respSMBCommand['MaxReadSize'] = 65536
-        respSMBCommand['MaxWriteSize'] = 65536
+        if dialect != smb2.SMB2_DIALECT_002 and dialect != smb2.SMB2_DIALECT_WILDCARD:
+            # SMB 2.1 onwards, multi-credit requests allow us to move up to MaxIOSize bytes per READ/WRITE
+            respSMBCommand['Capabilities'] = smb2.SMB2_GLOBAL_CAP_LARGE_MTU
+            maxIOSize = smbServer.getSMB2MaxIOSize()
+        else:
+            respSMBCommand['Capabilities'] = 0
+            maxIOSize = 65536
+        respSMBCommand['MaxTransactSize'] = maxIOSize
+        respSMBCommand['MaxReadSize'] = maxIOSize
+        respSMBCommand['MaxWriteSize'] = maxIOSize
+        connData['ServerCapabilities'] = respSMBCommand['Capabilities']
+        connData['MaxIOSize'] = maxIOSize
         respSMBCommand['SystemTime'] = smb.POSIXtoFT(calendar.timegm(time.gmtime()))
         respSMBCommand['ServerStartTime'] = smb.POSIXtoFT(calendar.timegm(time.gmtime()))
         respSMBCommand['SecurityBufferOffset'] = 0x80
@@ -2886,6 +3170,28 @@ class SMB2Commands:
         respSMBCommand['Buffer'] = blob.getData()
         respSMBCommand['SecurityBufferLength'] = len(respSMBCommand['Buffer'])
 
+        if dialect == smb2.SMB2_DIALECT_311:
+            # SMB 3.1.1 requires the SMB2_PREAUTH_INTEGRITY_CAPABILITIES context. We only support SHA-512,
+            # the only algorithm defined, and no encryption, so that's the only context sent back
+            preAuthIntegrityCapabilities = smb2.SMB2PreAuthIntegrityCapabilities()
+            preAuthIntegrityCapabilities['HashAlgorithmCount'] = 1
+            preAuthIntegrityCapabilities['SaltLength'] = 32
+            preAuthIntegrityCapabilities['HashAlgorithms'] = struct.pack('<H', SMB2_PREAUTH_INTEGRITY_SHA512)
+            preAuthIntegrityCapabilities['Salt'] = os.urandom(32)
+
+            negotiateContext = smb2.SMB2NegotiateContext()
+            negotiateContext['ContextType'] = smb2.SMB2_PREAUTH_INTEGRITY_CAPABILITIES
+            negotiateContext['Data'] = preAuthIntegrityCapabilities.getData()
+            negotiateContext['DataLength'] = len(negotiateContext['Data'])
+
+            # The first negotiate context MUST be 8-byte aligned
+            padLen = -(respSMBCommand['SecurityBufferOffset'] + respSMBCommand['SecurityBufferLength']) % 8
+            respSMBCommand['Padding'] = b'\x00' * padLen
+            respSMBCommand['NegotiateContextCount'] = 1
+            respSMBCommand['NegotiateContextOffset'] = respSMBCommand['SecurityBufferOffset'] + \
+                                                       respSMBCommand['SecurityBufferLength'] + padLen
+            respSMBCommand['NegotiateContextList'] = negotiateContext.getData()
+
         respPacket['Data'] = respSMBCommand
 
         smbServer.setConnectionData(connId, connData)
@@ -3253,6 +3559,17 @@ class SMB2Commands:
         elif authType == TypesMech['NTLMSSP - Microsoft NTLM Security Support Provider']:
             respSMBCommand, errorCode = SMB2Commands._ntlm_auth(token, connData, smbServer, rawNTLM)
 
+        if errorCode == STATUS_SUCCESS and connData['SignatureEnabled'] is True and \
+                connData['Dialect'] >= smb2.SMB2_DIALECT_30:
+            # SMB 3.x signs with AES-CMAC using a key derived from the session key
+            if connData['Dialect'] == smb2.SMB2_DIALECT_311:
+                connData['SigningSessionKey'] = crypto.KDF_CounterMode(connData['SigningSessionKey'],
+                                                                       b"SMBSigningKey\x00",
+                                                                       connData['SessionPreauthIntegrityHashValue'], 128)
+            else:
+                connData['SigningSessionKey'] = crypto.KDF_CounterMode(connData['SigningSessionKey'],
+                                                                       b"SMB2AESCMAC\x00", b"SmbSign\x00", 128)
+
         # From now on, the client can ask for other commands
         connData['Authenticated'] = True
         # For now, just switching to nobody
@@ -3324,7 +3641,7 @@ class SMB2Commands:
 
         # Sign the packet if needed
         if connData['SignatureEnabled']:
-            smbServer.signSMBv2(respPacket, connData['SigningSessionKey'])
+            smbServer.signSMBv2(respPacket, connData['SigningSessionKey'], dialect=connData['Dialect'])
         smbServer.setConnectionData(connId, connData)
 
         return None, [respPacket], errorCode
@@ -3426,8 +3743,7 @@ class SMB2Commands:
                                 mode |= os.O_BINARY
                             if ensure_str(pathName) in smbServer.getRegisteredNamedPipes():
                                 fid = PIPE_FILE_DESCRIPTOR
-                                sock = socket.socket()
-                                sock.connect(smbServer.getRegisteredNamedPipes()[ensure_str(pathName)])
+                                sock = openNamedPipe(smbServer.getRegisteredNamedPipes()[ensure_str(pathName)])
                             else:
                                 if readOnly:
                                     mode = os.O_RDONLY
@@ -3482,13 +3798,12 @@ class SMB2Commands:
                 connData['OpenedFiles'][fakefid]['Open'] = {}
                 connData['OpenedFiles'][fakefid]['Open']['EnumerationLocation'] = 0
                 connData['OpenedFiles'][fakefid]['Open']['EnumerationSearchPattern'] = ''
+                connData['OpenedFiles'][fakefid]['Open']['EnumerationFiles'] = []
                 if fid == PIPE_FILE_DESCRIPTOR:
                     connData['OpenedFiles'][fakefid]['Socket'] = sock
         else:
             respSMBCommand = smb2.SMB2Error()
 
-        if errorCode == STATUS_SUCCESS:
-            connData['LastRequest']['SMB2_CREATE'] = respSMBCommand
         smbServer.setConnectionData(connId, connData)
 
         return [respSMBCommand], None, errorCode
@@ -3501,14 +3816,7 @@ class SMB2Commands:
 
         closeRequest = smb2.SMB2Close(recvPacket['Data'])
 
-        if closeRequest['FileID'].getData() == b'\xff' * 16:
-            # Let's take the data from the lastRequest
-            if 'SMB2_CREATE' in connData['LastRequest']:
-                fileID = connData['LastRequest']['SMB2_CREATE']['FileID']
-            else:
-                fileID = closeRequest['FileID'].getData()
-        else:
-            fileID = closeRequest['FileID'].getData()
+        fileID = closeRequest['FileID'].getData()
 
         # Get the Tid associated
         if recvPacket['TreeID'] in connData['ConnectedShares']:
@@ -3576,14 +3884,7 @@ class SMB2Commands:
         respSMBCommand['OutputBufferOffset'] = 0x48
         respSMBCommand['Buffer'] = b'\x00'
 
-        if queryInfo['FileID'].getData() == b'\xff' * 16:
-            # Let's take the data from the lastRequest
-            if 'SMB2_CREATE' in connData['LastRequest']:
-                fileID = connData['LastRequest']['SMB2_CREATE']['FileID']
-            else:
-                fileID = queryInfo['FileID'].getData()
-        else:
-            fileID = queryInfo['FileID'].getData()
+        fileID = queryInfo['FileID'].getData()
 
         # Get the Tid associated
         if recvPacket['TreeID'] in connData['ConnectedShares']:
@@ -3634,14 +3935,7 @@ class SMB2Commands:
 
         errorCode = STATUS_SUCCESS
 
-        if setInfo['FileID'].getData() == b'\xff' * 16:
-            # Let's take the data from the lastRequest
-            if 'SMB2_CREATE' in connData['LastRequest']:
-                fileID = connData['LastRequest']['SMB2_CREATE']['FileID']
-            else:
-                fileID = setInfo['FileID'].getData()
-        else:
-            fileID = setInfo['FileID'].getData()
+        fileID = setInfo['FileID'].getData()
 
         # Get the Tid associated
         if recvPacket['TreeID'] in connData['ConnectedShares']:
@@ -3680,9 +3974,7 @@ class SMB2Commands:
                     elif informationLevel == smb2.SMB2_FILE_END_OF_FILE_INFO:
                         fileHandle = connData['OpenedFiles'][fileID]['FileHandle']
                         infoRecord = smb.SMBSetFileEndOfFileInfo(setInfo['Buffer'])
-                        if infoRecord['EndOfFile'] > 0:
-                            os.lseek(fileHandle, infoRecord['EndOfFile'] - 1, 0)
-                            os.write(fileHandle, b'\x00')
+                        setEndOfFile(fileHandle, infoRecord['EndOfFile'])
                     elif informationLevel == smb2.SMB2_FILE_RENAME_INFO:
                         renameInfo = smb2.FILE_RENAME_INFORMATION_TYPE_2(setInfo['Buffer'])
                         newFileName = normalize_path(renameInfo['FileName'].decode('utf-16le'))
@@ -3737,18 +4029,18 @@ class SMB2Commands:
         connData = smbServer.getConnectionData(connId)
 
         respSMBCommand = smb2.SMB2Write_Response()
-        writeRequest = smb2.SMB2Write(recvPacket['Data'])
-
+        # Only the fixed part of the request is parsed. The payload is a view over the request data, so
+        # big writes are not copied again by SMB2Write before reaching the file
+        data = recvPacket['Data']
         respSMBCommand['Buffer'] = b'\x00'
 
-        if writeRequest['FileID'].getData() == b'\xff' * 16:
-            # Let's take the data from the lastRequest
-            if 'SMB2_CREATE' in connData['LastRequest']:
-                fileID = connData['LastRequest']['SMB2_CREATE']['FileID']
-            else:
-                fileID = writeRequest['FileID'].getData()
-        else:
-            fileID = writeRequest['FileID'].getData()
+        # DataOffset is relative to the beginning of the SMB2 header (64 bytes)
+        if len(data) < 48:
+            return [respSMBCommand], None, STATUS_INVALID_PARAMETER
+        dataOffset, length, offset, fileID = struct.unpack_from('<2xHLQ16s', data)
+        if dataOffset < 64 or dataOffset - 64 + length > len(data):
+            return [respSMBCommand], None, STATUS_INVALID_PARAMETER
+        payload = memoryview(data)[dataOffset - 64:dataOffset - 64 + length]
 
         # Get the Tid associated
         if recvPacket['TreeID'] in connData['ConnectedShares']:
@@ -3759,16 +4051,14 @@ class SMB2Commands:
                 errorCode = STATUS_SUCCESS
                 try:
                     if fileHandle != PIPE_FILE_DESCRIPTOR:
-                        offset = writeRequest['Offset']
                         # If we're trying to write past the file end we just skip the write call (Vista does this)
-                        if os.lseek(fileHandle, 0, 2) >= offset:
-                            os.lseek(fileHandle, offset, 0)
-                            os.write(fileHandle, writeRequest['Buffer'])
+                        if os.fstat(fileHandle).st_size >= offset:
+                            writeFileRange(fileHandle, offset, payload)
                     else:
                         sock = connData['OpenedFiles'][fileID]['Socket']
-                        sock.send(writeRequest['Buffer'])
+                        sock.sendall(payload)
 
-                    respSMBCommand['Count'] = writeRequest['Length']
+                    respSMBCommand['Count'] = len(payload)
                     respSMBCommand['Remaining'] = 0xff
                 except Exception as e:
                     smbServer.log('SMB2_WRITE: %s' % e, logging.ERROR, connData=connData)
@@ -3790,14 +4080,7 @@ class SMB2Commands:
 
         respSMBCommand['Buffer'] = b'\x00'
 
-        if readRequest['FileID'].getData() == b'\xff' * 16:
-            # Let's take the data from the lastRequest
-            if 'SMB2_CREATE' in connData['LastRequest']:
-                fileID = connData['LastRequest']['SMB2_CREATE']['FileID']
-            else:
-                fileID = readRequest['FileID'].getData()
-        else:
-            fileID = readRequest['FileID'].getData()
+        fileID = readRequest['FileID'].getData()
 
         # Get the Tid associated
         if recvPacket['TreeID'] in connData['ConnectedShares']:
@@ -3807,20 +4090,28 @@ class SMB2Commands:
                 smbServer.log("smb2Read: %s" % fileName, logging.INFO, connData=connData)
                 errorCode = 0
                 try:
-                    if fileHandle != PIPE_FILE_DESCRIPTOR:
+                    if fileHandle != PIPE_FILE_DESCRIPTOR and hasattr(os, 'sendfile') and \
+                            stat.S_ISREG(os.fstat(fileHandle).st_mode):
+                        # The content is read by processRequest(), or sent straight from the file if possible
                         offset = readRequest['Offset']
-                        os.lseek(fileHandle, offset, 0)
-                        content = os.read(fileHandle, readRequest['Length'])
+                        length = max(0, min(readRequest['Length'], os.fstat(fileHandle).st_size - offset))
+                        respSMBCommand['Buffer'] = b''
+                        respSMBCommand.fileRegion = (fileHandle, offset, length)
                     else:
-                        sock = connData['OpenedFiles'][fileID]['Socket']
-                        content = sock.recv(readRequest['Length'])
+                        if fileHandle != PIPE_FILE_DESCRIPTOR:
+                            content = readFileRange(fileHandle, readRequest['Offset'], readRequest['Length'])
+                        else:
+                            sock = connData['OpenedFiles'][fileID]['Socket']
+                            content = sock.recv(readRequest['Length'])
+                        length = len(content)
+                        respSMBCommand['Buffer'] = content
 
                     respSMBCommand['DataOffset'] = 0x50
-                    respSMBCommand['DataLength'] = len(content)
+                    respSMBCommand['DataLength'] = length
                     respSMBCommand['DataRemaining'] = 0
-                    respSMBCommand['Buffer'] = content
-                    if len(content) == 0:
+                    if length == 0:
                         errorCode = STATUS_END_OF_FILE
+                        respSMBCommand.fileRegion = None
                 except Exception as e:
                     smbServer.log('SMB2_READ: %s ' % e, logging.ERROR, connData=connData)
                     errorCode = STATUS_ACCESS_DENIED
@@ -3874,14 +4165,7 @@ class SMB2Commands:
 
         # Next, the server MUST locate the open for the directory to be queried
         # If no open is found, the server MUST fail the request with STATUS_FILE_CLOSED
-        if queryDirectoryRequest['FileID'].getData() == b'\xff' * 16:
-            # Let's take the data from the lastRequest
-            if 'SMB2_CREATE' in connData['LastRequest']:
-                fileID = connData['LastRequest']['SMB2_CREATE']['FileID']
-            else:
-                fileID = queryDirectoryRequest['FileID'].getData()
-        else:
-            fileID = queryDirectoryRequest['FileID'].getData()
+        fileID = queryDirectoryRequest['FileID'].getData()
 
         if (fileID in connData['OpenedFiles']) is False:
             return [smb2.SMB2Error()], None, STATUS_FILE_CLOSED
@@ -3936,70 +4220,72 @@ class SMB2Commands:
                 queryDirectoryRequest['FileNameLength'] > 0:
             connData['OpenedFiles'][fileID]['Open']['EnumerationSearchPattern'] = pattern
 
-        pathName = os.path.join(os.path.normpath(connData['OpenedFiles'][fileID]['FileName']), pattern)
-        searchResult, searchCount, errorCode = findFirst2(os.path.dirname(pathName),
-                                                          os.path.basename(pathName),
-                                                          queryDirectoryRequest['FileInformationClass'],
-                                                          smb.ATTR_DIRECTORY, isSMB2=True)
+        # The directory is listed once per enumeration, entries are only built for the ones sent back
+        if connData['OpenedFiles'][fileID]['Open']['EnumerationLocation'] == 0:
+            pathName = os.path.join(os.path.normpath(connData['OpenedFiles'][fileID]['FileName']), pattern)
+            files, errorCode = findFiles(os.path.dirname(pathName), os.path.basename(pathName), smb.ATTR_DIRECTORY,
+                                         smbServer.getDirectoryCache())
+            if errorCode != STATUS_SUCCESS:
+                return [smb2.SMB2Error()], None, errorCode
 
-        if errorCode != STATUS_SUCCESS:
-            return [smb2.SMB2Error()], None, errorCode
+            if len(files) > 2 and pattern == '*':
+                # strip . and ..
+                files = files[2:]
 
-        if searchCount > 2 and pattern == '*':
-            # strip . and ..
-            searchCount -= 2
-            searchResult = searchResult[2:]
+            if len(files) == 0:
+                return [smb2.SMB2Error()], None, STATUS_NO_SUCH_FILE
 
-        if searchCount == 0 and connData['OpenedFiles'][fileID]['Open']['EnumerationLocation'] == 0:
-            return [smb2.SMB2Error()], None, STATUS_NO_SUCH_FILE
+            connData['OpenedFiles'][fileID]['Open']['EnumerationFiles'] = files
 
         if connData['OpenedFiles'][fileID]['Open']['EnumerationLocation'] < 0:
             return [smb2.SMB2Error()], None, STATUS_NO_MORE_FILES
 
+        files = connData['OpenedFiles'][fileID]['Open']['EnumerationFiles']
+        location = connData['OpenedFiles'][fileID]['Open']['EnumerationLocation']
+        entries = []
         totalData = 0
-        respData = b''
-        for nItem in range(connData['OpenedFiles'][fileID]['Open']['EnumerationLocation'], searchCount):
-            connData['OpenedFiles'][fileID]['Open']['EnumerationLocation'] += 1
-            if queryDirectoryRequest['Flags'] & smb2.SL_RETURN_SINGLE_ENTRY:
-                # If single entry is requested we must clear the NextEntryOffset
-                searchResult[nItem]['NextEntryOffset'] = 0
-            data = searchResult[nItem].getData()
-            lenData = len(data)
-            padLen = (8 - (lenData % 8)) % 8
-
-            # For larger directory we might reach the OutputBufferLength so we need to set 
-            # the NextEntryOffset to 0 for the last entry the will fit the buffer
+        while location < len(files):
             try:
-                # Check if the next data will exceed the OutputBufferLength
-                nextData = searchResult[nItem + 1].getData()
-                lenNextData = len(nextData)
-                nextTotalData = totalData + lenData + padLen + lenNextData
-                if nextTotalData >= queryDirectoryRequest['OutputBufferLength']:
-                    # Set the NextEntryOffset to 0 and get the data again
-                    searchResult[nItem]['NextEntryOffset'] = 0
-                    data = searchResult[nItem].getData()
-            except IndexError:
-                pass
-
-            if (totalData + lenData) >= queryDirectoryRequest['OutputBufferLength']:
-                connData['OpenedFiles'][fileID]['Open']['EnumerationLocation'] -= 1
+                entry = findEntry(files[location], queryDirectoryRequest['FileInformationClass'])
+            except FileNotFoundError:
+                # Removed since the directory was listed
+                location += 1
+                continue
+
+            data = entry.getData()
+            if totalData + len(data) > queryDirectoryRequest['OutputBufferLength']:
+                # The rest goes in the next QUERY_DIRECTORY
                 break
-            else:
-                respData += data + b'\x00' * padLen
-                totalData += lenData + padLen
+
+            entries.append(data)
+            totalData += entry['NextEntryOffset']
+            location += 1
 
             if queryDirectoryRequest['Flags'] & smb2.SL_RETURN_SINGLE_ENTRY:
                 break
 
-        if connData['OpenedFiles'][fileID]['Open']['EnumerationLocation'] >= searchCount:
-            connData['OpenedFiles'][fileID]['Open']['EnumerationLocation'] = -1
+        if len(entries) == 0 and location < len(files):
+            # Not even one entry fits the buffer
+            return [smb2.SMB2Error()], None, STATUS_INFO_LENGTH_MISMATCH
+
+        if location >= len(files):
+            location = -1
+            connData['OpenedFiles'][fileID]['Open']['EnumerationFiles'] = []
+        connData['OpenedFiles'][fileID]['Open']['EnumerationLocation'] = location
+
+        if len(entries) == 0:
+            return [smb2.SMB2Error()], None, STATUS_NO_MORE_FILES
+
+        # Entries are padded up to their NextEntryOffset, but the last one ends the list
+        respData = b''.join(data + b'\x00' * ((8 - (len(data) % 8)) % 8) for data in entries[:-1])
+        respData += b'\x00' * 4 + entries[-1][4:]
 
         respSMBCommand['OutputBufferOffset'] = 0x48
-        respSMBCommand['OutputBufferLength'] = totalData
+        respSMBCommand['OutputBufferLength'] = len(respData)
         respSMBCommand['Buffer'] = respData
 
         smbServer.setConnectionData(connId, connData)
-        return [respSMBCommand], None, errorCode
+        return [respSMBCommand], None, STATUS_SUCCESS
 
     @staticmethod
     def smb2ChangeNotify(connId, smbServer, recvPacket):
@@ -4140,15 +4426,64 @@ class Ioctls:
 
         validateNegotiateInfo = smb2.VALIDATE_NEGOTIATE_INFO(ioctlRequest['Buffer'])
         validateNegotiateInfoResponse = smb2.VALIDATE_NEGOTIATE_INFO_RESPONSE()
-        validateNegotiateInfoResponse['Capabilities'] = 0
+        validateNegotiateInfoResponse['Capabilities'] = connData['ServerCapabilities']
         validateNegotiateInfoResponse['Guid'] = b'A' * 16
-        validateNegotiateInfoResponse['SecurityMode'] = 1
-        validateNegotiateInfoResponse['Dialect'] = smb2.SMB2_DIALECT_002
+        validateNegotiateInfoResponse['SecurityMode'] = smb2.SMB2_NEGOTIATE_SIGNING_ENABLED
+        validateNegotiateInfoResponse['Dialect'] = connData['Dialect']
 
         smbServer.setConnectionData(connId, connData)
         return validateNegotiateInfoResponse.getData(), errorCode
 
 
+class SMBConnectionData(dict):
+    """
+    State of a client connection, owned by the handler serving it.
+
+    It keeps the mapping interface used by the command handlers (and by anyone hooking commands), so
+    connData['OpenedFiles'] and friends work as always, and it is updated in place.
+
+    Known keys:
+        ClientIP, ClientPort: Client address.
+        Uid, Pid: Session and process ids handed to the client.
+        Authenticated: Whether the session setup finished.
+        ConnectedShares: Tree id to share configuration.
+        OpenedFiles: File id to open file information.
+        SIDs: Pending FIND_FIRST2 results, by search id.
+        SignatureEnabled, SigningSessionKey, SigningChallengeResponse: Signing state.
+        Dialect, ServerCapabilities, MaxIOSize, Credits: Negotiated SMB2/3 parameters.
+        PreauthIntegrityHashValue, SessionPreauthIntegrityHashValue: SMB 3.1.1 preauth integrity hashes.
+
+    :param str connId: Connection identifier.
+    :param str ip: Client address.
+    :param int port: Client port.
+    """
+    __slots__ = ('connId',)
+
+    def __init__(self, connId, ip, port):
+        dict.__init__(self)
+        self.connId = connId
+        self['PacketNum'] = 0
+        self['ClientIP'] = ip
+        self['ClientPort'] = port
+        self['Uid'] = 0
+        self['ConnectedShares'] = {}
+        self['OpenedFiles'] = {}
+        # SID results for findfirst2
+        self['SIDs'] = {}
+        self['SignatureEnabled'] = False
+        self['SigningChallengeResponse'] = ''
+        self['SigningSessionKey'] = b''
+        self['Authenticated'] = False
+        # SMB2/3 negotiated dialect and credits available to the client
+        self['Dialect'] = smb2.SMB2_DIALECT_002
+        self['ServerCapabilities'] = 0
+        self['MaxIOSize'] = 65536
+        self['Credits'] = 1
+        # SMB 3.1.1 preauth integrity hashes (connection and in-progress session setup)
+        self['PreauthIntegrityHashValue'] = b'\x00' * 64
+        self['SessionPreauthIntegrityHashValue'] = None
+
+
 class SMBSERVERHandler(socketserver.BaseRequestHandler):
     def __init__(self, request, client_address, server, select_poll=False):
         self.__SMB = server
@@ -4163,12 +4498,12 @@ class SMBSERVERHandler(socketserver.BaseRequestHandler):
 
     def handle(self):
         self.__SMB.log("Incoming connection (%s,%d)" % (self.__ip, self.__port))
-        self.__SMB.addConnection(self.__connId, self.__ip, self.__port)
+        connData = self.__SMB.addConnection(self.__connId, self.__ip, self.__port)
+        session = nmb.NetBIOSTCPSession(self.__SMB.getServerName(), 'HOST', self.__ip, sess_port=self.__port,
+                                        sock=self.__request, select_poll=self.__select_poll)
         while True:
             try:
                 # First of all let's get the NETBIOS packet
-                session = nmb.NetBIOSTCPSession(self.__SMB.getServerName(), 'HOST', self.__ip, sess_port=self.__port,
-                                                sock=self.__request, select_poll=self.__select_poll)
                 try:
                     p = session.recv_packet(self.__timeOut)
                 except nmb.NetBIOSTimeout:
@@ -4188,11 +4523,13 @@ class SMBSERVERHandler(socketserver.BaseRequestHandler):
                     r.set_trailer(p.get_trailer())
                     self.__request.send(r.rawData())
                 else:
-                    resp = self.__SMB.processRequest(self.__connId, p.get_trailer())
+                    resp = self.__SMB.processRequest(self.__connId, p.get_trailer(), connData)
                     # Send all the packets received. Except for big transactions this should be
                     # a single packet
                     for i in resp:
-                        if hasattr(i, 'getData'):
+                        if isinstance(i, SMB2FileRegion):
+                            self.__sendFileRegion(i)
+                        elif hasattr(i, 'getData'):
                             session.send_packet(i.getData())
                         else:
                             session.send_packet(i)
@@ -4202,6 +4539,15 @@ class SMBSERVERHandler(socketserver.BaseRequestHandler):
                 traceback.print_exc()
                 break
 
+    def __sendFileRegion(self, fileRegion):
+        try:
+            while fileRegion.send(self.__request) is False:
+                _, writable, _ = select.select([], [self.__request], [], self.__timeOut)
+                if len(writable) == 0:
+                    raise nmb.NetBIOSTimeout
+        finally:
+            fileRegion.close()
+
     def finish(self):
         # Thread/process is dying, we should tell the main SMB thread to remove all this thread data
         self.__SMB.log("Closing down connection (%s,%d)" % (self.__ip, self.__port))
@@ -4261,6 +4607,10 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
         # SMB2 Support flag = default not active
         self.__SMB2Support = False
+        # Highest SMB2/3 dialect negotiated and max READ/WRITE size (SMB 2.1 onwards)
+        self.__SMB2MaxDialect = smb2.SMB2_DIALECT_311
+        self.__SMB2MaxIOSize = 8 * 1024 * 1024
+        self.__directoryCache = DirectoryCache()
 
         self.__dropSSP = False
         # Kerberos Support flag
@@ -4372,8 +4722,10 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
             0xFF: self.__smb2CommandsHandler.default
         }
 
-        # List of active connections
+        # Active connections, by connection id. Only needed to find a connection from another one, every
+        # handler keeps its own SMBConnectionData
         self.__activeConnections = {}
+        self.__activeConnectionsLock = threading.Lock()
 
     def getIoctls(self):
         return self.__smb2Ioctls
@@ -4382,38 +4734,34 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
         return self.__credentials
 
     def removeConnection(self, name):
-        try:
-            del (self.__activeConnections[name])
-        except:
-            pass
-        self.log("Remaining connections %s" % list(self.__activeConnections.keys()))
+        with self.__activeConnectionsLock:
+            self.__activeConnections.pop(name, None)
+            remaining = list(self.__activeConnections.keys())
+        self.log("Remaining connections %s" % remaining)
 
     def addConnection(self, name, ip, port):
-        self.__activeConnections[name] = {}
-        # Let's init with some know stuff we will need to have
-        # TODO: Document what's in there
-        # print "Current Connections", self.__activeConnections.keys()
-        self.__activeConnections[name]['PacketNum'] = 0
-        self.__activeConnections[name]['ClientIP'] = ip
-        self.__activeConnections[name]['ClientPort'] = port
-        self.__activeConnections[name]['Uid'] = 0
-        self.__activeConnections[name]['ConnectedShares'] = {}
-        self.__activeConnections[name]['OpenedFiles'] = {}
-        # SID results for findfirst2
-        self.__activeConnections[name]['SIDs'] = {}
-        self.__activeConnections[name]['LastRequest'] = {}
-        self.__activeConnections[name]['SignatureEnabled'] = False
-        self.__activeConnections[name]['SigningChallengeResponse'] = ''
-        self.__activeConnections[name]['SigningSessionKey'] = b''
-        self.__activeConnections[name]['Authenticated'] = False
+        """
+        Registers a new connection.
+
+        :return: The SMBConnectionData for the connection, to be kept by its handler.
+        """
+        connData = SMBConnectionData(name, ip, port)
+        with self.__activeConnectionsLock:
+            self.__activeConnections[name] = connData
+        return connData
 
     def getActiveConnections(self):
         return self.__activeConnections
 
     def setConnectionData(self, connId, data):
-        self.__activeConnections[connId] = data
-        # print "setConnectionData"
-        # print self.__activeConnections
+        connData = self.__activeConnections.get(connId)
+        if connData is None:
+            with self.__activeConnectionsLock:
+                self.__activeConnections[connId] = data
+        elif connData is not data:
+            # Someone built their own, keep the object the handler has
+            connData.clear()
+            connData.update(data)
 
     def getConnectionData(self, connId, checkStatus=True):
         conn = self.__activeConnections[connId]
@@ -4427,6 +4775,12 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
         return self.__registeredNamedPipes
 
     def registerNamedPipe(self, pipeName, address):
+        """
+        Registers a named pipe served by the IPC$ share
+
+        :param string pipeName: the pipe name (e.g. srvsvc)
+        :param address: either a DCERPCServer answering it in-process, or the (host, port) of a DCERPC listener
+        """
         self.__registeredNamedPipes[str(pipeName)] = address
         return True
 
@@ -4611,6 +4965,15 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
     def getKerberosSupport(self):
         return self.__KerberosSupport
 
+    def getSMB2MaxDialect(self):
+        return self.__SMB2MaxDialect
+
+    def getSMB2MaxIOSize(self):
+        return self.__SMB2MaxIOSize
+
+    def getDirectoryCache(self):
+        return self.__directoryCache
+
     def getNTLMSupport(self):
         return self.__NTLMSupport
 
@@ -4653,34 +5016,70 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
         packet['SecurityFeatures'] = m.digest()[:8]
         connData['SignSequenceNumber'] += 2
 
-    def signSMBv2(self, packet, signingSessionKey, padLength=0):
+    def signSMBv2(self, packet, signingSessionKey, padLength=0, dialect=smb2.SMB2_DIALECT_002):
         packet['Signature'] = b'\x00' * 16
         packet['Flags'] |= smb2.SMB2_FLAGS_SIGNED
         packetData = packet.getData() + b'\x00' * padLength
-        signature = hmac.new(signingSessionKey, packetData, hashlib.sha256).digest()
-        packet['Signature'] = signature[:16]
+        if dialect >= smb2.SMB2_DIALECT_30:
+            # SMB 3.x, signingSessionKey is the derived signing key
+            packet['Signature'] = CMAC.new(signingSessionKey, packetData, ciphermod=AES).digest()
+        else:
+            signature = hmac.new(signingSessionKey, packetData, hashlib.sha256).digest()
+            packet['Signature'] = signature[:16]
         # print "%s" % packet['Signature'].encode('hex')
 
-    def processRequest(self, connId, data):
-
-        # TODO: Process batched commands.
-        isSMB2 = False
-        SMBCommand = None
-        try:
+    def __grantCredits(self, connData, packet):
+        """
+        Returns the credits granted to the client in the answer for packet, keeping track of the ones
+        it has available. Clients get what they ask for, as long as they don't go over SMB2_MAX_CREDITS.
+        """
+        if connData['Dialect'] == smb2.SMB2_DIALECT_002:
+            creditCharge = 1
+        else:
+            creditCharge = max(1, packet['CreditCharge'])
+        available = max(0, connData['Credits'] - creditCharge)
+        granted = min(max(1, packet['CreditRequestResponse']), SMB2_MAX_CREDITS - available)
+        if available == 0:
+            # The client must always be able to send another request
+            granted = max(1, granted)
+        connData['Credits'] = available + granted
+        return granted
+
+    def __updatePreauthIntegrityHash(self, connData, key, data):
+        calculatedHash = hashlib.sha512()
+        calculatedHash.update(connData[key])
+        calculatedHash.update(data)
+        connData[key] = calculatedHash.digest()
+
+    def processRequest(self, connId, data, connData=None):
+        """
+        Processes a request (or a chain of compounded ones) and returns the answers to send back.
+
+        :param str connId: Connection identifier.
+        :param bytes data: NetBIOS session packet payload.
+        :param SMBConnectionData connData: State of the connection, looked up by connId if not given.
+        """
+        # The protocol id tells us how to parse the packet
+        protocolId = data[:4]
+        if protocolId == SMB2_PROTOCOL_ID:
+            isSMB2 = True
+            SMBCommand = None
+            packet = smb2.SMB2Packet(data=data)
+        elif protocolId == SMB1_PROTOCOL_ID:
+            isSMB2 = False
             packet = smb.NewSMBPacket(data=data)
             SMBCommand = smb.SMBCommand(packet['Data'][0])
-        except:
-            # Maybe a SMB2 packet?
-            packet = smb2.SMB2Packet(data=data)
-            connData = self.getConnectionData(connId, False)
-            self.signSMBv2(packet, connData['SigningSessionKey'])
-            isSMB2 = True
+        else:
+            # Encryption is never negotiated, so SMB2 TRANSFORM_HEADER packets (\xfdSMB) are not expected either
+            raise Exception('Unknown protocol id %r' % protocolId)
 
-        connData = self.getConnectionData(connId, False)
+        if connData is None:
+            connData = self.getConnectionData(connId, False)
 
         # We might have compound requests
         compoundedPacketsResponse = []
         compoundedPackets = []
+        rawRequests = []
         try:
             # Search out list of implemented commands
             # We provide them with:
@@ -4765,36 +5164,88 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
                 compoundedPackets.append(packet)
 
             else:
-                # Is the client authenticated already?
-                if connData['Authenticated'] is False and packet['Command'] not in (
-                smb2.SMB2_NEGOTIATE, smb2.SMB2_SESSION_SETUP):
-                    # Nope.. in that case he should only ask for a few commands, if not throw him out.
-                    errorCode = STATUS_ACCESS_DENIED
-                    respPackets = None
-                    respCommands = ['']
-                    compoundedPacketsResponse.append((respCommands, respPackets, errorCode))
-                    compoundedPackets.append(packet)
-                else:
-                    done = False
-                    while not done:
-                        if packet['Command'] in self.__smb2Commands:
-                            if self.__SMB2Support is True:
-                                respCommands, respPackets, errorCode = self.__smb2Commands[packet['Command']](
-                                    connId,
-                                    self,
-                                    packet)
-                            else:
-                                respCommands, respPackets, errorCode = self.__smb2Commands[255](connId, self, packet)
+                # State inherited by the related requests of a compound chain
+                chainSessionID = chainTreeID = chainFileID = None
+                chainStatus = STATUS_SUCCESS
+                done = False
+                while not done:
+                    if packet['NextCommand'] != 0:
+                        rawRequest = data[:packet['NextCommand']]
+                    else:
+                        rawRequest = data
+                    if connData['Dialect'] == smb2.SMB2_DIALECT_311 and packet['Command'] == smb2.SMB2_SESSION_SETUP:
+                        # Session keys depend on every SESSION_SETUP request, including this one
+                        if connData['SessionPreauthIntegrityHashValue'] is None:
+                            connData['SessionPreauthIntegrityHashValue'] = connData['PreauthIntegrityHashValue']
+                        self.__updatePreauthIntegrityHash(connData, 'SessionPreauthIntegrityHashValue', rawRequest)
+                    rawRequests.append(rawRequest)
+
+                    fileIDOffset = SMB2_FILEID_OFFSETS.get(packet['Command'])
+                    related = len(compoundedPackets) > 0 and packet['Flags'] & smb2.SMB2_FLAGS_RELATED_OPERATIONS
+                    chainFailed = False
+                    if related:
+                        packet['SessionID'] = chainSessionID
+                        packet['TreeID'] = chainTreeID
+                        if fileIDOffset is not None and \
+                                packet['Data'][fileIDOffset:fileIDOffset + 16] == SMB2_RELATED_FILEID:
+                            if chainStatus != STATUS_SUCCESS:
+                                # The operation that should have given us the FileId failed, so does this one
+                                chainFailed = True
+                            elif chainFileID is not None:
+                                packet['Data'] = packet['Data'][:fileIDOffset] + chainFileID + \
+                                                 packet['Data'][fileIDOffset + 16:]
+
+                    # Is the client authenticated already?
+                    if connData['Authenticated'] is False and packet['Command'] not in (
+                    smb2.SMB2_NEGOTIATE, smb2.SMB2_SESSION_SETUP):
+                        # Nope.. in that case he should only ask for a few commands, if not throw him out.
+                        errorCode = STATUS_ACCESS_DENIED
+                        respPackets = None
+                        respCommands = [smb2.SMB2Error()]
+                    elif chainFailed is True:
+                        errorCode = chainStatus
+                        respPackets = None
+                        respCommands = [smb2.SMB2Error()]
+                    elif packet['Command'] in self.__smb2Commands:
+                        if self.__SMB2Support is True:
+                            respCommands, respPackets, errorCode = self.__smb2Commands[packet['Command']](
+                                connId,
+                                self,
+                                packet)
                         else:
                             respCommands, respPackets, errorCode = self.__smb2Commands[255](connId, self, packet)
-                        # Let's store the result for this compounded packet
-                        compoundedPacketsResponse.append((respCommands, respPackets, errorCode))
-                        compoundedPackets.append(packet)
-                        if packet['NextCommand'] != 0:
-                            data = data[packet['NextCommand']:]
-                            packet = smb2.SMB2Packet(data=data)
-                        else:
-                            done = True
+                    else:
+                        respCommands, respPackets, errorCode = self.__smb2Commands[255](connId, self, packet)
+                    # Let's store the result for this compounded packet
+                    compoundedPacketsResponse.append((respCommands, respPackets, errorCode))
+                    compoundedPackets.append(packet)
+
+                    # And what the next request of the chain will inherit
+                    chainStatus = errorCode
+                    chainSessionID = connData['Uid']
+                    if respPackets is not None and len(respPackets) > 0:
+                        chainTreeID = respPackets[-1]['TreeID']
+                    else:
+                        chainTreeID = packet['TreeID']
+                    if errorCode == STATUS_SUCCESS and packet['Command'] == smb2.SMB2_CREATE:
+                        chainFileID = respCommands[0]['FileID']
+                    elif fileIDOffset is not None:
+                        chainFileID = packet['Data'][fileIDOffset:fileIDOffset + 16]
+
+                    if packet['NextCommand'] != 0:
+                        # Later requests of the chain might close the file, so READ answers can't wait to be
+                        # sent straight from it
+                        for respCommand in respCommands or ():
+                            fileRegion = getattr(respCommand, 'fileRegion', None)
+                            if fileRegion is not None:
+                                fileHandle, offset, length = fileRegion
+                                content = readFileRange(fileHandle, offset, length)
+                                respCommand['Buffer'] = content + b'\x00' * (length - len(content))
+                                respCommand.fileRegion = None
+                        data = data[packet['NextCommand']:]
+                        packet = smb2.SMB2Packet(data=data)
+                    else:
+                        done = True
 
         except Exception as e:
             # import traceback
@@ -4804,8 +5255,6 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
             raise
 
         # We prepare the response packet to commands don't need to bother about that.
-        connData = self.getConnectionData(connId, False)
-
         # Force reconnection loop.. This is just a test.. client will send me back credentials :)
         # connData['PacketNum'] += 1
         # if connData['PacketNum'] == 15:
@@ -4823,6 +5272,8 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
         self.setConnectionData(connId, connData)
 
         packetsToSend = []
+        # Answers whose payload is still in a file (SMB2 READ), by index in packetsToSend
+        fileRegions = {}
         for packetNum in range(len(compoundedPacketsResponse)):
             respCommands, respPackets, errorCode = compoundedPacketsResponse[packetNum]
             packet = compoundedPackets[packetNum]
@@ -4858,9 +5309,8 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
                         packetsToSend.append(respPacket)
                     else:
                         respPacket = smb2.SMB2Packet()
-                        respPacket['Flags'] = smb2.SMB2_FLAGS_SERVER_TO_REDIR
-                        if packetNum > 0:
-                            respPacket['Flags'] |= smb2.SMB2_FLAGS_RELATED_OPERATIONS
+                        respPacket['Flags'] = smb2.SMB2_FLAGS_SERVER_TO_REDIR | \
+                                              packet['Flags'] & smb2.SMB2_FLAGS_RELATED_OPERATIONS
                         respPacket['Status'] = errorCode
                         respPacket['CreditRequestResponse'] = packet['CreditRequestResponse']
                         respPacket['Command'] = packet['Command']
@@ -4876,31 +5326,71 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
                             respPacket['Data'] = str(respCommand)
 
                         packetsToSend.append(respPacket)
+                        fileRegions[len(packetsToSend) - 1] = getattr(respCommand, 'fileRegion', None)
             else:
                 # The SMBCommand took care of building the packet
-                packetsToSend = respPackets
+                if isinstance(packet, smb2.SMB2Packet):
+                    for respPacket in respPackets:
+                        respPacket['Flags'] |= packet['Flags'] & smb2.SMB2_FLAGS_RELATED_OPERATIONS
+                packetsToSend.extend(respPackets)
 
         if isSMB2 is True:
             # Let's build a compound answer and sign it
             finalData = []
             totalPackets = len(packetsToSend)
+            # A single unsigned answer can be sent straight from the file, otherwise we need its content
+            zeroCopy = totalPackets == 1 and connData['SignatureEnabled'] is False
             for idx, packet in enumerate(packetsToSend):
-                padLen = -len(packet) % 8
+                fileRegion = fileRegions.get(idx)
+                if fileRegion is not None and zeroCopy is False:
+                    fileHandle, offset, length = fileRegion
+                    content = readFileRange(fileHandle, offset, length)
+                    packet['Data'] = packet['Data'] + content + b'\x00' * (length - len(content))
+                    fileRegion = None
+
+                if fileRegion is not None:
+                    padLen = -(len(packet) + fileRegion[2]) % 8
+                else:
+                    padLen = -len(packet) % 8
                 if idx + 1 < totalPackets:
                     packet['NextCommand'] = len(packet) + padLen
 
+                if hasattr(packet, 'getData') and idx < len(compoundedPackets):
+                    if isinstance(compoundedPackets[idx], smb2.SMB2Packet):
+                        packet['CreditRequestResponse'] = self.__grantCredits(connData, compoundedPackets[idx])
+                    else:
+                        # SMB1 NEGOTIATE answered with SMB2
+                        packet['CreditRequestResponse'] = 1
+
                 if connData['SignatureEnabled']:
-                    self.signSMBv2(packet, connData['SigningSessionKey'], padLength=padLen)
+                    self.signSMBv2(packet, connData['SigningSessionKey'], padLength=padLen, dialect=connData['Dialect'])
 
-                if hasattr(packet, 'getData'):
+                if fileRegion is not None:
+                    fileHandle, offset, length = fileRegion
+                    finalData.append(SMB2FileRegion(packet.getData(), fileHandle, offset, length, padLen))
+                elif hasattr(packet, 'getData'):
                     finalData.append(packet.getData() + padLen * b'\x00')
                 else:
                     finalData.append(packet + padLen * b'\x00')
 
-            packetsToSend = [b"".join(finalData)]
-
-        # We clear the compound requests
-        connData['LastRequest'] = {}
+            if zeroCopy is True:
+                packetsToSend = finalData
+            else:
+                packetsToSend = [b"".join(finalData)]
+
+            if connData['Dialect'] == smb2.SMB2_DIALECT_311 and len(rawRequests) == 1:
+                command = compoundedPackets[0]['Command']
+                if command == smb2.SMB2_NEGOTIATE:
+                    connData['PreauthIntegrityHashValue'] = b'\x00' * 64
+                    self.__updatePreauthIntegrityHash(connData, 'PreauthIntegrityHashValue', rawRequests[0])
+                    self.__updatePreauthIntegrityHash(connData, 'PreauthIntegrityHashValue', packetsToSend[0])
+                elif command == smb2.SMB2_SESSION_SETUP:
+                    if compoundedPacketsResponse[0][2] == STATUS_MORE_PROCESSING_REQUIRED:
+                        self.__updatePreauthIntegrityHash(connData, 'SessionPreauthIntegrityHashValue',
+                                                          packetsToSend[0])
+                    else:
+                        # Session setup finished, the next one starts from the connection hash again
+                        connData['SessionPreauthIntegrityHashValue'] = None
 
         return packetsToSend
 
@@ -4943,6 +5433,16 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
         else:
             self.__SMB2Support = False
 
+        if self.__serverConfig.has_option("global", "SMB2MaxDialect"):
+            self.__SMB2MaxDialect = SMB2_DIALECTS[self.__serverConfig.get("global", "SMB2MaxDialect")]
+        else:
+            self.__SMB2MaxDialect = smb2.SMB2_DIALECT_311
+
+        if self.__serverConfig.has_option("global", "SMB2MaxIOSize"):
+            self.__SMB2MaxIOSize = self.__serverConfig.getint("global", "SMB2MaxIOSize")
+        else:
+            self.__SMB2MaxIOSize = 8 * 1024 * 1024
+
         if self.__serverConfig.has_option("global", "DropSSP"):
             self.__dropSSP = self.__serverConfig.getboolean("global", "DropSSP")
         else:
@@ -5015,6 +5515,323 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
         }
 
 
+class AsyncSMBSERVERConnection:
+    """
+    State of a client connection handled by AsyncSMBSERVER: the NetBIOS framing buffers and the
+    requests waiting to be processed. Only one request per connection is processed at a time, so
+    answers are sent in order.
+    """
+    def __init__(self, connId, sock, address):
+        self.connId = connId
+        self.sock = sock
+        self.ip, self.port = address[:2]
+        self.inBuffer = bytearray()
+        self.outBuffers = collections.deque()
+        self.requests = collections.deque()
+        self.busy = False
+        self.closing = False
+        self.lastActivity = time.time()
+        self.connData = None
+
+    def pendingOutput(self):
+        return len(self.outBuffers) > 0
+
+    def queuePacket(self, packetType, data):
+        length = len(data)
+        if packetType == nmb.NETBIOS_SESSION_MESSAGE:
+            header = struct.pack('!BBH', packetType, (length >> 16) & 0xff, length & 0xffff)
+        else:
+            header = struct.pack('!BBH', packetType, 0, length)
+        self.outBuffers.append(memoryview(header + data))
+
+    def parsePackets(self):
+        # Extracts every complete NetBIOS session packet from the input buffer as (type, trailer) tuples
+        packets = []
+        offset = 0
+        while len(self.inBuffer) - offset >= 4:
+            packetType, flags, length = struct.unpack_from('!BBH', self.inBuffer, offset)
+            if packetType == nmb.NETBIOS_SESSION_MESSAGE:
+                length |= flags << 16
+            elif flags & 0x01:
+                length |= 0x10000
+            if len(self.inBuffer) - offset - 4 < length:
+                break
+            packets.append((packetType, bytes(self.inBuffer[offset + 4:offset + 4 + length])))
+            offset += 4 + length
+        if offset > 0:
+            del self.inBuffer[:offset]
+        return packets
+
+
+class AsyncSMBSERVER(SMBSERVER):
+    """
+    Event loop (selectors) based SMBSERVER. Instead of a thread per client, a single thread multiplexes
+    every connection, doing the NetBIOS framing and driving the same SMBCommands/SMB2Commands handlers
+    through processRequest(). Requests can optionally be processed by a pool of worker threads, so
+    blocking filesystem or named pipe operations don't stall the rest of the connections.
+
+    :param tuple server_address: Address and port to listen on.
+    :param int workers: Number of worker threads processing requests. 0 processes them in the event loop.
+    :param int maxOutputBuffer: A connection isn't read while it has more than this bytes pending to be sent.
+    """
+    # Seconds a connection can be idle before being closed
+    CONNECTION_TIMEOUT = 60 * 5
+
+    def __init__(self, server_address, handler_class=SMBSERVERHandler, config_parser=None, ipv6=False, workers=4,
+                 maxOutputBuffer=4 * 1024 * 1024):
+        self.__workers = workers
+        self.__maxOutputBuffer = maxOutputBuffer
+        self.__pool = None
+        self.__selector = None
+        self.__connections = {}
+        self.__completed = collections.deque()
+        self.__connCounter = 0
+        self.__shutdownRequest = False
+        self.__isShutDown = threading.Event()
+        self.__isShutDown.set()
+        self.__loopThread = None
+        self.__wakeupRead, self.__wakeupWrite = socket.socketpair()
+        self.__wakeupRead.setblocking(False)
+        self.__wakeupWrite.setblocking(False)
+        SMBSERVER.__init__(self, server_address, handler_class, config_parser, ipv6)
+
+    def getConnectionsCount(self):
+        return len(self.__connections)
+
+    def __wakeup(self):
+        try:
+            self.__wakeupWrite.send(b'\x00')
+        except (BlockingIOError, OSError):
+            # Already signaled (or shutting down)
+            pass
+
+    def serve_forever(self, poll_interval=0.5):
+        self.__isShutDown.clear()
+        self.__loopThread = threading.current_thread()
+        if self.__workers > 0:
+            from concurrent.futures import ThreadPoolExecutor
+            self.__pool = ThreadPoolExecutor(max_workers=self.__workers)
+
+        self.__selector = selectors.DefaultSelector()
+        self.socket.setblocking(False)
+        self.__selector.register(self.socket, selectors.EVENT_READ, None)
+        self.__selector.register(self.__wakeupRead, selectors.EVENT_READ, None)
+        lastTimeoutCheck = time.time()
+        try:
+            while not self.__shutdownRequest:
+                for key, events in self.__selector.select(poll_interval):
+                    if key.fileobj is self.socket:
+                        self.__accept()
+                    elif key.fileobj is self.__wakeupRead:
+                        try:
+                            while self.__wakeupRead.recv(4096):
+                                pass
+                        except (BlockingIOError, OSError):
+                            pass
+                    else:
+                        conn = key.data
+                        if conn.sock is None:
+                            # Closed while handling a previous event
+                            continue
+                        try:
+                            if events & selectors.EVENT_READ:
+                                self.__read(conn)
+                            if events & selectors.EVENT_WRITE and conn.sock is not None:
+                                self.__write(conn)
+                        except Exception as e:
+                            # A broken client must not take the whole server down
+                            self.log("Handle: %s" % e)
+                            self.__closeConnection(conn)
+                self.__processCompleted()
+                if time.time() - lastTimeoutCheck > poll_interval:
+                    lastTimeoutCheck = time.time()
+                    self.__checkTimeouts()
+        finally:
+            for conn in list(self.__connections.values()):
+                self.__closeConnection(conn)
+            self.__selector.close()
+            self.__selector = None
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=True)
+                self.__pool = None
+            self.__loopThread = None
+            self.__shutdownRequest = False
+            self.__isShutDown.set()
+
+    def shutdown(self):
+        self.__shutdownRequest = True
+        self.__wakeup()
+        if self.__loopThread is not threading.current_thread():
+            self.__isShutDown.wait()
+
+    def server_close(self):
+        if self.__loopThread is not None:
+            self.shutdown()
+        SMBSERVER.server_close(self)
+        self.__wakeupRead.close()
+        self.__wakeupWrite.close()
+
+    def __accept(self):
+        try:
+            sock, address = self.socket.accept()
+        except (BlockingIOError, OSError):
+            return
+        if self.verify_request(sock, address) is False:
+            sock.close()
+            return
+        sock.setblocking(False)
+        self.__connCounter += 1
+        connId = 'Conn-%d' % self.__connCounter
+        conn = AsyncSMBSERVERConnection(connId, sock, address)
+        self.__connections[connId] = conn
+        self.__selector.register(sock, selectors.EVENT_READ, conn)
+        self.log("Incoming connection (%s,%d)" % (conn.ip, conn.port))
+        conn.connData = self.addConnection(connId, conn.ip, conn.port)
+
+    def __closeConnection(self, conn):
+        if conn.sock is None:
+            return
+        self.log("Closing down connection (%s,%d)" % (conn.ip, conn.port))
+        try:
+            self.__selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        conn.sock = None
+        for buf in conn.outBuffers:
+            if isinstance(buf, SMB2FileRegion):
+                buf.close()
+        conn.outBuffers.clear()
+        self.__connections.pop(conn.connId, None)
+        if conn.busy is False:
+            self.removeConnection(conn.connId)
+        else:
+            # A worker is still processing a request, connection data will be removed once it finishes
+            conn.closing = True
+
+    def __updateEvents(self, conn):
+        if conn.sock is None:
+            return
+        events = 0
+        outputSize = sum(len(buf) for buf in conn.outBuffers)
+        if outputSize < self.__maxOutputBuffer:
+            events |= selectors.EVENT_READ
+        if outputSize > 0:
+            events |= selectors.EVENT_WRITE
+        self.__selector.modify(conn.sock, events, conn)
+
+    def __read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.log("Handle: %s" % e)
+            self.__closeConnection(conn)
+            return
+        if len(data) == 0:
+            self.__closeConnection(conn)
+            return
+        conn.lastActivity = time.time()
+        conn.inBuffer += data
+
+        for packetType, trailer in conn.parsePackets():
+            if packetType == nmb.NETBIOS_SESSION_REQUEST:
+                # Someone is requesting a session, we're gonna accept them all :)
+                _, rn, my = trailer.split(b' ')
+                remote_name = nmb.decode_name(b'\x20' + rn)
+                myname = nmb.decode_name(b'\x20' + my)
+                self.log("NetBIOS Session request (%s,%s,%s)" % (conn.ip, remote_name[1].strip(), myname[1]))
+                conn.queuePacket(nmb.NETBIOS_SESSION_POSITIVE_RESPONSE, trailer)
+            elif packetType == nmb.NETBIOS_SESSION_KEEP_ALIVE:
+                continue
+            else:
+                conn.requests.append(trailer)
+
+        self.__dispatch(conn)
+        self.__updateEvents(conn)
+
+    def __write(self, conn):
+        while conn.pendingOutput():
+            buf = conn.outBuffers[0]
+            if isinstance(buf, SMB2FileRegion):
+                try:
+                    if buf.send(conn.sock) is False:
+                        break
+                except OSError as e:
+                    self.log("Handle: %s" % e)
+                    self.__closeConnection(conn)
+                    return
+                conn.outBuffers.popleft()
+                continue
+            try:
+                sent = conn.sock.send(buf)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.log("Handle: %s" % e)
+                self.__closeConnection(conn)
+                return
+            if sent < len(buf):
+                conn.outBuffers[0] = buf[sent:]
+                break
+            conn.outBuffers.popleft()
+        self.__updateEvents(conn)
+
+    def __dispatch(self, conn):
+        while conn.busy is False and len(conn.requests) > 0 and conn.sock is not None:
+            data = conn.requests.popleft()
+            conn.busy = True
+            if self.__pool is None:
+                self.__handleResponse(*self.__process(conn, data))
+            else:
+                self.__pool.submit(self.__processAndSignal, conn, data)
+
+    def __process(self, conn, data):
+        try:
+            return conn, self.processRequest(conn.connId, data, conn.connData), None
+        except Exception as e:
+            return conn, None, e
+
+    def __processAndSignal(self, conn, data):
+        self.__completed.append(self.__process(conn, data))
+        self.__wakeup()
+
+    def __handleResponse(self, conn, resp, error):
+        conn.busy = False
+        if conn.sock is None:
+            if conn.closing is True:
+                self.removeConnection(conn.connId)
+            return
+        if error is not None:
+            self.log("Handle: %s" % error)
+            self.__closeConnection(conn)
+            return
+        # Send all the packets received. Except for big transactions this should be
+        # a single packet
+        for i in resp:
+            if isinstance(i, SMB2FileRegion):
+                conn.outBuffers.append(i)
+            elif hasattr(i, 'getData'):
+                conn.queuePacket(nmb.NETBIOS_SESSION_MESSAGE, i.getData())
+            else:
+                conn.queuePacket(nmb.NETBIOS_SESSION_MESSAGE, i)
+
+    def __processCompleted(self):
+        while len(self.__completed) > 0:
+            conn = self.__completed[0][0]
+            self.__handleResponse(*self.__completed.popleft())
+            self.__dispatch(conn)
+            self.__updateEvents(conn)
+
+    def __checkTimeouts(self):
+        now = time.time()
+        for conn in list(self.__connections.values()):
+            if conn.busy is False and now - conn.lastActivity > self.CONNECTION_TIMEOUT:
+                self.log("Connection (%s,%d) timed out" % (conn.ip, conn.port))
+                self.__closeConnection(conn)
+
+
 # For windows platforms, opening a directory is not an option, so we set a void FD
 VOID_FILE_DESCRIPTOR = -1
 PIPE_FILE_DESCRIPTOR = -2
@@ -5208,20 +6025,17 @@ class SimpleSMBServer:
         # Now we have to register the MS-SRVS server. This specially important for
         # Windows 7+ and Mavericks clients since they WON'T (specially OSX)
         # ask for shares using MS-RAP.
+        # Both are answered in-process, so no threads are started for them.
 
         self.__srvsServer = SRVSServer()
-        self.__srvsServer.daemon=True
         self.__wkstServer = WKSTServer()
-        self.__wkstServer.daemon=True
-        self.__server.registerNamedPipe('srvsvc', ('127.0.0.1', self.__srvsServer.getListenPort()))
-        self.__server.registerNamedPipe('wkssvc', ('127.0.0.1', self.__wkstServer.getListenPort()))
+        self.__server.registerNamedPipe('srvsvc', self.__srvsServer)
+        self.__server.registerNamedPipe('wkssvc', self.__wkstServer)
 
     def getServer(self):
         return self.__server
 
     def start(self):
-        self.__srvsServer.start()
-        self.__wkstServer.start()
         self.__server.serve_forever()
 
     def stop(self):
@@ -5298,6 +6112,24 @@ class SimpleSMBServer:
         self.__server.setServerConfig(self.__smbConfig)
         self.__server.processConfigFile()
 
+    def setSMB2MaxDialect(self, value):
+        """
+        Sets the highest dialect negotiated with SMB2 clients ('2.0.2', '2.1', '3.0', '3.0.2' or '3.1.1')
+        """
+        if value not in SMB2_DIALECTS:
+            raise Exception("Unknown SMB2 dialect %s" % value)
+        self.__smbConfig.set("global", "SMB2MaxDialect", value)
+        self.__server.setServerConfig(self.__smbConfig)
+        self.__server.processConfigFile()
+
+    def setSMB2MaxIOSize(self, value):
+        """
+        Sets the max READ/WRITE/transaction size advertised to SMB 2.1+ clients
+        """
+        self.__smbConfig.set("global", "SMB2MaxIOSize", str(value))
+        self.__server.setServerConfig(self.__smbConfig)
+        self.__server.processConfigFile()
+
     def setNTLMSupport(self, value):
         if value is True:
             self.__smbConfig.set("global", "NTLMSupport", "True")
@@ -24,10 +24,13 @@
 
 from __future__ import division
 from __future__ import print_function
-import sys
 import re
-from binascii import unhexlify
-from struct import unpack
+import json
+import mmap
+from binascii import unhexlify, hexlify
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from struct import unpack, unpack_from, iter_unpack, pack
 import ntpath
 from six import b
 from abc import ABC, abstractmethod
@@ -47,6 +50,29 @@ REG_DWORD       = 0x04
 REG_MULTISZ     = 0x07
 REG_QWORD       = 0x0b
 
+REG_TYPE_NAMES = {
+    REG_NONE: 'REG_NONE',
+    REG_SZ: 'REG_SZ',
+    REG_EXPAND_SZ: 'REG_EXPAND_SZ',
+    REG_BINARY: 'REG_BINARY',
+    REG_DWORD: 'REG_DWORD',
+    REG_MULTISZ: 'REG_MULTI_SZ',
+    REG_QWORD: 'REG_QWORD',
+}
+
+# Names stored as ASCII (Latin-1) instead of UTF-16LE
+KEY_COMP_NAME   = 0x20
+VALUE_COMP_NAME = 0x01
+
+# The hbins start right after the base block, cell offsets are relative to it
+HBIN_START      = 0x1000
+HBIN_HEADER_SIZE = 0x20
+# NameLength and KeyName offsets within a nk cell
+NK_NAME_LENGTH_OFFSET = 0x48
+NK_NAME_OFFSET  = 0x4c
+# Values bigger than a segment are stored in big data (db) cells, as a list of segments
+BIG_DATA_SEGMENT_SIZE = 16344
+
 # Structs
 class REG_REGF(Structure):
     structure = (
@@ -163,6 +189,56 @@ StructMappings = {b'nk': REG_NK,
                   b'sk': REG_SK,
                  }
 
+# Decoded cells kept in the cell cache, the ones that are parsed over and over when looking keys up
+CACHED_CELLS = (b'nk', b'vk', b'sk')
+
+class REG_FILE:
+    """
+    Storage backend reading the hive through a file object (seek and read). It's used for remote hives
+    (secretsdump's RemoteFile already keeps a block cache), and for local ones that can't be mapped.
+
+    :param fd: the opened file object, owned by the caller.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+
+    def read(self, offset, length):
+        self.fd.seek(offset, 0)
+        return self.fd.read(length)
+
+    def write(self, offset, data):
+        self.fd.seek(offset, 0)
+        written = self.fd.write(data)
+        self.fd.flush()
+        return written
+
+    def getSize(self):
+        self.fd.seek(0, 2)
+        return self.fd.tell()
+
+    def close(self):
+        pass
+
+class REG_MMAP_FILE(REG_FILE):
+    """
+    Storage backend for local hives, mapped in memory so cells are just sliced out of the map. Writes still go
+    through the file object, the map sees them once flushed.
+
+    :param fd: the opened file object, owned by the caller.
+    """
+    def __init__(self, fd):
+        REG_FILE.__init__(self, fd)
+        self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, offset, length):
+        return self.map[offset:offset+length]
+
+    def getSize(self):
+        return len(self.map)
+
+    def close(self):
+        self.map.close()
+
 class Registry(ABC):
     def close(self):
         if hasattr(self, 'fd'):
@@ -179,6 +255,12 @@ class Registry(ABC):
     def findKey(self, key):
         pass
 
+    def findKeys(self, keys):
+        """
+        Returns the keys for a list of paths, None for the ones that aren't found.
+        """
+        return [self.findKey(key) for key in keys]
+
     @abstractmethod
     def printValue(self, valueType, valueData):
         pass
@@ -200,14 +282,36 @@ class Registry(ABC):
         pass
 
 class saveRegistryParser(Registry):
-    def __init__(self, hive, isRemote = False):
+    """
+    Binary (regf) hive parser
+
+    :param hive: the hive path or, if isRemote is True, a file object with open(), seek(), read() and close()
+        (e.g. secretsdump's RemoteFile).
+    :param bool isRemote: whether hive is a file object instead of a path.
+    :param int cellCacheSize: the maximum number of decoded NK, VK and SK cells kept in memory.
+    :param int subKeyIndexSize: the maximum number of keys whose subkeys are indexed by name (the index of a key
+        is built the first time one of its subkeys is looked up). 0 looks subkeys up through the hash lists.
+    """
+    def __init__(self, hive, isRemote = False, cellCacheSize = 4096, subKeyIndexSize = 256):
+        self.__storage = None
         self.__hive = hive
+        self.__cellCacheSize = cellCacheSize
+        self.__cellCache = OrderedDict()
+        self.__subKeyIndexSize = subKeyIndexSize
+        self.__subKeyIndex = OrderedDict()
         if isRemote is True:
             self.fd = self.__hive
             self.__hive.open()
+            self.__storage = REG_FILE(self.fd)
         else:
             self.fd = open(hive,'r+b')
-        data = self.fd.read(4096)
+            try:
+                self.__storage = REG_MMAP_FILE(self.fd)
+            except (ValueError, OSError) as e:
+                # Empty files, or filesystems not supporting it
+                LOG.debug('Cannot map %s (%s), reading it instead' % (hive, e))
+                self.__storage = REG_FILE(self.fd)
+        data = self.__storage.read(0, HBIN_START)
         self.__regf = REG_REGF(data)
         self.indent = ''
         self.rootKey = self.__findRootKey()
@@ -216,83 +320,90 @@ class saveRegistryParser(Registry):
         elif self.__regf['MajorVersion'] != 1 and self.__regf['MinorVersion'] > 5:
             LOG.warning("Unsupported version (%d.%d) - things might not work!" % (self.__regf['MajorVersion'], self.__regf['MinorVersion']))
 
+    def close(self):
+        if self.__storage is not None:
+            self.__storage.close()
+            self.__storage = None
+        self.__cellCache.clear()
+        self.__subKeyIndex.clear()
+        Registry.close(self)
+
     def __findRootKey(self):
-        self.fd.seek(0,0)
-        data = self.fd.read(4096)
-        while len(data) > 0:
-            try:
-                hbin = REG_HBIN(data[:0x20])
-                # Read the remaining bytes for this hbin
-                data += self.fd.read(hbin['OffsetNextHBin']-4096)
-                data = data[0x20:]
-                blocks = self.__processDataBlocks(data)
-                for block in blocks:
-                    if isinstance(block, REG_NK):
-                        if block['Type'] == ROOT_KEY:
-                            return block
-            except Exception as e:
-                pass
-            data = self.fd.read(4096)
+        # The base block points to the root key
+        rootKey = self.__getBlock(self.__regf['OffsetFirstRecord'])
+        if isinstance(rootKey, REG_NK) and rootKey['Type'] == ROOT_KEY:
+            return rootKey
+
+        # Otherwise, look for it hbin by hbin
+        LOG.debug('Root key not found at 0x%x, scanning the hbins' % self.__regf['OffsetFirstRecord'])
+        fileSize = self.__storage.getSize()
+        hbinOffset = HBIN_START
+        while hbinOffset + HBIN_HEADER_SIZE <= fileSize:
+            hbin = self.__storage.read(hbinOffset, HBIN_HEADER_SIZE)
+            hbinSize = unpack('<L', hbin[8:12])[0]
+            if hbin[:4] != b'hbin' or hbinSize < HBIN_HEADER_SIZE:
+                hbinOffset += 4096
+                continue
+            cellOffset = hbinOffset + HBIN_HEADER_SIZE
+            hbinEnd = min(hbinOffset + hbinSize, fileSize)
+            while cellOffset + 8 <= hbinEnd:
+                cellSize, magic, cellType = unpack('<l2sH', self.__storage.read(cellOffset, 8))
+                if cellSize == 0:
+                    break
+                if magic == b'nk' and cellType == ROOT_KEY:
+                    return self.__getBlock(cellOffset - HBIN_START)
+                cellOffset += abs(cellSize)
+            hbinOffset += hbinSize
 
         return None
 
+    def __getCell(self, offset):
+        # Returns the data of the cell at offset, without its size
+        sizeBytes = self.__storage.read(HBIN_START+offset, 4)
+        if len(sizeBytes) < 4:
+            return b''
+        # Allocated cells have a negative size
+        return self.__storage.read(HBIN_START+offset+4, abs(unpack('<l', sizeBytes)[0])-4)
 
     def __getBlock(self, offset):
-        self.fd.seek(4096+offset,0)
-        sizeBytes = self.fd.read(4)
-        data = sizeBytes + self.fd.read(unpack('<l',sizeBytes)[0]*-1-4)
+        # Decoded cells are kept in a LRU cache, parents are looked up over and over
+        block = self.__cellCache.get(offset)
+        if block is not None:
+            self.__cellCache.move_to_end(offset)
+            return block
+
+        data = self.__getCell(offset)
         if len(data) == 0:
             return None
+
+        magic = data[:2]
+        if magic in StructMappings:
+            block = StructMappings[magic](data)
         else:
-            block = REG_HBINBLOCK(data)
-            if block['Data'][:2] in StructMappings:
-                return StructMappings[block['Data'][:2]](block['Data'])
-            else:
-                LOG.debug("Unknown type 0x%s" % block['Data'][:2])
-                return block
-            return None
+            LOG.debug("Unknown type 0x%s" % magic)
+            return REG_HBINBLOCK(pack('<l', -len(data)-4) + data)
+
+        if magic in CACHED_CELLS and self.__cellCacheSize > 0:
+            self.__cellCache[offset] = block
+            if len(self.__cellCache) > self.__cellCacheSize:
+                self.__cellCache.popitem(last=False)
+        return block
 
     def __getValueBlocks(self, offset, count):
-        valueList = []
         res = []
-        self.fd.seek(4096+offset,0)
-        for i in range(count):
-            valueList.append(unpack('<l',self.fd.read(4))[0])
-
-        for valueOffset in valueList:
+        # count includes the size of the value list cell, that's skipped as it's negative
+        data = self.__storage.read(HBIN_START+offset, count*4)
+        for valueOffset, in iter_unpack('<l', data[:len(data) & ~3]):
             if valueOffset > 0:
                 block = self.__getBlock(valueOffset)
                 res.append(block)
         return res
 
     def __getData(self, offset, count):
-        self.fd.seek(4096+offset, 0)
-        return self.fd.read(count)[4:]
+        return self.__storage.read(HBIN_START+offset+4, count-4)
     
     def __setData(self, offset, value):
-        self.fd.seek(4096+offset+4, 0)
-        return self.fd.write(value)
-
-    def __processDataBlocks(self,data):
-        res = []
-        while len(data) > 0:
-            #blockSize = unpack('<l',data[:calcsize('l')])[0]
-            blockSize = unpack('<l',data[:4])[0]
-            block = REG_HBINBLOCK()
-            if blockSize > 0:
-                tmpList = list(block.structure)
-                tmpList[1] = ('_Data','_-Data','self["DataBlockSize"]-4')
-                block.structure =  tuple(tmpList)
-
-            block.fromString(data)
-            blockLen = len(block)
-
-            if block['Data'][:2] in StructMappings:
-                block = StructMappings[block['Data'][:2]](block['Data'])
-
-            res.append(block)
-            data = data[blockLen:]
-        return res
+        return self.__storage.write(HBIN_START+offset+4, value)
 
     def __getValueData(self, rec):
         # We should receive a VK record
@@ -302,7 +413,7 @@ class saveRegistryParser(Registry):
             # if DataLen < 5 the value itself is stored in the Offset field
             return rec['OffsetData']
         else:
-            return self.__getData(rec['OffsetData'], rec['DataLen']+4)
+            return self.__getValueBytes(rec)
     
     def __setValueData(self, rec, value):
         if len(value) != rec['DataLen']:
@@ -328,117 +439,205 @@ class saveRegistryParser(Registry):
             res += ord(bb)
         return res % 0x100000000
 
-    def __compareHash(self, magic, hashData, key):
-        if magic == 'lf':
-            hashRec = REG_HASH(hashData)
-            if hashRec['KeyName'].strip(b'\x00') == b(key[:4]):
-                return hashRec['OffsetNk']
-        elif magic == 'lh':
-            hashRec = REG_HASH(hashData)
-            if unpack('<L',hashRec['KeyName'])[0] == self.__getLhHash(key):
-                return hashRec['OffsetNk']
-        elif magic == 'ri':
-            # Special case here, don't know exactly why, an ri pointing to a NK :-o
-            offset = unpack('<L', hashData[:4])[0]
-            nk = self.__getBlock(offset)
-            if nk['KeyName'] == key:
-                return offset
-        else:
-            LOG.critical("UNKNOWN Magic %s" % magic)
-            sys.exit(1)
+    @staticmethod
+    def __decodeKeyName(keyType, keyName):
+        # Compressed names are stored as latin-1, the rest as UTF-16LE
+        if keyType & KEY_COMP_NAME:
+            return keyName.decode('latin-1')
+        return keyName.decode('utf-16le', 'replace')
+
+    def __getKeyName(self, offset):
+        # Just the name of the nk cell at offset, without decoding the whole cell
+        nk = self.__cellCache.get(offset)
+        if nk is not None:
+            return self.__decodeKeyName(nk['Type'], nk['KeyName'])
+        header = self.__storage.read(HBIN_START+offset+4, NK_NAME_OFFSET)
+        keyType = unpack_from('<H', header, 2)[0]
+        nameLength = unpack_from('<H', header, NK_NAME_LENGTH_OFFSET)[0]
+        return self.__decodeKeyName(keyType, self.__storage.read(HBIN_START+offset+4+NK_NAME_OFFSET, nameLength))
+
+    def __getSubKeyLists(self, parentKey):
+        # Yields the (magic, data) of the lf/lh/li lists holding the subkeys of parentKey, following ri lists
+        if parentKey['NumSubKeys'] == 0 or parentKey['OffsetSubKeyLf'] < 0:
+            return
+        lists = [parentKey['OffsetSubKeyLf']]
+        while len(lists) > 0:
+            data = self.__getCell(lists.pop())
+            magic, numKeys = unpack('<2sH', data[:4])
+            if magic == b'ri':
+                # ri points to lf/lh records, pushed in reverse to keep the order
+                lists.extend(offset for offset, in reversed(list(iter_unpack('<L', data[4:4+numKeys*4]))))
+            elif magic in (b'lf', b'lh'):
+                yield magic, data[4:4+numKeys*8]
+            elif magic == b'li':
+                yield magic, data[4:4+numKeys*4]
+            else:
+                LOG.debug("Unknown subkey list type 0x%s" % magic)
 
-        return None
+    def __getSubKeyOffsets(self, parentKey):
+        offsets = []
+        for magic, data in self.__getSubKeyLists(parentKey):
+            if magic == b'li':
+                offsets.extend(offset for offset, in iter_unpack('<L', data))
+            else:
+                offsets.extend(offset for offset, _ in iter_unpack('<L4s', data))
+        return offsets
+
+    def __getSubKeyIndex(self, parentKey):
+        # Name -> offset of the subkeys, kept in a LRU cache by subkey list offset (there's one per parent key)
+        listOffset = parentKey['OffsetSubKeyLf']
+        index = self.__subKeyIndex.get(listOffset)
+        if index is not None:
+            self.__subKeyIndex.move_to_end(listOffset)
+            return index
+
+        index = {}
+        for offset in self.__getSubKeyOffsets(parentKey):
+            index[self.__getKeyName(offset)] = offset
+        self.__subKeyIndex[listOffset] = index
+        if len(self.__subKeyIndex) > self.__subKeyIndexSize:
+            self.__subKeyIndex.popitem(last=False)
+        return index
 
     def __findSubKey(self, parentKey, subKey):
-        lf = self.__getBlock(parentKey['OffsetSubKeyLf'])
-        if lf is not None:
-            data = lf['HashRecords']
-            # Let's search the hash records for the name
-            if lf['Magic'] == 'ri':
-                # ri points to lf/lh records, so we must parse them before
-                records = b''
-                for i in range(lf['NumKeys']):
-                    offset = unpack('<L', data[:4])[0]
-                    l = self.__getBlock(offset)
-                    records = records + l['HashRecords'][:l['NumKeys']*8]
-                    data = data[4:]
-                data = records
-
-            #for record in range(lf['NumKeys']):
-            for record in range(parentKey['NumSubKeys']):
-                hashRec = data[:8]
-                res = self.__compareHash(lf['Magic'], hashRec, subKey)
-                if res is not None:
-                    # We have a match, now let's check the whole record
-                    nk = self.__getBlock(res)
-                    if nk['KeyName'].decode('utf-8') == subKey:
-                        return nk
-                data = data[8:]
+        if parentKey['NumSubKeys'] == 0 or parentKey['OffsetSubKeyLf'] < 0:
+            return None
+
+        if self.__subKeyIndexSize > 0:
+            offset = self.__getSubKeyIndex(parentKey).get(subKey)
+            if offset is not None:
+                return self.__getBlock(offset)
+            return None
+
+        # Let's search the hash records for the name, lf hints are only checked for ASCII names
+        lhHash = self.__getLhHash(subKey)
+        try:
+            hint = subKey[:4].encode('ascii')
+        except UnicodeEncodeError:
+            hint = None
+        for magic, data in self.__getSubKeyLists(parentKey):
+            if magic == b'li':
+                candidates = (offset for offset, in iter_unpack('<L', data))
+            elif magic == b'lh':
+                candidates = (offset for offset, hashValue in iter_unpack('<LL', data) if hashValue == lhHash)
+            else:
+                candidates = (offset for offset, keyHint in iter_unpack('<L4s', data)
+                              if hint is None or keyHint.strip(b'\x00') == hint)
+            for offset in candidates:
+                # We have a match, now let's check the whole name
+                if self.__getKeyName(offset) == subKey:
+                    return self.__getBlock(offset)
 
         return None
 
-    def __walkSubNodes(self, rec):
-        nk = self.__getBlock(rec['OffsetNk'])
-        if isinstance(nk, REG_NK):
-            print("%s%s" % (self.indent, nk['KeyName'].decode('utf-8')))
-            self.indent += '  '
-            if nk['OffsetSubKeyLf'] < 0:
-                self.indent = self.indent[:-2]
-                return
-            lf = self.__getBlock(nk['OffsetSubKeyLf'])
-        else:
-            lf = nk
-
-        data = lf['HashRecords']
-
-        if lf['Magic'] == 'ri':
-            # ri points to lf/lh records, so we must parse them before
-            records = ''
-            for i in range(lf['NumKeys']):
-                offset = unpack('<L', data[:4])[0]
-                l = self.__getBlock(offset)
-                records = records + l['HashRecords'][:l['NumKeys']*8]
-                data = data[4:]
-            data = records
-
-        for key in range(lf['NumKeys']):
-            hashRec = REG_HASH(data[:8])
-            self.__walkSubNodes(hashRec)
-            data = data[8:]
-
-        if isinstance(nk, REG_NK):
-            self.indent = self.indent[:-2]
+    def __getValueBytes(self, rec):
+        # Like __getValueData, but always returning the value bytes
+        if rec['DataLen'] < 0:
+            # Stored in the Offset field, the high bit of DataLen is set
+            return pack('<L', rec['OffsetData'])[:rec['DataLen'] & 0x7fffffff]
+        elif rec['DataLen'] == 0:
+            return b''
+        elif rec['DataLen'] > BIG_DATA_SEGMENT_SIZE:
+            cell = self.__getCell(rec['OffsetData'])
+            if cell[:2] == b'db':
+                return self.__getBigData(cell, rec['DataLen'])
+        return self.__getData(rec['OffsetData'], rec['DataLen']+4)
+
+    def __getBigData(self, cell, dataLen):
+        # A db cell has the number of segments and the offset of the cell listing them
+        numSegments, segmentListOffset = unpack_from('<HL', cell, 2)
+        segmentList = self.__getCell(segmentListOffset)[:numSegments*4]
+        # Segment cells come with their padding
+        data = b''.join(self.__getCell(segmentOffset)[:BIG_DATA_SEGMENT_SIZE]
+                        for segmentOffset, in iter_unpack('<L', segmentList[:len(segmentList) & ~3]))
+        if len(data) < dataLen:
+            LOG.error('Big data value truncated, %d bytes out of %d' % (len(data), dataLen))
+        return data[:dataLen]
+
+    def walkKeys(self, parentKey='\\', withValues=True):
+        """
+        Walks the key and everything below it, without recursion. Keys are yielded parent first, subkeys in the
+        order they're stored (sorted by name).
 
-    def walk(self, parentKey):
-        key = self.findKey(parentKey)
+        :param str parentKey: path of the key to start from.
+        :param bool withValues: whether the values are read, if False None is yielded instead.
 
-        if key is None or key['OffsetSubKeyLf'] < 0:
+        :return: a generator of (path, key, values) tuples, where path is the key path from the root key ('' for
+            the root key itself), key the REG_NK record and values a list of (name, valueType, valueData bytes)
+            with an empty name for the default value.
+        """
+        key = self.findKey(parentKey)
+        if key is None:
             return
 
-        lf = self.__getBlock(key['OffsetSubKeyLf'])
-        data = lf['HashRecords']
-        for record in range(lf['NumKeys']):
-            hashRec = REG_HASH(data[:8])
-            self.__walkSubNodes(hashRec)
-            data = data[8:]
+        stack = [('\\'.join(self.__splitKey(parentKey)), key)]
+        while len(stack) > 0:
+            path, key = stack.pop()
+            values = None
+            if withValues is True:
+                values = []
+                if key['NumValues'] > 0:
+                    for value in self.__getValueBlocks(key['OffsetValueList'], key['NumValues']+1):
+                        if value['Flag'] & VALUE_COMP_NAME:
+                            name = value['Name'].decode('latin-1')
+                        else:
+                            name = value['Name'].decode('utf-16le', 'replace')
+                        values.append((name, value['ValueType'], self.__getValueBytes(value)))
+            yield path, key, values
+
+            # Pushed in reverse, so they're popped in order
+            for offset in reversed(self.__getSubKeyOffsets(key)):
+                subKey = self.__getBlock(offset)
+                if not isinstance(subKey, REG_NK):
+                    LOG.debug("Subkey at 0x%x is not a nk record" % offset)
+                    continue
+                name = self.__decodeKeyName(subKey['Type'], subKey['KeyName'])
+                stack.append((path + '\\' + name if len(path) > 0 else name, subKey))
 
-    def findKey(self, key):
-        # Let's strip '\' from the beginning, except for the case of
+    def walk(self, parentKey):
+        baseDepth = None
+        for path, key, _ in self.walkKeys(parentKey, withValues=False):
+            depth = path.count('\\') + 1 if len(path) > 0 else 0
+            if baseDepth is None:
+                # The key itself isn't printed
+                baseDepth = depth
+                continue
+            print("%s%s" % ('  ' * (depth - baseDepth - 1), path.rsplit('\\', 1)[-1]))
+
+    def __splitKey(self, key):
+        # Let's strip '\\' from the beginning, except for the case of
         # only asking for the root node
         if key[0] == '\\' and len(key) > 1:
             key = key[1:]
 
-        parentKey = self.rootKey
-        if len(key) > 0 and key[0]!='\\':
-            for subKey in key.split('\\'):
-                res = self.__findSubKey(parentKey, subKey)
-                if res is not None:
-                    parentKey = res
-                else:
-                    #LOG.error("Key %s not found!" % key)
-                    return None
+        if len(key) > 0 and key[0] != '\\':
+            return tuple(key.split('\\'))
+        return ()
 
-        return parentKey
+    def findKey(self, key):
+        return self.findKeys([key])[0]
+
+    def findKeys(self, keys):
+        """
+        Returns the keys for a list of paths, None for the ones that aren't found. Every parent key is looked up
+        once, so paths sharing a prefix (e.g. the values read from ControlSet001) don't walk it again.
+        """
+        resolved = {(): self.rootKey}
+        res = []
+        for key in keys:
+            path = self.__splitKey(key)
+            # Start from the longest prefix already looked up
+            depth = len(path)
+            while path[:depth] not in resolved:
+                depth -= 1
+            parentKey = resolved[path[:depth]]
+            while parentKey is not None and depth < len(path):
+                parentKey = self.__findSubKey(parentKey, path[depth])
+                depth += 1
+                resolved[path[:depth]] = parentKey
+            res.append(parentKey)
+
+        return res
 
     def printValue(self, valueType, valueData):
         if valueType in [REG_SZ, REG_EXPAND_SZ, REG_MULTISZ]:
@@ -469,26 +668,9 @@ class saveRegistryParser(Registry):
     def enumKey(self, parentKey):
         res = []
         # If we're here.. we have a valid NK record for the key
-        # Now let's searcht the subkeys
-        if parentKey['NumSubKeys'] > 0:
-            lf = self.__getBlock(parentKey['OffsetSubKeyLf'])
-            data = lf['HashRecords']
-
-            if lf['Magic'] == 'ri':
-                # ri points to lf/lh records, so we must parse them before
-                records = ''
-                for i in range(lf['NumKeys']):
-                    offset = unpack('<L', data[:4])[0]
-                    l = self.__getBlock(offset)
-                    records = records + l['HashRecords'][:l['NumKeys']*8]
-                    data = data[4:]
-                data = records
-
-            for i in range(parentKey['NumSubKeys']):
-                hashRec = REG_HASH(data[:8])
-                nk = self.__getBlock(hashRec['OffsetNk'])
-                data = data[8:]
-                res.append('%s'%nk['KeyName'].decode('utf-8'))
+        # Now let's search the subkeys
+        for offset in self.__getSubKeyOffsets(parentKey):
+            res.append(self.__getKeyName(offset))
         return res
 
     def enumValues(self,key):
@@ -772,6 +954,93 @@ class exportRegistryParser(Registry):
         # Export format does not contain class name
         return None
 
+def decodeValueData(valueType, valueData):
+    """
+    Returns the value bytes as a JSON friendly object: strings for REG_SZ and REG_EXPAND_SZ, a list of them for
+    REG_MULTI_SZ, integers for REG_DWORD and REG_QWORD, and a hex string for everything else.
+    """
+    try:
+        if valueType in (REG_SZ, REG_EXPAND_SZ):
+            return valueData.decode('utf-16le').rstrip('\x00')
+        elif valueType == REG_MULTISZ:
+            strings = valueData.decode('utf-16le').rstrip('\x00')
+            return strings.split('\x00') if len(strings) > 0 else []
+    except UnicodeDecodeError:
+        pass
+    if valueType == REG_DWORD and len(valueData) == 4:
+        return unpack('<L', valueData)[0]
+    elif valueType == REG_QWORD and len(valueData) == 8:
+        return unpack('<Q', valueData)[0]
+    return hexlify(valueData).decode('utf-8')
+
+def formatRegValue(name, valueType, valueData):
+    """
+    Returns the .reg file (regedit 5) line for a value, an empty name being the default value.
+    """
+    def escape(string):
+        return string.replace('\\', '\\\\').replace('"', '\\"')
+
+    line = '"%s"=' % escape(name) if len(name) > 0 else '@='
+    if valueType == REG_SZ:
+        try:
+            return line + '"%s"' % escape(valueData.decode('utf-16le').rstrip('\x00'))
+        except UnicodeDecodeError:
+            pass
+    elif valueType == REG_DWORD and len(valueData) == 4:
+        return line + 'dword:%08x' % unpack('<L', valueData)[0]
+
+    hexData = ','.join('%02x' % byte for byte in bytearray(valueData))
+    if valueType == REG_BINARY:
+        return line + 'hex:' + hexData
+    return line + 'hex(%x):' % valueType + hexData
+
+def exportRegFile(reg, fd, parentKey='\\', rootName=None):
+    """
+    Writes a key and everything below it in .reg file (regedit 5) format, as it's walked. regedit expects the
+    file UTF-16LE encoded, with a BOM and CRLF line endings.
+
+    :param saveRegistryParser reg: the opened hive.
+    :param file fd: text file object where the keys are written.
+    :param str parentKey: path of the key to export.
+    :param str rootName: path the keys are written under (e.g. HKEY_LOCAL_MACHINE\\SYSTEM), the root key name
+        if None.
+
+    :return: the number of keys written.
+    """
+    if rootName is None:
+        rootName = reg.rootKey['KeyName'].decode('utf-8')
+    fd.write('Windows Registry Editor Version 5.00\n\n')
+    keys = 0
+    for path, key, values in reg.walkKeys(parentKey):
+        lines = ['[%s]' % (rootName + '\\' + path if len(path) > 0 else rootName)]
+        lines.extend(formatRegValue(*value) for value in values)
+        fd.write('\n'.join(lines) + '\n\n')
+        keys += 1
+    return keys
+
+def exportJsonLines(reg, fd, parentKey='\\'):
+    """
+    Writes a key and everything below it as JSON lines, one object per key with its path, last write time and
+    values (see decodeValueData), as it's walked.
+
+    :param saveRegistryParser reg: the opened hive.
+    :param file fd: text file object where the keys are written.
+    :param str parentKey: path of the key to export.
+
+    :return: the number of keys written.
+    """
+    keys = 0
+    for path, key, values in reg.walkKeys(parentKey):
+        lastWrite = datetime(1601, 1, 1) + timedelta(microseconds=key['lastChange'] // 10)
+        fd.write(json.dumps({
+            'path': path,
+            'last_write': lastWrite.isoformat(),
+            'values': [{'name': name, 'type': REG_TYPE_NAMES.get(valueType, valueType),
+                        'data': decodeValueData(valueType, valueData)} for name, valueType, valueData in values],
+        }) + '\n')
+        keys += 1
+    return keys
+
 # Factory function to create the appropriate registry parser
 def get_registry_parser(hive, isRemote=False):
     """
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Throughput and latency benchmarks for the SMB server and client. A SimpleSMBServer
+#   is started on loopback sharing a synthetic tree, and driven by one or more
+#   SMBConnection clients running one of these workloads:
+#
+#     read:   sequential reads of a big file
+#     write:  sequential writes of a big file
+#     small:  reads of many small files (open, read and close every one of them)
+#     list:   listing of a big directory
+#     rpc:    NetrShareEnum calls through the srvsvc named pipe
+#
+#   Every result is printed as a JSON line with MB/s, ops/s and p50/p99 latencies, so
+#   runs can be compared to catch regressions. No network access is needed.
+#
+#   Example:
+#   python -m tests.SMB_RPC.benchmark_smbserver -workloads read list -clients 4 -output results.json
+#
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from io import BytesIO
+from os.path import join
+from threading import Thread
+
+from impacket.dcerpc.v5 import transport, srvs
+from impacket.smb import SMB_DIALECT
+from impacket.smb3structs import SMB2_DIALECT_002, SMB2_DIALECT_21, SMB2_DIALECT_30, SMB2_DIALECT_311, \
+    FILE_READ_DATA
+from impacket.smbconnection import SMBConnection, compute_lmhash, compute_nthash
+from impacket.smbserver import SimpleSMBServer, SMBSERVER, AsyncSMBSERVER
+
+WORKLOADS = ('read', 'write', 'small', 'list', 'rpc')
+
+DIALECTS = {
+    'smb1': SMB_DIALECT,
+    '2.0.2': SMB2_DIALECT_002,
+    '2.1': SMB2_DIALECT_21,
+    '3.0': SMB2_DIALECT_30,
+    '3.1.1': SMB2_DIALECT_311,
+}
+
+SERVERS = {
+    'threaded': SMBSERVER,
+    'eventloop': AsyncSMBSERVER,
+}
+
+SHARE_NAME = 'BENCH'
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+
+def percentile(values, fraction):
+    """
+    Returns the value below which the given fraction of the (sorted) values fall.
+    """
+    if len(values) == 0:
+        return 0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class SMBServerBenchmark:
+    """
+    Runs benchmark workloads against a local SimpleSMBServer
+
+    :param str address: Address to listen on.
+    :param int port: Port to listen on.
+    :param str server: Server implementation, one of SERVERS.
+    :param str dialect: Dialect asked by the clients, one of DIALECTS (None to let them negotiate).
+    :param int fileSize: Size, in bytes, of the file used by the read and write workloads.
+    :param int smallFiles: Number of files used by the small workload.
+    :param int smallFileSize: Size, in bytes, of every small file.
+    :param int listFiles: Number of entries in the directory used by the list workload.
+    :param int blockSize: Size of every read/write request.
+    """
+    def __init__(self, address='127.0.0.1', port=14450, server='threaded', dialect=None, fileSize=64 * 1024 * 1024,
+                 smallFiles=500, smallFileSize=4096, listFiles=10000, blockSize=1024 * 1024):
+        self.__address = address
+        self.__port = port
+        self.__serverClass = SERVERS[server]
+        self.__serverName = server
+        self.__dialectName = dialect
+        self.__dialect = DIALECTS[dialect] if dialect is not None else None
+        self.__fileSize = fileSize
+        self.__smallFiles = smallFiles
+        self.__smallFileSize = smallFileSize
+        self.__listFiles = listFiles
+        self.__blockSize = blockSize
+
+        self.__sharePath = None
+        self.__server = None
+        self.__serverThread = None
+
+    def setUp(self):
+        """
+        Creates the shared tree and starts the server.
+        """
+        self.__sharePath = tempfile.mkdtemp(prefix='smbbench')
+        block = os.urandom(1024 * 1024)
+        with open(join(self.__sharePath, 'big.bin'), 'wb') as fd:
+            remaining = self.__fileSize
+            while remaining > 0:
+                fd.write(block[:remaining])
+                remaining -= len(block)
+
+        os.mkdir(join(self.__sharePath, 'small'))
+        for i in range(self.__smallFiles):
+            with open(join(self.__sharePath, 'small', 'file%06d.bin' % i), 'wb') as fd:
+                fd.write(block[:self.__smallFileSize])
+
+        os.mkdir(join(self.__sharePath, 'list'))
+        for i in range(self.__listFiles):
+            open(join(self.__sharePath, 'list', 'entry_%06d.txt' % i), 'w').close()
+
+        self.__server = SimpleSMBServer(listenAddress=self.__address, listenPort=self.__port,
+                                        smbserverclass=self.__serverClass)
+        self.__server.addCredential(USERNAME, 0, compute_lmhash(PASSWORD), compute_nthash(PASSWORD))
+        self.__server.addShare(SHARE_NAME, self.__sharePath)
+        self.__server.setSMB2Support(True)
+        self.__server.setLogFile('/dev/null' if os.name != 'nt' else 'NUL')
+        # Daemon, so a server that doesn't stop can't keep the interpreter alive
+        self.__serverThread = Thread(target=self.__server.start)
+        self.__serverThread.daemon = True
+        self.__serverThread.start()
+
+        # Wait for the server to accept connections
+        for _ in range(100):
+            try:
+                self.getClient().close()
+                break
+            except Exception:
+                time.sleep(0.1)
+
+    def tearDown(self):
+        if self.__server is not None:
+            self.__server.getServer().shutdown()
+            self.__server.stop()
+            self.__serverThread.join(10)
+            self.__server = None
+        if self.__sharePath is not None:
+            shutil.rmtree(self.__sharePath)
+            self.__sharePath = None
+
+    def getClient(self):
+        client = SMBConnection(self.__address, self.__address, sess_port=self.__port,
+                               preferredDialect=self.__dialect)
+        client.login(USERNAME, PASSWORD)
+        return client
+
+    def __read(self, client, clientNum):
+        latencies = []
+        tid = client.connectTree(SHARE_NAME)
+        fid = client.openFile(tid, 'big.bin', desiredAccess=FILE_READ_DATA)
+        try:
+            offset = 0
+            while offset < self.__fileSize:
+                start = time.perf_counter()
+                data = client.readFile(tid, fid, offset, self.__blockSize, singleCall=False)
+                latencies.append(time.perf_counter() - start)
+                offset += len(data)
+        finally:
+            client.closeFile(tid, fid)
+            client.disconnectTree(tid)
+        return latencies, offset
+
+    def __write(self, client, clientNum):
+        latencies = []
+        data = os.urandom(self.__blockSize)
+        fileName = 'upload%d.bin' % clientNum
+        tid = client.connectTree(SHARE_NAME)
+        fid = client.createFile(tid, fileName)
+        try:
+            offset = 0
+            while offset < self.__fileSize:
+                # The last chunk is clamped, so exactly fileSize bytes are written
+                chunk = data[:self.__fileSize - offset]
+                start = time.perf_counter()
+                client.writeFile(tid, fid, chunk, offset)
+                latencies.append(time.perf_counter() - start)
+                offset += len(chunk)
+        finally:
+            client.closeFile(tid, fid)
+            client.deleteFile(SHARE_NAME, fileName)
+            client.disconnectTree(tid)
+        return latencies, offset
+
+    def __small(self, client, clientNum):
+        latencies = []
+        totalBytes = 0
+        for i in range(self.__smallFiles):
+            output = BytesIO()
+            start = time.perf_counter()
+            client.getFile(SHARE_NAME, 'small\\file%06d.bin' % i, output.write)
+            latencies.append(time.perf_counter() - start)
+            totalBytes += len(output.getvalue())
+        return latencies, totalBytes
+
+    def __list(self, client, clientNum):
+        start = time.perf_counter()
+        entries = client.listPath(SHARE_NAME, 'list\\*')
+        return [time.perf_counter() - start], len(entries)
+
+    def __rpc(self, client, clientNum, calls=50):
+        latencies = []
+        rpctransport = transport.SMBTransport(client.getRemoteName(), client.getRemoteHost(), filename=r'\srvsvc',
+                                              smb_connection=client)
+        dce = rpctransport.get_dce_rpc()
+        dce.connect()
+        dce.bind(srvs.MSRPC_UUID_SRVS)
+        try:
+            for _ in range(calls):
+                start = time.perf_counter()
+                srvs.hNetrShareEnum(dce, 1)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            dce.disconnect()
+        return latencies, 0
+
+    def run(self, workload, clients=1):
+        """
+        Runs a workload with the given number of concurrent clients.
+
+        :param str workload: One of WORKLOADS.
+        :param int clients: Number of concurrent clients, each one with its own connection.
+
+        :return: Dictionary with the results.
+        """
+        if workload not in WORKLOADS:
+            raise Exception('Unknown workload %s' % workload)
+        function = getattr(self, '_SMBServerBenchmark__%s' % workload)
+        connections = [self.getClient() for _ in range(clients)]
+        results = [None] * clients
+        errors = []
+
+        def runClient(clientNum):
+            try:
+                results[clientNum] = function(connections[clientNum], clientNum)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=runClient, args=(i,)) for i in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        for client in connections:
+            client.close()
+        if len(errors) > 0:
+            raise errors[0]
+
+        latencies = sorted(latency for clientLatencies, _ in results for latency in clientLatencies)
+        totalBytes = sum(clientBytes for _, clientBytes in results)
+        return {
+            'workload': workload,
+            'server': self.__serverName,
+            'dialect': self.__dialectName,
+            'clients': clients,
+            'ops': len(latencies),
+            'bytes': totalBytes if workload != 'list' else 0,
+            'entries': totalBytes if workload == 'list' else 0,
+            'seconds': elapsed,
+            'mb_per_second': (totalBytes / elapsed / (1024 * 1024)) if workload != 'list' else 0,
+            'ops_per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(add_help=True, description="SMB server/client benchmarks on loopback.")
+    parser.add_argument('-workloads', nargs='*', choices=WORKLOADS, default=list(WORKLOADS),
+                        help='Workloads to run (default all)')
+    parser.add_argument('-clients', type=int, nargs='*', default=[1], help='Concurrent clients, can be a list')
+    parser.add_argument('-server', choices=list(SERVERS.keys()), default='threaded', help='Server implementation')
+    parser.add_argument('-dialect', choices=list(DIALECTS.keys()), help='Dialect asked by the clients')
+    parser.add_argument('-size', type=int, default=64, help='Size of the read/write file, in MB (default 64)')
+    parser.add_argument('-block-size', type=int, default=1024, help='Size of every read/write, in KB (default 1024)')
+    parser.add_argument('-small-files', type=int, default=500, help='Files read by the small workload')
+    parser.add_argument('-list-files', type=int, default=10000, help='Entries listed by the list workload')
+    parser.add_argument('-port', type=int, default=14450, help='Port to listen on (default 14450)')
+    parser.add_argument('-output', action='store', help='Append the JSON lines to this file too')
+
+    options = parser.parse_args()
+
+    benchmark = SMBServerBenchmark(port=options.port, server=options.server, dialect=options.dialect,
+                                   fileSize=options.size * 1024 * 1024, smallFiles=options.small_files,
+                                   listFiles=options.list_files, blockSize=options.block_size * 1024)
+    benchmark.setUp()
+    try:
+        for workload in options.workloads:
+            for clients in options.clients:
+                line = json.dumps(benchmark.run(workload, clients))
+                print(line)
+                sys.stdout.flush()
+                if options.output is not None:
+                    with open(options.output, 'a') as fd:
+                        fd.write(line + '\n')
+    finally:
+        benchmark.tearDown()
@@ -9,8 +9,10 @@
 # for more information.
 #
 import pytest
+import socket
 import unittest
 from binascii import unhexlify
+from struct import pack
 from tests import RemoteTestCase
 
 from impacket import nmb
@@ -91,6 +93,46 @@ class NMBLocalTests(unittest.TestCase):
         self.assertEqual(addr, str(resp.entries[0])) # Assert
 
 
+    def _tcp_session(self, select_poll):
+        client, server = socket.socketpair()
+        session = nmb.NetBIOSTCPSession('CLIENT', 'SERVER', '127.0.0.1', sess_port=nmb.SMB_SESSION_PORT,
+                                        sock=client, select_poll=select_poll)
+        return session, server
+
+    def test_tcpsession_recv_packet(self):
+        for select_poll in (False, True):
+            session, peer = self._tcp_session(select_poll)
+            payload = bytes(bytearray(i % 256 for i in range(0x18000)))
+
+            # Keep alive packets are discarded, and lengths over 64k use the flags byte
+            peer.sendall(pack('!BBH', nmb.NETBIOS_SESSION_KEEP_ALIVE, 0, 0))
+            peer.sendall(pack('!BBH', nmb.NETBIOS_SESSION_MESSAGE, len(payload) >> 16, len(payload) & 0xffff))
+            # Body split in several writes
+            for i in range(0, len(payload), 4096):
+                peer.sendall(payload[i:i+4096])
+
+            packet = session.recv_packet(5)
+            self.assertEqual(packet.get_type(), nmb.NETBIOS_SESSION_MESSAGE)
+            self.assertEqual(packet.get_length(), len(payload))
+            self.assertEqual(packet.get_trailer(), payload)
+            self.assertEqual(packet.rawData()[4:], payload)
+
+            # Timeouts apply to the whole read, even if some data was received
+            peer.sendall(pack('!BBH', nmb.NETBIOS_SESSION_MESSAGE, 0, 10) + b'12345')
+            with self.assertRaises(nmb.NetBIOSTimeout):
+                session.recv_packet(0.2)
+
+            peer.close()
+            session.close()
+
+    def test_tcpsession_closed(self):
+        session, peer = self._tcp_session(False)
+        peer.sendall(pack('!BBH', nmb.NETBIOS_SESSION_MESSAGE, 0, 10) + b'12345')
+        peer.close()
+        with self.assertRaises(nmb.NetBIOSError):
+            session.recv_packet(1)
+        session.close()
+
 
 @pytest.mark.remote
 class NMBRemoteTests(RemoteTestCase, unittest.TestCase):
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Tests for the SMB share crawler, run against a local SimpleSMBServer
+#   sharing a synthetic tree.
+#
+import json
+import shutil
+import socket
+import tempfile
+import unittest
+from io import StringIO
+from os import mkdir
+from os.path import join
+from threading import Thread, enumerate as enumerateThreads
+from time import sleep
+
+from impacket.smbserver import SimpleSMBServer
+from impacket.smbconnection import compute_lmhash, compute_nthash
+from impacket.examples.smbcrawler import SMBCrawler, STYPE_SPECIAL
+from tests.SMB_RPC.test_smbserver import SMBSERVERForTests
+
+
+class SMBCrawlerTests(unittest.TestCase):
+
+    address = "127.0.0.1"
+    port = 1446
+    username = "UserName"
+    password = "Password"
+    share_name = "share"
+
+    directories = 3
+    files_per_directory = 5
+    content = "crawler content"
+
+    def setUp(self):
+        self.share_path = tempfile.mkdtemp()
+        for i in range(self.directories):
+            directory = join(self.share_path, "dir%d" % i)
+            mkdir(directory)
+            mkdir(join(directory, "sub"))
+            for j in range(self.files_per_directory):
+                with open(join(directory, "file%d.txt" % j), "w") as fd:
+                    fd.write(self.content)
+            with open(join(directory, "sub", "nested.log"), "w") as fd:
+                fd.write(self.content)
+
+        self.server = SimpleSMBServer(listenAddress=self.address, listenPort=self.port,
+                                      smbserverclass=SMBSERVERForTests)
+        self.server.addCredential(self.username, 0, compute_lmhash(self.password), compute_nthash(self.password))
+        self.server.addShare(self.share_name, self.share_path)
+        self.server.setSMB2Support(True)
+        self.server_thread = Thread(target=self.server.start)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.server.getServer().must_serve = False
+        sleep(0.1)
+        self.server_thread.join()
+        shutil.rmtree(self.share_path)
+
+    def get_crawler(self, **kwargs):
+        return SMBCrawler(self.username, self.password, port=self.port, **kwargs)
+
+    def test_crawl(self):
+        crawler = self.get_crawler(workers=2, pipeline=2)
+        results = list(crawler.crawl([self.address, self.address]))
+
+        # Every entry is reported once per target
+        expected = self.directories * (self.files_per_directory + 3)
+        self.assertEqual(len(results), 2 * expected)
+        self.assertTrue(all("error" not in result for result in results))
+        self.assertEqual(set(result["share"] for result in results), {self.share_name.upper()})
+        self.assertIn("dir0\\sub\\nested.log", [result["path"] for result in results])
+
+        stats = crawler.getStats()
+        self.assertEqual(stats["targets"], 2)
+        self.assertEqual(stats["targets_done"], 2)
+        self.assertEqual(stats["files"], 2 * self.directories * (self.files_per_directory + 1))
+        self.assertEqual(stats["directories"], 2 * self.directories * 2)
+        self.assertEqual(stats["bytes"], stats["files"] * len(self.content))
+
+    def test_crawl_filters(self):
+        crawler = self.get_crawler(include=["*.TXT"], exclude=["dir1\\*"])
+        paths = [result["path"] for result in crawler.crawl([self.address])]
+        self.assertEqual(len(paths), (self.directories - 1) * self.files_per_directory)
+        self.assertTrue(all(path.endswith(".txt") and not path.startswith("dir1") for path in paths))
+
+        crawler = self.get_crawler(shares=["UNEXISTENT"])
+        self.assertEqual(list(crawler.crawl([self.address])), [])
+
+    def test_crawl_errors(self):
+        crawler = SMBCrawler(self.username, "WrongPassword", port=self.port)
+        results = list(crawler.crawl([self.address]))
+        self.assertEqual(len(results), 1)
+        self.assertIn("error", results[0])
+        self.assertEqual(crawler.getStats()["targets_failed"], 1)
+
+    def test_crawl_target_errors(self):
+        crawler = self.get_crawler()
+        getConnection = crawler.getConnection
+
+        def listSharesError():
+            raise Exception("listShares failed")
+
+        def walkError(shareName, path, pipeline=1):
+            raise socket.error("Connection reset")
+
+        # Failures after login are reported too, so incomplete hosts show up in the output
+        for name, method in (("listShares", listSharesError), ("walk", walkError)):
+            def failingConnection(target):
+                smbClient = getConnection(target)
+                setattr(smbClient, name, method)
+                return smbClient
+
+            crawler.resetStats()
+            crawler.getConnection = failingConnection
+            results = list(crawler.crawl([self.address]))
+            self.assertEqual(len(results), 1)
+            self.assertEqual(results[0]["host"], self.address)
+            self.assertIn("error", results[0])
+            self.assertEqual(crawler.getStats()["errors"], 1)
+            self.assertEqual(crawler.getStats()["targets_failed"], 1)
+
+    def test_share_included(self):
+        crawler = self.get_crawler()
+        self.assertTrue(crawler.isShareIncluded("DATA", 0))
+        self.assertFalse(crawler.isShareIncluded("IPC$", 3))
+        self.assertFalse(crawler.isShareIncluded("C$", STYPE_SPECIAL))
+        self.assertFalse(crawler.isShareIncluded("ADMIN$", STYPE_SPECIAL))
+
+        crawler = self.get_crawler(shares=["c$"])
+        self.assertTrue(crawler.isShareIncluded("C$", STYPE_SPECIAL))
+        self.assertFalse(crawler.isShareIncluded("DATA", 0))
+
+    def test_crawl_stopped(self):
+        crawler = self.get_crawler(workers=2)
+        results = crawler.crawl([self.address] * 4)
+        self.assertIn("path", next(results))
+        results.close()
+
+        # Workers exit, and skip the targets not started yet
+        self.assertEqual([thread for thread in enumerateThreads() if thread.name.startswith("SMBCrawler worker")], [])
+        self.assertLess(crawler.getStats()["targets_done"], 4)
+
+    def test_dump(self):
+        crawler = self.get_crawler(include=["*nested*"])
+        output = StringIO()
+        stats = crawler.dump([self.address], output)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(len(lines), self.directories)
+        self.assertEqual(stats["targets_done"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
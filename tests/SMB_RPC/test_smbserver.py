@@ -74,18 +74,40 @@
 #         [ ] smb2Lock
 #         [ ] smb2Cancel
 #
+import os
+import shutil
+import tempfile
 import unittest
 from time import sleep
+from struct import pack
 from os.path import exists, join
 from os import mkdir, rmdir, remove
 from multiprocessing import Process
 
 from six import PY2, StringIO, BytesIO, b, assertRaisesRegex, assertCountEqual
 
+import hashlib
+import hmac
+
+from impacket import crypto
 from impacket.smb import SMB_DIALECT
-from impacket.smbserver import normalize_path, isInFileJail, SimpleSMBServer, SMBSERVER
-from impacket.smbconnection import SMBConnection, SessionError, compute_lmhash, compute_nthash
+from impacket.nmb import NetBIOSTCPSession, NetBIOSError
+from impacket.nt_errors import STATUS_NOT_SUPPORTED, STATUS_SUCCESS, STATUS_NO_SUCH_FILE, STATUS_INVALID_PARAMETER, \
+    STATUS_ACCESS_DENIED
+from impacket.smb3structs import SMB2_DIALECT_002, SMB2_DIALECT_21, SMB2_DIALECT_30, SMB2_DIALECT_311, SMB2_ECHO, \
+    SMB2_NEGOTIATE, SMB2_CREATE, SMB2_READ, SMB2_WRITE, SMB2_CLOSE, SMB2_FLAGS_RELATED_OPERATIONS, \
+    SMB2_FLAGS_SERVER_TO_REDIR, SMB2_IL_IMPERSONATION, FILE_READ_DATA, FILE_SHARE_READ, FILE_OPEN, \
+    FILE_NON_DIRECTORY_FILE, SMB2Echo, SMB2Negotiate, SMB2Packet, SMB2Create, SMB2Create_Response, SMB2Read, \
+    SMB2Read_Response, SMB2Close, SMB2Write_Response, SMB2_FILE_END_OF_FILE_INFO, SMB2_QUERY_DIRECTORY, \
+    SMB2QueryDirectory, SMB2Error
+from impacket.smbserver import normalize_path, isInFileJail, SimpleSMBServer, SMBSERVER, AsyncSMBSERVER, \
+    SMB2FileRegion, DirectoryCache, SMBConnectionData, findFiles, writeFileRange, setEndOfFile
+from impacket.smb import SMBSetFileEndOfFileInfo
+from impacket.dcerpc.v5.rpcrt import DCERPCServer, DCERPCException
+from impacket.smbconnection import SMBConnection, SMBFile, SMBSessionManager, SessionError, compute_lmhash, \
+    compute_nthash
 from threading import Thread
+from tests.SMB_RPC.benchmark_smbserver import SMBServerBenchmark, WORKLOADS
 
 import select
 import socket
@@ -167,6 +189,107 @@ class SMBServerUnitTests(unittest.TestCase):
         self.assertFalse(isInFileJail(jail_path, "../filename"))
         self.assertFalse(isInFileJail(jail_path, "../../filename"))
 
+    def test_directory_cache(self):
+        """Test directory listings are reused until the directory changes.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            mkdir(join(directory, "subdir"))
+            with open(join(directory, "file.txt"), "w") as fd:
+                fd.write("content")
+
+            # Recently modified directories are not cached
+            cache = DirectoryCache()
+            entries = cache.listDirectory(directory)
+            assertCountEqual(self, entries, [("subdir", True), ("file.txt", False)])
+            self.assertIsNot(cache.listDirectory(directory), entries)
+
+            cache = DirectoryCache(racyInterval=0)
+            entries = cache.listDirectory(directory)
+            self.assertIs(cache.listDirectory(directory), entries)
+
+            # Pretend the directory changes later on
+            os.utime(directory, (0, 0))
+            self.assertIsNot(cache.listDirectory(directory), entries)
+
+            files, errorCode = findFiles(directory, "*.TXT", 0, cache)
+            self.assertEqual(files, [join(directory, "file.txt")])
+            files, errorCode = findFiles(directory, "*", 0, cache)
+            self.assertEqual(files, [join(directory, "."), join(directory, ".."), join(directory, "file.txt")])
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipUnless(hasattr(os, "sendfile"), "os.sendfile not available")
+    def test_file_region(self):
+        """Test answers sent straight from a file, including one truncated after being built.
+        """
+        with tempfile.TemporaryFile() as fd:
+            fd.write(b"0123456789")
+            fd.flush()
+
+            region = SMB2FileRegion(b"HEADER", fd.fileno(), 2, 5, padLength=3)
+            self.assertEqual(len(region), 14)
+            self.assertEqual(region.getData(), b"HEADER23456\x00\x00\x00")
+
+            reader, writer = socket.socketpair()
+            try:
+                region = SMB2FileRegion(b"HEADER", fd.fileno(), 8, 4)
+                self.assertTrue(region.send(writer))
+                self.assertEqual(reader.recv(100), b"\x00\x00\x00\x0aHEADER89\x00\x00")
+            finally:
+                reader.close()
+                writer.close()
+
+            # Answers never sent close their descriptor too
+            with SMB2FileRegion(b"HEADER", fd.fileno(), 2, 5) as region:
+                fileHandle = region._SMB2FileRegion__fileHandle
+                os.fstat(fileHandle)
+            self.assertRaises(OSError, os.fstat, fileHandle)
+
+            region = SMB2FileRegion(b"HEADER", fd.fileno(), 2, 5)
+            fileHandle = region._SMB2FileRegion__fileHandle
+            del region
+            self.assertRaises(OSError, os.fstat, fileHandle)
+
+    def test_dcerpc_server_pipe(self):
+        """Test in-process DCERPC pipes reject fragment lengths shorter than the header.
+        """
+        server = DCERPCServer()
+        self.assertIsNone(server._sock)
+        pipe = server.openPipe()
+        for fragLen in (0, 10):
+            self.assertRaises(DCERPCException, pipe.send, b"\x05\x00\x0b\x03\x10\x00\x00\x00" + pack("<H", fragLen))
+            self.assertEqual(pipe.recv(100), b"")
+
+    def test_dcerpc_server_bind(self):
+        """Test setting the listening address or port binds right away.
+        """
+        listening = socket.socket()
+        listening.bind(("127.0.0.1", 0))
+        listening.listen(1)
+        try:
+            server = DCERPCServer()
+            server.setListenPort(0)
+            self.assertIsNotNone(server._sock)
+            self.assertRaises(OSError, server.setListenPort, listening.getsockname()[1])
+        finally:
+            listening.close()
+
+    def test_write_file_range(self):
+        """Test positional writes from views and setting the end of file, growing and shrinking it.
+        """
+        with tempfile.TemporaryFile() as fd:
+            setEndOfFile(fd.fileno(), 10)
+            self.assertEqual(os.fstat(fd.fileno()).st_size, 10)
+
+            data = memoryview(b"xxABCDyy")
+            writeFileRange(fd.fileno(), 6, data[2:6])
+            writeFileRange(fd.fileno(), 0, b"01")
+            self.assertEqual(os.pread(fd.fileno(), 20, 0), b"01\x00\x00\x00\x00ABCD")
+
+            setEndOfFile(fd.fileno(), 7)
+            self.assertEqual(os.pread(fd.fileno(), 20, 0), b"01\x00\x00\x00\x00A")
+
 
 class SimpleSMBServerFuncTests(unittest.TestCase):
     """Pseudo functional tests for the SimpleSMBServer.
@@ -175,6 +298,7 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
     we should (and can) use for example Samba's smbclient or similar.
     """
     server = None
+    server_class = SMBSERVERForTests
     server_smb2_support = False
     client_preferred_dialect = None
 
@@ -244,7 +368,7 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
         #smbserver = SimpleSMBServerForTests(listenAddress=self.address, listenPort=int(self.port))
         # smbserver should be run in a host thread and also be able to be terminated in order to run several times
         # different configurations.
-        smbserver = SimpleSMBServer(listenAddress=self.address, listenPort=int(self.port),smbserverclass=SMBSERVERForTests)
+        smbserver = SimpleSMBServer(listenAddress=self.address, listenPort=int(self.port),smbserverclass=self.server_class)
         if add_credential:
             smbserver.addCredential(self.username, 0, self.lmhash, self.nthash)
         if add_share:
@@ -355,6 +479,140 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
 
         client.close()
 
+    def test_smbserver_list_shares_concurrent(self):
+        """Test many clients listing shares at once, served in-process by the srvsvc pipe.
+        """
+        server = self.get_smbserver()
+        self.assertTrue(all(isinstance(address, DCERPCServer)
+                            for address in server.getRegisteredNamedPipes().values()))
+        # Answered in-process, so no listening socket is bound for them
+        self.assertTrue(all(address._sock is None for address in server.getRegisteredNamedPipes().values()))
+        self.start_smbserver(server)
+
+        clients = []
+        for i in range(4):
+            client = self.get_smbclient()
+            client.login(self.username, self.password)
+            clients.append(client)
+
+        results = []
+
+        def worker(client):
+            try:
+                for i in range(3):
+                    results.append(sorted(share['shi1_netname'][:-1] for share in client.listShares()))
+            except Exception as e:
+                results.append(e)
+
+        threads = [Thread(target=worker, args=(client,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for client in clients:
+            client.close()
+
+        self.assertEqual(results, [sorted(["IPC$", self.share_name.upper()])] * 12)
+
+    def test_smbserver_pipe_invalid_fragment(self):
+        """Test writing a PDU with a fragment length shorter than its header to an in-process pipe.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+        treeId = client.connectTree("IPC$")
+        fileId = client.openFile(treeId, "srvsvc")
+        try:
+            with assertRaisesRegex(self, SessionError, "STATUS_ACCESS_DENIED"):
+                client.writeFile(treeId, fileId, b"\x05\x00\x0b\x03\x10\x00\x00\x00\x00\x00")
+        finally:
+            client.closeFile(treeId, fileId)
+            client.disconnectTree(treeId)
+
+        # The server is still answering
+        self.assertEqual(len(client.listShares()), 2)
+        client.close()
+
+    def test_smbserver_session_manager(self):
+        """Test reusing sessions and trees through the session manager.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        manager = SMBSessionManager(keepAliveInterval=3600)
+        credentials = dict(sess_port=int(self.port), preferredDialect=self.client_preferred_dialect,
+                           username=self.username, password=self.password)
+
+        with manager.session(self.address, **credentials) as client:
+            tree_id = manager.connectTree(client, self.share_name)
+            self.assertEqual(manager.connectTree(client, self.share_name), tree_id)
+            first_client = client
+
+        # Same host and identity get the cached session and tree
+        with manager.session(self.address, **credentials) as client:
+            self.assertIs(client, first_client)
+            self.assertEqual(manager.connectTree(client, self.share_name), tree_id)
+            client.echo()
+
+        # Invalid credentials are not cached
+        with assertRaisesRegex(self, SessionError, "STATUS_LOGON_FAILURE"):
+            manager.getSession(self.address, sess_port=int(self.port), username="Invalid", password="Invalid")
+
+        # The cached session is not handed out for the same user with a wrong password
+        wrong_credentials = dict(credentials, password="WrongPassword")
+        with assertRaisesRegex(self, SessionError, "STATUS_LOGON_FAILURE"):
+            manager.getSession(self.address, **wrong_credentials)
+        with manager.session(self.address, **credentials) as client:
+            self.assertIs(client, first_client)
+
+        # Expired sessions are transparently re-established
+        first_client.getSMBServer().get_socket().close()
+        manager = SMBSessionManager(keepAliveInterval=0)
+        with manager.session(self.address, **credentials) as client:
+            client.getSMBServer().get_socket().close()
+        with manager.session(self.address, **credentials) as client:
+            files = client.listPath(self.share_name, "*")
+            assertCountEqual(self, [f.get_longname() for f in files], self.share_list)
+
+        manager.close()
+
+    def test_smbserver_connection_data(self):
+        """Test the state kept for every connection.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+        tree_id = client.connectTree(self.share_name)
+
+        smbserver = server.getServer()
+        connections = smbserver.getActiveConnections()
+        self.assertEqual(len(connections), 1)
+        connId, connData = list(connections.items())[0]
+        self.assertIsInstance(connData, SMBConnectionData)
+        self.assertEqual(connData.connId, connId)
+        self.assertEqual(connData["ClientIP"], self.address)
+        self.assertTrue(connData["Authenticated"])
+        self.assertIn(tree_id, connData["ConnectedShares"])
+
+        # Setting a copy updates the state the connection handler has
+        newConnData = dict(connData)
+        newConnData["Custom"] = "value"
+        smbserver.setConnectionData(connId, newConnData)
+        self.assertIs(smbserver.getConnectionData(connId), connData)
+        self.assertEqual(connData["Custom"], "value")
+        client.listPath(self.share_name, "*")
+
+        client.close()
+        for _ in range(50):
+            if len(connections) == 0:
+                break
+            sleep(0.1)
+        self.assertEqual(len(connections), 0)
+
     def test_smbserver_connect_disconnect_tree(self):
         """Test connecting/disconnecting to a share tree.
         """
@@ -420,6 +678,87 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
 
         client.close()
 
+    def test_smbserver_list_large_directory(self):
+        """Test listing a directory that doesn't fit in a single answer, and that it changes right after.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        directory = join(self.share_path, "large")
+        mkdir(directory)
+        names = ["file_with_a_long_name_%05d.txt" % i for i in range(2000)]
+        for name in names:
+            open(join(directory, name), "w").close()
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+
+        try:
+            files = client.listPath(self.share_name, "large\\*")
+            dots = [name for name in self.share_list if name in (".", "..")]
+            assertCountEqual(self, [f.get_longname() for f in files], dots + names)
+
+            open(join(directory, "new.txt"), "w").close()
+            files = client.listPath(self.share_name, "large\\*.txt")
+            assertCountEqual(self, [f.get_longname() for f in files], names + ["new.txt"])
+        finally:
+            client.close()
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(PY2, "Unicode filename expected failing in Python 2.x")
+    def test_smbserver_iter_path(self):
+        """Test iterating over files in a shared folder.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+
+        # Check unauthenticated iter path
+        with assertRaisesRegex(self, SessionError, "STATUS_ACCESS_DENIED"):
+            list(client.iterPath(self.share_name, "/"))
+
+        # Check authenticated iter path
+        client.login(self.username, self.password)
+
+        files = client.iterPath(self.share_name, "*")
+        assertCountEqual(self, [f.get_longname() for f in files], self.share_list)
+
+        # Check unexistent file
+        with assertRaisesRegex(self, SessionError, "STATUS_NO_SUCH_FILE"):
+            list(client.iterPath(self.share_name, "unexistent"))
+
+        client.close()
+
+    @unittest.skipIf(PY2, "Unicode filename expected failing in Python 2.x")
+    def test_smbserver_walk(self):
+        """Test recursively walking a shared folder.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        nested_file = join(self.share_path, self.share_directory, self.share_file)
+        with open(nested_file, "w") as fd:
+            fd.write(self.share_new_content)
+
+        try:
+            client = self.get_smbclient()
+            client.login(self.username, self.password)
+
+            expected = [("", self.share_file), ("", self.share_directory), ("", self.unicode_share_file),
+                        (self.share_directory, self.share_file)]
+            for pipeline in (1, 4):
+                entries = client.walk(self.share_name, "/", pipeline=pipeline)
+                assertCountEqual(self, [(d, f.get_longname()) for d, f in entries], expected)
+
+            entries = client.walk(self.share_name, self.share_directory)
+            assertCountEqual(self, [(d, f.get_longname()) for d, f in entries],
+                             [(self.share_directory, self.share_file)])
+
+            client.close()
+        finally:
+            remove(nested_file)
+
     def test_smbserver_put(self):
         """Test writing files to a shared folder.
         """
@@ -483,6 +822,58 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
 
         client.close()
 
+    def test_smbserver_smbfile(self):
+        """Test reading a file through the SMBFile block cache.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        content = bytes(bytearray(i % 251 for i in range(10000)))
+        with open(join(self.share_path, self.share_new_file), "wb") as fd:
+            fd.write(content)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+
+        with SMBFile(client, self.share_name, self.share_new_file, blockSize=1024, readAhead=2, cacheSize=4) as remote:
+            self.assertEqual(remote.getFileSize(), len(content))
+
+            # Small sequential reads are served from the read ahead window
+            self.assertEqual(remote.read(4), content[:4])
+            self.assertEqual(remote.read(100), content[4:104])
+            self.assertEqual(remote.tell(), 104)
+            self.assertEqual(remote.getReadCount(), 1)
+
+            # Reads spanning blocks, and beyond the end of the file
+            remote.seek(2000)
+            self.assertEqual(remote.read(3000), content[2000:5000])
+            remote.seek(-10, 2)
+            self.assertEqual(remote.read(100), content[-10:])
+            self.assertEqual(remote.read(100), b"")
+            remote.seek(-20, 1)
+            self.assertEqual(remote.read(), content[-20:])
+
+            # Blocks evicted from the cache are fetched again
+            reads = remote.getReadCount()
+            remote.seek(0)
+            self.assertEqual(remote.read(), content)
+            self.assertGreater(remote.getReadCount(), reads)
+
+        # The read ahead window doesn't go beyond a single READ
+        maxReadSize = client.getIOCapabilities()["MaxReadSize"]
+        blockSize = maxReadSize // 2
+        with open(join(self.share_path, self.share_new_file), "wb") as fd:
+            fd.write(content * (4 * blockSize // len(content) + 1))
+        with SMBFile(client, self.share_name, self.share_new_file, blockSize=blockSize, readAhead=8) as remote:
+            data = b""
+            while len(data) < remote.getFileSize():
+                data += remote.read(4096)
+            self.assertEqual(len(data), remote.getFileSize())
+            # 4 full blocks and a partial one, 2 blocks per READ
+            self.assertEqual(remote.getReadCount(), 3)
+
+        client.close()
+
     @unittest.skipIf(PY2, "Unicode filename expected failing in Python 2.x")
     def test_smbserver_get_unicode_file(self):
         """Test reading unicode files from a shared folder.
@@ -725,6 +1116,400 @@ class SimpleSMBServer2FuncTests(SimpleSMBServerFuncTests):
 
         client.close()
 
+    def test_smbserver_signing(self):
+        """Test the answers are signed with the algorithm and key of the negotiated dialect.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+
+        smb3 = client.getSMBServer()
+        packet = smb3.SMB_PACKET()
+        packet['Command'] = SMB2_ECHO
+        packet['Data'] = SMB2Echo()
+        answer = smb3.recvSMB(smb3.sendSMB(packet))
+        self.assertGreaterEqual(answer['CreditRequestResponse'], 1)
+
+        data = bytearray(answer.rawData)
+        signature = bytes(data[48:64])
+        data[48:64] = b"\x00" * 16
+        sessionKey = smb3._Session['SessionKey']
+        if client.getDialect() == SMB2_DIALECT_311:
+            expected = crypto.AES_CMAC(smb3._Session['SigningKey'], bytes(data), len(data))
+        elif client.getDialect() >= SMB2_DIALECT_30:
+            signingKey = crypto.KDF_CounterMode(sessionKey, b"SMB2AESCMAC\x00", b"SmbSign\x00", 128)
+            expected = crypto.AES_CMAC(signingKey, bytes(data), len(data))
+        else:
+            expected = hmac.new(sessionKey, bytes(data), hashlib.sha256).digest()[:16]
+        self.assertEqual(signature, expected)
+
+        client.close()
+
+    def test_smbserver_max_dialect(self):
+        """Test the negotiated dialect and I/O sizes honor the server settings.
+        """
+        server = self.get_smbserver()
+        server.setSMB2MaxDialect("2.0.2")
+        self.start_smbserver(server)
+
+        client = SMBConnection(self.address, self.address, sess_port=int(self.port))
+        self.assertEqual(client.getDialect(), SMB2_DIALECT_002)
+        self.assertEqual(client.getSMBServer()._Connection['MaxReadSize'], 65536)
+        client.close()
+
+        server.setSMB2MaxDialect("2.1")
+        server.setSMB2MaxIOSize(1024 * 1024)
+        client = SMBConnection(self.address, self.address, sess_port=int(self.port))
+        self.assertEqual(client.getDialect(), SMB2_DIALECT_21)
+        self.assertEqual(client.getSMBServer()._Connection['MaxReadSize'], 1024 * 1024)
+        self.assertTrue(client.getSMBServer()._Connection['SupportsMultiCredit'])
+        client.close()
+
+        # No common dialect
+        session = NetBIOSTCPSession("*SMBSERVER", self.address, self.address, sess_port=int(self.port))
+        packet = SMB2Packet()
+        packet['Command'] = SMB2_NEGOTIATE
+        negotiate = SMB2Negotiate()
+        negotiate['Dialects'] = [SMB2_DIALECT_311]
+        negotiate['DialectCount'] = 1
+        packet['Data'] = negotiate
+        session.send_packet(packet.getData())
+        answer = SMB2Packet(session.recv_packet(10).get_trailer())
+        self.assertEqual(answer['Status'], STATUS_NOT_SUPPORTED)
+        session.close()
+
+        with self.assertRaises(Exception):
+            server.setSMB2MaxDialect("4.0")
+
+    def test_smbserver_unknown_protocol(self):
+        """Test the connection is dropped when a packet is not SMB1 nor SMB2.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        session = NetBIOSTCPSession("*SMBSERVER", self.address, self.address, sess_port=int(self.port))
+        session.send_packet(b"\xfdSMB" + b"\x00" * 60)
+        with self.assertRaises(NetBIOSError):
+            session.recv_packet(10)
+        session.close()
+
+    def test_smbserver_get_file_unsigned(self):
+        """Test reading files from an unsigned (guest) session, served straight from the file.
+        """
+        server = self.get_smbserver(add_credential=False)
+        self.start_smbserver(server)
+
+        content = os.urandom(1024 * 1024 + 123)
+        with open(join(self.share_path, self.share_new_file), "wb") as fd:
+            fd.write(content)
+
+        client = self.get_smbclient()
+        client.login("Guest", "")
+
+        local_file = BytesIO()
+        client.getFile(self.share_name, self.share_new_file, local_file.write)
+        self.assertEqual(local_file.getvalue(), content)
+
+        with SMBFile(client, self.share_name, self.share_new_file, blockSize=4096, readAhead=0) as remote_file:
+            remote_file.seek(12345)
+            self.assertEqual(remote_file.read(10000), content[12345:22345])
+            remote_file.seek(-100, 2)
+            self.assertEqual(remote_file.read(), content[-100:])
+
+        client.close()
+
+    def test_smbserver_large_read_write(self):
+        """Test transferring a file bigger than a single SMB2 READ/WRITE.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+
+        content = os.urandom(1024 * 1024 + 123)
+        client.putFile(self.share_name, self.share_new_file, BytesIO(content).read)
+        local_file = BytesIO()
+        client.getFile(self.share_name, self.share_new_file, local_file.write)
+        self.assertEqual(local_file.getvalue(), content)
+
+        client.close()
+
+    def test_smbserver_write_preallocated(self):
+        """Test writes in any order to a file whose end of file was set before uploading it.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+        tid = client.connectTree(self.share_name)
+        fid = client.createFile(tid, self.share_new_file)
+        try:
+            blocks = [os.urandom(4096) for _ in range(3)]
+            endOfFile = SMBSetFileEndOfFileInfo()
+            endOfFile['EndOfFile'] = 3 * 4096
+            client.setInfo(tid, fid, SMB2_FILE_END_OF_FILE_INFO, endOfFile.getData())
+
+            # Past the original end of file, so only written thanks to the new size
+            for index in (2, 0, 1):
+                client.writeFile(tid, fid, blocks[index], index * 4096)
+
+            endOfFile['EndOfFile'] = 2 * 4096 + 10
+            client.setInfo(tid, fid, SMB2_FILE_END_OF_FILE_INFO, endOfFile.getData())
+        finally:
+            client.closeFile(tid, fid)
+            client.disconnectTree(tid)
+            client.close()
+
+        with open(join(self.share_path, self.share_new_file), "rb") as fd:
+            self.assertEqual(fd.read(), b"".join(blocks)[:2 * 4096 + 10])
+
+    def send_compound(self, client, treeId, requests):
+        """Sends a compound request built from (command, flags, body) tuples and returns the responses.
+        """
+        smbServer = client.getSMBServer()
+        data = b""
+        for idx, (command, flags, body) in enumerate(requests):
+            packet = SMB2Packet()
+            packet['Command'] = command
+            packet['Flags'] = flags
+            packet['SessionID'] = smbServer._Session['SessionID']
+            packet['TreeID'] = treeId
+            packet['MessageID'] = 1000 + idx
+            packet['CreditRequestResponse'] = 1
+            packet['Data'] = body
+            if idx + 1 < len(requests):
+                padLen = -len(packet) % 8
+                packet['NextCommand'] = len(packet) + padLen
+                data += packet.getData() + b"\x00" * padLen
+            else:
+                data += packet.getData()
+        smbServer._NetBIOSSession.send_packet(data)
+
+        data = smbServer._NetBIOSSession.recv_packet(10).get_trailer()
+        responses = []
+        while True:
+            response = SMB2Packet(data)
+            responses.append(response)
+            if response['NextCommand'] == 0:
+                break
+            data = data[response['NextCommand']:]
+        return responses
+
+    def test_smbserver_compound_requests(self):
+        """Test related compound requests using the FileId opened earlier in the same chain.
+        """
+        server = self.get_smbserver(add_credential=False)
+        self.start_smbserver(server)
+
+        content = os.urandom(5000)
+        with open(join(self.share_path, self.share_new_file), "wb") as fd:
+            fd.write(content)
+
+        client = self.get_smbclient()
+        client.login("Guest", "")
+        treeId = client.connectTree(self.share_name)
+
+        def create(fileName):
+            request = SMB2Create()
+            request['ImpersonationLevel'] = SMB2_IL_IMPERSONATION
+            request['DesiredAccess'] = FILE_READ_DATA
+            request['ShareAccess'] = FILE_SHARE_READ
+            request['CreateDisposition'] = FILE_OPEN
+            request['CreateOptions'] = FILE_NON_DIRECTORY_FILE
+            request['NameLength'] = len(fileName.encode('utf-16le'))
+            request['Buffer'] = fileName.encode('utf-16le')
+            return request
+
+        read = SMB2Read()
+        read['Length'] = 1000
+        read['Offset'] = 100
+        read['FileID'] = b"\xff" * 16
+        read['Buffer'] = b"\x00"
+        close = SMB2Close()
+        close['FileID'] = b"\xff" * 16
+
+        responses = self.send_compound(client, treeId, [(SMB2_CREATE, 0, create(self.share_new_file)),
+                                                        (SMB2_READ, SMB2_FLAGS_RELATED_OPERATIONS, read),
+                                                        (SMB2_CLOSE, SMB2_FLAGS_RELATED_OPERATIONS, close)])
+        self.assertEqual([response['Command'] for response in responses], [SMB2_CREATE, SMB2_READ, SMB2_CLOSE])
+        self.assertEqual([response['Status'] for response in responses], [STATUS_SUCCESS] * 3)
+        self.assertEqual([response['Flags'] for response in responses],
+                         [SMB2_FLAGS_SERVER_TO_REDIR] + [SMB2_FLAGS_SERVER_TO_REDIR | SMB2_FLAGS_RELATED_OPERATIONS] * 2)
+        fileId = SMB2Create_Response(responses[0]['Data'])['FileID'].getData()
+        readResponse = SMB2Read_Response(responses[1]['Data'])
+        self.assertEqual(readResponse['Buffer'][:readResponse['DataLength']], content[100:1100])
+
+        # The file was closed by the chain
+        close['FileID'] = fileId
+        responses = self.send_compound(client, treeId, [(SMB2_CLOSE, 0, close)])
+        self.assertNotEqual(responses[0]['Status'], STATUS_SUCCESS)
+
+        # A failed CREATE fails the related requests with its own status
+        close['FileID'] = b"\xff" * 16
+        responses = self.send_compound(client, treeId, [(SMB2_CREATE, 0, create("unexistent.txt")),
+                                                        (SMB2_READ, SMB2_FLAGS_RELATED_OPERATIONS, read),
+                                                        (SMB2_CLOSE, SMB2_FLAGS_RELATED_OPERATIONS, close)])
+        self.assertEqual([response['Status'] for response in responses], [STATUS_NO_SUCH_FILE] * 3)
+
+        client.close()
+
+    def test_smbserver_write_invalid(self):
+        """Test SMB2 WRITE requests whose DataOffset/Length don't fit in the received data.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+        treeId = client.connectTree(self.share_name)
+        fileId = client.createFile(treeId, self.share_new_file)
+
+        def write(dataOffset, length, data):
+            return pack('<HHLQ16sLLHHL', 49, dataOffset, length, 0, fileId, 0, 0, 0, 0, 0) + data
+
+        try:
+            for body in (write(10, 4, b"data"),      # Offset inside the SMB2 header
+                         write(112, 1000, b"data"),  # Length past the end of the data
+                         write(112, 4, b"")[:20]):   # Short buffer
+                responses = self.send_compound(client, treeId, [(SMB2_WRITE, 0, body)])
+                self.assertEqual(responses[0]['Status'], STATUS_INVALID_PARAMETER)
+
+            responses = self.send_compound(client, treeId, [(SMB2_WRITE, 0, write(112, 4, b"data"))])
+            self.assertEqual(responses[0]['Status'], STATUS_SUCCESS)
+            self.assertEqual(SMB2Write_Response(responses[0]['Data'])['Count'], 4)
+        finally:
+            client.closeFile(treeId, fileId)
+            client.disconnectTree(treeId)
+            client.close()
+
+        with open(join(self.share_path, self.share_new_file), "rb") as fd:
+            self.assertEqual(fd.read(), b"data")
+
+    def test_smbserver_walk_query_failure(self):
+        """Test walking a shared folder with a subdirectory that can be opened but not listed.
+        """
+        server = self.get_smbserver()
+        smbServer = server.getServer()
+        queryDirectory = smbServer.hookSmb2Command(SMB2_QUERY_DIRECTORY, None)
+
+        def deniedQueryDirectory(connId, smbServer, recvPacket):
+            fileId = SMB2QueryDirectory(recvPacket['Data'])['FileID'].getData()
+            openedFile = smbServer.getConnectionData(connId)['OpenedFiles'].get(fileId)
+            if openedFile is not None and openedFile['FileName'].endswith("denied"):
+                return [SMB2Error()], None, STATUS_ACCESS_DENIED
+            return queryDirectory(connId, smbServer, recvPacket)
+
+        smbServer.hookSmb2Command(SMB2_QUERY_DIRECTORY, deniedQueryDirectory)
+        self.start_smbserver(server)
+
+        denied_path = join(self.share_path, self.share_directory, "denied")
+        mkdir(denied_path)
+        with open(join(denied_path, self.share_file), "w") as fd:
+            fd.write(self.share_new_content)
+
+        try:
+            client = self.get_smbclient()
+            client.login(self.username, self.password)
+
+            # The rest of the share is still walked
+            expected = [("", self.share_file), ("", self.share_directory), ("", self.unicode_share_file),
+                        (self.share_directory, "denied")]
+            for pipeline in (1, 4):
+                entries = client.walk(self.share_name, "/", pipeline=pipeline)
+                assertCountEqual(self, [(d, f.get_longname()) for d, f in entries], expected)
+
+            with assertRaisesRegex(self, SessionError, "STATUS_ACCESS_DENIED"):
+                list(client.walk(self.share_name, join(self.share_directory, "denied")))
+
+            client.close()
+        finally:
+            shutil.rmtree(denied_path)
+
+
+class SimpleSMBServer21FuncTests(SimpleSMBServer2FuncTests):
+
+    client_preferred_dialect = SMB2_DIALECT_21
+
+
+class SimpleSMBServer311FuncTests(SimpleSMBServer2FuncTests):
+
+    client_preferred_dialect = SMB2_DIALECT_311
+
+
+class AsyncSMBServerFuncTests(SimpleSMBServerFuncTests):
+
+    server_class = AsyncSMBSERVER
+
+
+class AsyncSMBServer2FuncTests(SimpleSMBServer2FuncTests):
+
+    server_class = AsyncSMBSERVER
+
+    def test_smbserver_concurrent_clients(self):
+        """Test many clients working at the same time against the event loop server.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        clients = []
+        for i in range(50):
+            client = self.get_smbclient()
+            client.login(self.username, self.password)
+            clients.append(client)
+
+        errors = []
+
+        def worker(client):
+            try:
+                for i in range(5):
+                    files = [f.get_longname() for f in client.listPath(self.share_name, "*")]
+                    if self.share_file not in files:
+                        errors.append(files)
+                    fh = BytesIO()
+                    client.getFile(self.share_name, self.share_file, fh.write)
+                    if fh.getvalue() != b(self.share_new_content):
+                        errors.append(fh.getvalue())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                client.close()
+
+        threads = [Thread(target=worker, args=(client,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        sleep(0.5)
+        self.assertEqual(server.getServer().getConnectionsCount(), 0)
+
+
+class SMBServerBenchmarkTests(unittest.TestCase):
+    """Checks the benchmark harness runs every workload, with tiny sizes.
+    """
+
+    def test_benchmark(self):
+        benchmark = SMBServerBenchmark(port=14451, fileSize=3 * 1024 * 1024 + 5, smallFiles=5, listFiles=50,
+                                       blockSize=1024 * 1024)
+        benchmark.setUp()
+        try:
+            for workload in WORKLOADS:
+                result = benchmark.run(workload, clients=2)
+                self.assertEqual(result["workload"], workload)
+                self.assertGreater(result["ops"], 0)
+                self.assertGreaterEqual(result["p99_ms"], result["p50_ms"])
+                if workload in ("read", "write"):
+                    self.assertEqual(result["bytes"], 2 * (3 * 1024 * 1024 + 5))
+                elif workload == "list":
+                    self.assertEqual(result["entries"], 2 * 50)
+        finally:
+            benchmark.tearDown()
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=1)
@@ -0,0 +1,700 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Tests for the ESE parser, run against small synthetic databases built here
+#   (Exchange 2003 SP0 page format, 8 KB pages).
+#
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from binascii import hexlify
+from struct import pack
+
+from impacket.ese import ESENT_DB, ESENT_DB_HEADER, ESENT_JET_SIGNATURE, ESENT_FILE, ESENT_MMAP_FILE, ESENT_PAGE, \
+    ESENT_PAGE_HEADER, ESENT_ROW, ensureBytes, normalizeKeyColumn, CATALOG_PAGE_NUMBER, TAG_COMMON, \
+    CATALOG_TYPE_TABLE, CATALOG_TYPE_COLUMN, CATALOG_TYPE_INDEX, CATALOG_TYPE_LONG_VALUE, FLAGS_ROOT, FLAGS_LEAF, \
+    FLAGS_PARENT, FLAGS_INDEX, FLAGS_LONG_VALUE, TAGGED_DATA_TYPE_STORED, TAGGED_DATA_TYPE_MULTI_VALUE, \
+    MULTI_VALUE_LONG_VALUE, ESENT_LONG_VALUE, JET_coltypLong, JET_coltypLongLong, \
+    JET_coltypText, JET_coltypBinary, JET_coltypGUID, JET_coltypUnsignedShort, CODEPAGE_UNICODE
+
+PAGE_SIZE = 8192
+VERSION = 0x620
+REVISION = 0x09
+# Old format page header, CheckSum and PageNumber plus the common fields
+PAGE_HEADER_SIZE = 40
+FIRST_DATA_PAGE = 10
+LONG_VALUE_CHUNK_SIZE = 1000
+
+# (name, identifier, type, size) of the columns of the test table
+COLUMNS = [
+    ("DNT_col", 1, JET_coltypLong, 4),
+    ("size_col", 2, JET_coltypLongLong, 8),
+    ("name_col", 128, JET_coltypText, 0),
+    ("blob_col", 129, JET_coltypBinary, 0),
+    ("ATTm3", 256, JET_coltypText, 0),
+    ("ATTk4", 257, JET_coltypBinary, 0),
+]
+
+
+def encode_value(columnType, value):
+    if columnType == JET_coltypLong:
+        return pack("<l", value)
+    elif columnType == JET_coltypLongLong:
+        return pack("<Q", value)
+    elif columnType == JET_coltypText:
+        return value.encode("utf-16le")
+    return value
+
+
+def build_page(pageNum, flags, tags, fatherDataPage=0, nextPage=0, previousPage=0):
+    """Builds a page from its (flags, data) tags, tag 0 being the page header.
+    """
+    data = b""
+    tagArray = b""
+    for tagFlags, tagData in tags:
+        # Tags are stored backwards at the end of the page
+        tagArray = pack("<HH", len(tagData), (tagFlags << 13) | len(data)) + tagArray
+        data += tagData
+    header = pack("<LLQLLLHHHHL", 0, pageNum, 0, previousPage, nextPage, fatherDataPage, 0, 0, len(data),
+                  len(tags), flags)
+    padding = PAGE_SIZE - len(header) - len(data) - len(tagArray)
+    if padding < 0:
+        raise Exception("Page %d overflow" % pageNum)
+    return header + data + b"\x00" * padding + tagArray
+
+
+def build_leaf_entry(key, entryData):
+    return pack("<H", len(key)) + key + entryData
+
+
+def build_catalog_entry(fixedData, name):
+    name = name.encode("utf-8")
+    return pack("<BBH", 1, 128, 4 + len(fixedData)) + fixedData + pack("<H", len(name)) + name
+
+
+class LongValue(bytes):
+    """Value stored in the long value tree.
+    """
+
+
+class MissingLongValue(bytes):
+    """Reference to a value that isn't in the long value tree.
+    """
+
+
+class MultiValue(list):
+    """Values of a multi-valued column.
+    """
+
+
+def encode_tagged(columnType, value, longValues):
+    """Returns the flags (None if there are no flags) and data of a tagged value. Long values are appended to
+    longValues and referenced by their id.
+    """
+    if isinstance(value, LongValue):
+        longValues.append(bytes(value))
+        return TAGGED_DATA_TYPE_STORED, pack("<L", len(longValues))
+    elif isinstance(value, MissingLongValue):
+        return TAGGED_DATA_TYPE_STORED, pack("<L", 1000)
+    elif isinstance(value, MultiValue):
+        offsets = b""
+        data = b""
+        for item in value:
+            offset = 2 * len(value) + len(data)
+            if isinstance(item, LongValue):
+                longValues.append(bytes(item))
+                offsets += pack("<H", MULTI_VALUE_LONG_VALUE | offset)
+                data += pack("<L", len(longValues))
+            else:
+                offsets += pack("<H", offset)
+                data += encode_value(columnType, item)
+        return TAGGED_DATA_TYPE_MULTI_VALUE, offsets + data
+    return None, encode_value(columnType, value)
+
+
+def build_record(row, columns=COLUMNS, longValues=None):
+    """Builds the data of a record from a {column name: value} dictionary, values being python objects.
+    """
+    if longValues is None:
+        longValues = []
+    # Values are stored by identifier, whatever the catalog order is
+    columns = sorted(columns, key=lambda column: column[1])
+    fixed = [column for column in columns if column[1] <= 127]
+    variable = [column for column in columns if 127 < column[1] <= 255]
+    tagged = [column for column in columns if column[1] > 255 and row.get(column[0]) is not None]
+
+    lastFixed = 0
+    fixedData = b""
+    for name, identifier, columnType, size in fixed:
+        if row.get(name) is not None:
+            lastFixed = identifier
+    for name, identifier, columnType, size in fixed:
+        if identifier <= lastFixed:
+            value = row.get(name)
+            fixedData += encode_value(columnType, value) if value is not None else b"\x00" * size
+
+    offsets = b""
+    variableData = b""
+    for name, identifier, columnType, size in variable:
+        value = row.get(name)
+        if value is None:
+            offsets += pack("<H", 0x8000 | len(variableData))
+        else:
+            variableData += encode_value(columnType, value)
+            offsets += pack("<H", len(variableData))
+
+    taggedArray = b""
+    taggedData = b""
+    for name, identifier, columnType, size in tagged:
+        flags, data = encode_tagged(columnType, row[name], longValues)
+        offset = 4 * len(tagged) + len(taggedData)
+        if flags is not None:
+            # The flags byte goes before the data
+            offset |= 0x4000
+            data = bytes((flags,)) + data
+        taggedArray += pack("<HH", identifier, offset)
+        taggedData += data
+
+    header = pack("<BBH", lastFixed, 127 + len(variable), 4 + len(fixedData))
+    return header + fixedData + offsets + variableData + taggedArray + taggedData
+
+
+def normalize_key(columnType, value):
+    """Normalizes a column value as ESE does for index keys (just the types used here).
+    """
+    if columnType == JET_coltypLong:
+        return b"\x7f" + pack(">L", (value + 0x80000000) & 0xffffffff)
+    elif columnType == JET_coltypLongLong:
+        return b"\x7f" + pack(">Q", (value + 0x8000000000000000) & 0xffffffffffffffff)
+    elif len(value) == 0:
+        return b"\x40"
+    key = b"\x7f"
+    for offset in range(0, len(value), 8):
+        chunk = value[offset:offset + 8]
+        key += chunk + b"\x00" * (8 - len(chunk)) + bytes((9 if offset + 8 < len(value) else len(chunk),))
+    return key
+
+
+def build_tree(pages, firstPage, entries, objectId, rowsPerPage, fanout, flags=0):
+    """Builds a B-tree out of (key, data) entries sorted by key, starting at page firstPage. Keys are prefix
+    compressed against the common key of every non root page. Returns the root page number and the next free page.
+    """
+    rootPage = firstPage
+    chunks = [entries[i:i + rowsPerPage] for i in range(0, len(entries), rowsPerPage)] or [[]]
+    leafPages = list(range(rootPage + 1, rootPage + 1 + len(chunks)))
+    nextFreePage = leafPages[-1] + 1
+
+    def build_entries(items):
+        # Branch keys are the upper bounds of their child pages, the last one is empty
+        commonKey = os.path.commonprefix([key for key, _ in items]) if len(items) > 0 else b""
+        tags = [(0, commonKey)]
+        for key, data in items:
+            if len(commonKey) > 0:
+                local = key[len(commonKey):]
+                tags.append((TAG_COMMON, pack("<HH", len(commonKey), len(local)) + local + data))
+            else:
+                tags.append((0, build_leaf_entry(key, data)))
+        return tags
+
+    for index, (leafPage, chunk) in enumerate(zip(leafPages, chunks)):
+        pages[leafPage] = build_page(leafPage, FLAGS_LEAF | flags, build_entries(chunk), fatherDataPage=objectId,
+                                     nextPage=leafPages[index + 1] if index + 1 < len(leafPages) else 0,
+                                     previousPage=leafPages[index - 1] if index > 0 else 0)
+
+    # (page number, last key) of every page of the current level
+    level = [(leafPage, chunk[-1][0] if len(chunk) > 0 else b"") for leafPage, chunk in zip(leafPages, chunks)]
+    levelFlags = FLAGS_PARENT
+    while fanout is not None and len(level) > fanout:
+        children = [level[i:i + fanout] for i in range(0, len(level), fanout)]
+        level = []
+        for childPages in children:
+            items = [(key, pack("<L", pageNum)) for pageNum, key in childPages[:-1]]
+            items.append((b"", pack("<L", childPages[-1][0])))
+            pages[nextFreePage] = build_page(nextFreePage, levelFlags | flags, build_entries(items),
+                                             fatherDataPage=objectId)
+            level.append((nextFreePage, childPages[-1][1]))
+            nextFreePage += 1
+        levelFlags = 0
+
+    rootTags = [(0, b"")]
+    for index, (pageNum, key) in enumerate(level):
+        rootTags.append((0, build_leaf_entry(key if index + 1 < len(level) else b"", pack("<L", pageNum))))
+    pages[rootPage] = build_page(rootPage, FLAGS_ROOT | levelFlags | flags, rootTags, fatherDataPage=objectId)
+    return rootPage, nextFreePage
+
+
+def build_database(fileName, tables, rowsPerPage=20, fanout=None):
+    """Writes a database with the given tables, {table name: (columns, rows[, indexes])}. Every table gets a
+    branch root page pointing to leaf pages of up to rowsPerPage records, linked to each other. If fanout is set,
+    branch pages point to up to fanout pages, adding levels of branch pages as needed.
+
+    indexes is a list of (index name, column names, primary). Records are keyed by the primary index, if any, or
+    by their row number. LongValue values go to the table's long value tree, in chunks of LONG_VALUE_CHUNK_SIZE.
+    """
+    pages = {}
+    catalog = []
+    nextFreePage = FIRST_DATA_PAGE
+    for tableIndex, (tableName, table) in enumerate(tables.items()):
+        columns, rows = table[:2]
+        indexes = table[2] if len(table) > 2 else []
+        columnTypes = dict((name, columnType) for name, _, columnType, _ in columns)
+        objectId = 10 + tableIndex
+
+        def make_key(row, columnNames):
+            return b"".join(normalize_key(columnTypes[name], row[name]) for name in columnNames)
+
+        primary = [index for index in indexes if index[2] is True]
+        if len(primary) > 0:
+            keys = [make_key(row, primary[0][1]) for row in rows]
+        else:
+            keys = [pack(">L", rowNumber) for rowNumber in range(len(rows))]
+        longValues = []
+        entries = sorted(zip(keys, [build_record(row, columns, longValues) for row in rows]))
+        rootPage, nextFreePage = build_tree(pages, nextFreePage, entries, objectId, rowsPerPage, fanout)
+
+        catalog.append(build_catalog_entry(pack("<LHLLL", objectId, CATALOG_TYPE_TABLE, objectId, rootPage, 0),
+                                           tableName))
+        for name, identifier, columnType, size in columns:
+            catalog.append(build_catalog_entry(pack("<LHLLLLL", objectId, CATALOG_TYPE_COLUMN, identifier,
+                                                    columnType, size, 0, CODEPAGE_UNICODE), name))
+
+        for indexNumber, (indexName, columnNames, isPrimary) in enumerate(indexes):
+            if isPrimary is True:
+                indexRoot = rootPage
+            else:
+                # Secondary index entries point to the record keys
+                indexEntries = sorted((make_key(row, columnNames), key) for row, key in zip(rows, keys))
+                indexRoot, nextFreePage = build_tree(pages, nextFreePage, indexEntries, objectId, rowsPerPage,
+                                                     fanout, FLAGS_INDEX)
+            catalog.append(build_catalog_entry(pack("<LHLLLLL", objectId, CATALOG_TYPE_INDEX, 100 + indexNumber,
+                                                    indexRoot, 0, 0, 0), indexName))
+
+        if len(longValues) > 0:
+            # A root entry keyed by the long value id, then the chunks keyed by id and offset
+            lvEntries = []
+            for lid, value in enumerate(longValues, 1):
+                lvEntries.append((pack(">L", lid), pack("<LL", 1, len(value))))
+                for offset in range(0, len(value), LONG_VALUE_CHUNK_SIZE):
+                    lvEntries.append((pack(">LL", lid, offset), value[offset:offset + LONG_VALUE_CHUNK_SIZE]))
+            lvRoot, nextFreePage = build_tree(pages, nextFreePage, lvEntries, objectId, rowsPerPage, fanout,
+                                              FLAGS_LONG_VALUE)
+            catalog.append(build_catalog_entry(pack("<LHLLL", objectId, CATALOG_TYPE_LONG_VALUE, objectId + 1000,
+                                                    lvRoot, 0), "LV"))
+
+    catalogTags = [(0, b"\x00" * 16)]
+    for index, entry in enumerate(catalog):
+        catalogTags.append((0, build_leaf_entry(pack(">L", index), entry)))
+    pages[CATALOG_PAGE_NUMBER] = build_page(CATALOG_PAGE_NUMBER, FLAGS_ROOT | FLAGS_LEAF, catalogTags,
+                                            fatherDataPage=2)
+
+    header = ESENT_DB_HEADER()
+    header["DBSignature"] = ESENT_JET_SIGNATURE()
+    header["LogSignature"] = ESENT_JET_SIGNATURE()
+    header["Version"] = VERSION
+    header["FileFormatRevision"] = REVISION
+    header["PageSize"] = PAGE_SIZE
+    header = header.getData()
+    header += b"\x00" * (PAGE_SIZE - len(header))
+
+    with open(fileName, "wb") as fd:
+        # Header and its shadow copy
+        fd.write(header * 2)
+        for pageNum in range(1, nextFreePage):
+            fd.write(pages.get(pageNum, b"\x00" * PAGE_SIZE))
+
+
+def build_rows(count):
+    rows = []
+    for i in range(count):
+        row = {"DNT_col": i, "size_col": i * 1000, "name_col": "user%d" % i, "blob_col": b"\x01\x02" * (i % 3)}
+        if i % 2 == 0:
+            row["ATTm3"] = "tagged%d" % i
+        if i % 3 == 0:
+            row["ATTk4"] = b"\xaa" * 4
+        rows.append(row)
+    return rows
+
+
+class ESEPageTests(unittest.TestCase):
+
+    def test_tags(self):
+        tags = [(0, b"header")] + [(i % 8, b"tag%03d" % i) for i in range(1, 300)]
+        page = ESENT_PAGE({"Version": VERSION, "FileFormatRevision": REVISION, "PageSize": PAGE_SIZE},
+                          build_page(20, FLAGS_LEAF, tags))
+        self.assertEqual(len(page.tagOffsets), 300)
+        for tagNum, tag in enumerate(tags):
+            self.assertEqual(page.getTag(tagNum), tag)
+        self.assertRaises(Exception, page.getTag, 300)
+
+    def test_tags_large_pages(self):
+        # Windows 7 format with 32K pages, the flags are the 3 upper bits of the data's second byte
+        db = {"Version": 0x620, "FileFormatRevision": 0x11, "PageSize": 32768}
+        headerSize = len(ESENT_PAGE_HEADER(db["Version"], db["FileFormatRevision"], db["PageSize"]))
+        self.assertEqual(headerSize, 80)
+
+        values = [b"\x00\x00header", b"\x01" + bytes([(TAG_COMMON << 5) | 0x03]) + b"entry", b"\x05\x06"]
+        data = b"".join(values)
+        tagArray = b""
+        offset = 0
+        for value in values:
+            tagArray = pack("<HH", len(value), offset) + tagArray
+            offset += len(value)
+        header = pack("<QQLLLHHHHL", 0, 0, 0, 0, 1, 0, 0, len(data), len(values), FLAGS_LEAF) + b"\x00" * 40
+        pageData = header + data + b"\x00" * (32768 - len(header) - len(data) - len(tagArray)) + tagArray
+
+        page = ESENT_PAGE(db, pageData)
+        self.assertEqual(page.getTag(0), (0, b"\x00\x00header"))
+        self.assertEqual(page.getTag(1), (TAG_COMMON, b"\x01\x03entry"))
+        self.assertEqual(page.getTag(2), (0, b"\x05\x06"))
+
+
+class RemoteBytesFile(BytesIO):
+    """Stands for secretsdump's RemoteFile, a file object that has to be opened.
+    """
+    def open(self):
+        self.seek(0)
+
+
+class ESETests(unittest.TestCase):
+
+    rows = 95
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.directory, "test.dit")
+        # The catalog doesn't have to list the columns by identifier
+        build_database(self.fileName, {"datatable": (COLUMNS, build_rows(self.rows)),
+                                       "empty_table": (COLUMNS, []),
+                                       "unsorted_table": (COLUMNS[::-1], build_rows(self.rows))})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_rows(self, db, tableName="datatable", columns=None):
+        cursor = db.openTable(tableName, columns)
+        rows = []
+        while True:
+            record = db.getNextRow(cursor)
+            if record is None:
+                break
+            rows.append(record)
+        return rows
+
+    def check_rows(self, rows):
+        self.assertEqual(len(rows), self.rows)
+        for i, record in enumerate(rows):
+            self.assertEqual(record[b"DNT_col"], i)
+            self.assertEqual(record[b"size_col"], i * 1000)
+            self.assertEqual(record[b"name_col"], "user%d" % i)
+            self.assertEqual(record[b"blob_col"], b"0102" * (i % 3))
+            self.assertEqual(record[b"ATTm3"], "tagged%d" % i if i % 2 == 0 else None)
+            self.assertEqual(record[b"ATTk4"], b"aaaaaaaa" if i % 3 == 0 else None)
+
+    def test_local_database(self):
+        db = ESENT_DB(self.fileName)
+        try:
+            self.assertIsInstance(db._ESENT_DB__DB, ESENT_MMAP_FILE)
+            self.check_rows(self.read_rows(db))
+            self.assertEqual(self.read_rows(db, "empty_table"), [])
+            self.assertIsNone(db.openTable("unknown"))
+        finally:
+            db.close()
+
+    def test_remote_database(self):
+        with open(self.fileName, "rb") as fd:
+            remoteFile = RemoteBytesFile(fd.read())
+        db = ESENT_DB(remoteFile, isRemote=True)
+        try:
+            self.assertIsInstance(db._ESENT_DB__DB, ESENT_FILE)
+            self.check_rows(self.read_rows(db))
+        finally:
+            db.close()
+        self.assertTrue(remoteFile.closed)
+
+    def test_projection(self):
+        db = ESENT_DB(self.fileName)
+        try:
+            full = self.read_rows(db)
+            for tableName in ("datatable", "unsorted_table"):
+                columns = ["ATTk4", b"name_col", "size_col", "ATTm3", "blob_col", "DNT_col"]
+                rows = self.read_rows(db, tableName, columns)
+                self.assertEqual(len(rows), self.rows)
+                for record, row in zip(full, rows):
+                    self.assertIsInstance(row, ESENT_ROW)
+                    self.assertEqual(tuple(row), tuple(record[ensureBytes(column)] for column in columns))
+                    self.assertEqual(row["DNT_col"], record[b"DNT_col"])
+                    self.assertEqual(row[b"ATTm3"], row[3])
+                    self.assertIsNone(row.get("unknown"))
+
+            # Just a few columns, the others are never decoded
+            rows = self.read_rows(db, "datatable", ["ATTm3"])
+            self.assertEqual([row[0] for row in rows], [record[b"ATTm3"] for record in full])
+            self.assertEqual(rows[0].keys(), [b"ATTm3"])
+
+            # Columns not in the table are always empty
+            rows = self.read_rows(db, "datatable", ["unknown", "DNT_col"])
+            self.assertEqual([tuple(row) for row in rows], [(None, i) for i in range(self.rows)])
+            self.assertIs(db.getProjection("datatable", ["ATTm3"]), db.getProjection(b"datatable", [b"ATTm3"]))
+        finally:
+            db.close()
+
+    def test_independent_cursors(self):
+        db = ESENT_DB(self.fileName)
+        try:
+            first = db.openTable("datatable", ["DNT_col"])
+            second = db.openTable("datatable")
+            self.assertEqual(db.getNextRow(first)[0], 0)
+            self.assertEqual(db.getNextRow(first)[0], 1)
+            self.assertEqual(db.getNextRow(second)[b"DNT_col"], 0)
+            self.assertEqual(db.getNextRow(first)[0], 2)
+        finally:
+            db.close()
+
+    def test_leaf_page_ranges(self):
+        build_database(self.fileName, {"datatable": (COLUMNS, build_rows(self.rows)),
+                                       "empty_table": (COLUMNS, [])}, rowsPerPage=3, fanout=4)
+        db = ESENT_DB(self.fileName)
+        try:
+            full = self.read_rows(db)
+            self.check_rows(full)
+            # 32 leaf pages under two levels of branch pages
+            leafPages = db.getLeafPages("datatable")
+            self.assertEqual(len(leafPages), 32)
+            self.assertEqual(leafPages, sorted(leafPages))
+            self.assertEqual(len(db.getLeafPages("empty_table")), 1)
+
+            for count in (1, 3, 7, 32, 100):
+                pageRanges = db.getLeafPageRanges("datatable", count)
+                self.assertEqual(len(pageRanges), min(count, len(leafPages)))
+                self.assertEqual(pageRanges[0][0], leafPages[0])
+                self.assertEqual(pageRanges[-1][1], 0)
+                rows = []
+                for pageRange in pageRanges:
+                    cursor = db.openTable("datatable", ["DNT_col"], pageRange=pageRange)
+                    while True:
+                        row = db.getNextRow(cursor)
+                        if row is None:
+                            break
+                        rows.append(row[0])
+                self.assertEqual(rows, list(range(self.rows)))
+
+            # Ranges starting at a given leaf page, the rows before it are skipped
+            pageRanges = db.getLeafPageRanges("datatable", 2, leafPages[10])
+            self.assertEqual(pageRanges[0][0], leafPages[10])
+            cursor = db.openTable("datatable", ["DNT_col"], pageRange=pageRanges[0])
+            self.assertEqual(db.getNextRow(cursor)[0], 30)
+            self.assertRaises(Exception, db.getLeafPageRanges, "datatable", 2, CATALOG_PAGE_NUMBER)
+        finally:
+            db.close()
+
+    def test_page_cache(self):
+        db = ESENT_DB(self.fileName, pageCacheSize=2)
+        try:
+            page = db.getPage(CATALOG_PAGE_NUMBER)
+            self.assertIs(db.getPage(CATALOG_PAGE_NUMBER), page)
+            # Only the last pages used are kept
+            self.check_rows(self.read_rows(db))
+            self.assertLessEqual(len(db._ESENT_DB__pageCache), 2)
+            self.assertIsNot(db.getPage(CATALOG_PAGE_NUMBER), page)
+        finally:
+            db.close()
+
+        db = ESENT_DB(self.fileName, pageCacheSize=0)
+        try:
+            self.check_rows(self.read_rows(db))
+            self.assertEqual(len(db._ESENT_DB__pageCache), 0)
+        finally:
+            db.close()
+
+
+class ESEIndexTests(unittest.TestCase):
+
+    rows = 95
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.directory, "test.dit")
+        # Records are stored by their primary key, whatever order they're inserted
+        rows = build_rows(self.rows)
+        random.Random(0).shuffle(rows)
+        indexes = [("DNT_index", ["DNT_col"], True), ("blob_index", ["blob_col", "DNT_col"], False),
+                   ("size_index", ["size_col"], False)]
+        build_database(self.fileName, {"datatable": (COLUMNS, rows, indexes)}, rowsPerPage=3, fanout=4)
+        self.db = ESENT_DB(self.fileName)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def read_rows(self, cursor):
+        rows = []
+        while True:
+            row = self.db.getNextRow(cursor)
+            if row is None:
+                break
+            rows.append(row[0])
+        return rows
+
+    def test_normalize_key(self):
+        self.assertEqual(normalizeKeyColumn(JET_coltypLong, 1), b"\x7f\x80\x00\x00\x01")
+        self.assertEqual(normalizeKeyColumn(JET_coltypLong, -1), b"\x7f\x7f\xff\xff\xff")
+        self.assertEqual(normalizeKeyColumn(JET_coltypLong, 1, True), b"\x80\x7f\xff\xff\xfe")
+        self.assertEqual(normalizeKeyColumn(JET_coltypUnsignedShort, 0x1234), b"\x7f\x12\x34")
+        self.assertEqual(normalizeKeyColumn(JET_coltypLong, None), b"\x00")
+        self.assertEqual(normalizeKeyColumn(JET_coltypBinary, b""), b"\x40")
+        self.assertEqual(normalizeKeyColumn(JET_coltypBinary, b"\x01" * 9),
+                         b"\x7f" + b"\x01" * 8 + b"\x09" + b"\x01" + b"\x00" * 7 + b"\x01")
+        self.assertEqual(normalizeKeyColumn(JET_coltypGUID, bytes(range(16))),
+                         b"\x7f" + bytes((10, 11, 12, 13, 14, 15, 8, 9, 6, 7, 4, 5, 0, 1, 2, 3)))
+        self.assertRaises(Exception, normalizeKeyColumn, JET_coltypText, "user")
+        for columnType, values in ((JET_coltypLong, [-5, -1, 0, 1, 1000]),
+                                   (JET_coltypLongLong, [-2 ** 40, 0, 2 ** 40]),
+                                   (JET_coltypBinary, [b"", b"\x00", b"\x00\x00", b"\x01" * 8, b"\x01" * 9, b"\x02"])):
+            keys = [normalizeKeyColumn(columnType, value) for value in values]
+            self.assertEqual(keys, sorted(keys))
+        self.assertEqual(self.db.makeKey("datatable", [("blob_col", b"\x01"), (b"DNT_col", 1)]),
+                         normalize_key(JET_coltypBinary, b"\x01") + normalize_key(JET_coltypLong, 1))
+
+    def test_primary_index(self):
+        cursor = self.db.openTable("datatable", ["DNT_col"], indexName="DNT_index")
+        self.assertEqual(self.read_rows(cursor), list(range(self.rows)))
+        cursor = self.db.openTable("datatable", ["DNT_col"])
+        self.assertEqual(self.read_rows(cursor), list(range(self.rows)))
+
+        self.db.seek(cursor, self.db.makeKey("datatable", [("DNT_col", 50)]))
+        self.assertEqual(self.read_rows(cursor), list(range(50, self.rows)))
+        self.db.seek(cursor, self.db.makeKey("datatable", [("DNT_col", 50)]),
+                     self.db.makeKey("datatable", [("DNT_col", 60)]))
+        self.assertEqual(self.read_rows(cursor), list(range(50, 61)))
+        # Keys not in the table
+        self.db.seek(cursor, self.db.makeKey("datatable", [("DNT_col", -5)]))
+        self.assertEqual(self.db.getNextRow(cursor)[0], 0)
+        self.db.seek(cursor, self.db.makeKey("datatable", [("DNT_col", 1000)]))
+        self.assertIsNone(self.db.getNextRow(cursor))
+
+        # Every row can be found, reading just the pages in the way to it
+        for dnt in range(self.rows):
+            db = ESENT_DB(self.fileName)
+            try:
+                row = db.getRow("datatable", db.makeKey("datatable", [("DNT_col", dnt)]), columns=["DNT_col", "name_col"])
+                self.assertEqual(tuple(row), (dnt, "user%d" % dnt))
+                self.assertLessEqual(len(db._ESENT_DB__pageCache), 8)
+            finally:
+                db.close()
+
+    def test_secondary_index(self):
+        cursor = self.db.openTable("datatable", ["DNT_col"], indexName="blob_index")
+        self.assertEqual(self.read_rows(cursor), [i for j in range(3) for i in range(self.rows) if i % 3 == j])
+
+        prefix = self.db.makeKey("datatable", [("blob_col", b"\x01\x02")])
+        self.db.seek(cursor, prefix, prefix)
+        self.assertEqual(self.read_rows(cursor), [i for i in range(self.rows) if i % 3 == 1])
+        self.db.seek(cursor, self.db.makeKey("datatable", [("blob_col", b"\x01\x02"), ("DNT_col", 50)]), prefix)
+        self.assertEqual(self.read_rows(cursor), [i for i in range(50, self.rows) if i % 3 == 1])
+
+        row = self.db.getRow("datatable", self.db.makeKey("datatable", [("size_col", 42000)]), "size_index",
+                             ["DNT_col", "size_col"])
+        self.assertEqual(tuple(row), (42, 42000))
+        self.assertEqual(self.db.getRow("datatable", self.db.makeKey("datatable", [("size_col", 42001)]),
+                                        "size_index", ["DNT_col"]), None)
+        self.assertEqual(self.db.getRow("datatable", self.db.makeKey("datatable", [("size_col", 42000)]),
+                                        "size_index")[b"name_col"], "user42")
+        self.assertRaises(Exception, self.db.openTable, "datatable", indexName="unknown")
+
+
+class ESELongValueTests(unittest.TestCase):
+
+    rows = 30
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.directory, "test.dit")
+        rows = build_rows(self.rows)
+        self.values = {}
+        for i, row in enumerate(rows):
+            if i % 3 == 0:
+                # Several chunks, over several pages
+                self.values[i] = bytes((i + j) % 256 for j in range(2500 + i))
+                row["ATTk4"] = LongValue(self.values[i])
+            if i % 4 == 0:
+                row["ATTm3"] = MultiValue(["first%d" % i, LongValue(("second%d" % i).encode("utf-16le") * 100),
+                                           "third"])
+        build_database(self.fileName, {"datatable": (COLUMNS, rows)}, rowsPerPage=3, fanout=4)
+        self.db = ESENT_DB(self.fileName)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def check_row(self, i, blob, multiValue):
+        self.assertEqual(blob, hexlify(self.values[i]) if i % 3 == 0 else None)
+        if i % 4 == 0:
+            self.assertEqual(multiValue, ["first%d" % i, "second%d" % i * 100, "third"])
+        else:
+            self.assertEqual(multiValue, "tagged%d" % i if i % 2 == 0 else None)
+
+    def test_long_values(self):
+        for columns in (None, ["DNT_col", "ATTk4", "ATTm3"]):
+            cursor = self.db.openTable("datatable", columns)
+            for i in range(self.rows):
+                row = self.db.getNextRow(cursor)
+                self.assertEqual(row[b"DNT_col"], i)
+                self.check_row(i, row[b"ATTk4"], row[b"ATTm3"])
+            self.assertIsNone(self.db.getNextRow(cursor))
+
+        # Ids are given in column identifier order, ATTm3 goes first
+        self.assertEqual(self.db.getLongValue("datatable", 1), "second0".encode("utf-16le") * 100)
+        self.assertEqual(self.db.getLongValue("datatable", pack("<L", 2)), self.values[0])
+        self.assertRaises(Exception, self.db.getLongValue, "datatable", 1000)
+
+    def test_stream_long_values(self):
+        for columns in (None, ["ATTk4", "ATTm3"]):
+            cursor = self.db.openTable("datatable", columns, streamLongValues=True)
+            for i in range(self.rows):
+                row = self.db.getNextRow(cursor)
+                if i % 3 == 0:
+                    reader = row[b"ATTk4"]
+                    self.assertIsInstance(reader, ESENT_LONG_VALUE)
+                    self.assertEqual(reader.size, len(self.values[i]))
+                    # Reads not aligned to the chunks
+                    data = reader.read(10) + reader.read(1500) + reader.read(0)
+                    data += b"".join(reader)
+                    self.assertEqual(data, self.values[i])
+                    self.assertEqual(reader.read(), b"")
+                if i % 4 == 0:
+                    self.assertEqual(row[b"ATTm3"][0], "first%d" % i)
+                    self.assertEqual(row[b"ATTm3"][1].read(), ("second%d" % i).encode("utf-16le") * 100)
+
+    def test_missing_long_value(self):
+        rows = build_rows(3)
+        rows[0]["ATTk4"] = LongValue(b"value")
+        rows[1]["ATTk4"] = MissingLongValue()
+        fileName = os.path.join(self.directory, "missing.dit")
+        build_database(fileName, {"datatable": (COLUMNS, rows)})
+
+        # The row is still decoded, the reference being returned instead of the value
+        db = ESENT_DB(fileName)
+        try:
+            for columns in (None, ["DNT_col", "ATTk4"]):
+                cursor = db.openTable("datatable", columns)
+                with self.assertLogs("impacket", level="ERROR"):
+                    values = [db.getNextRow(cursor)[b"ATTk4"] for i in range(len(rows))]
+                self.assertEqual(values, [hexlify(b"value"), hexlify(pack("<L", 1000)), None])
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
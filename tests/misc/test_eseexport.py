@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Tests for the streaming ESE table exporter, run against the synthetic
+#   databases of test_ese.
+#
+import csv
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from binascii import hexlify
+
+from impacket.ese import ESENT_DB, JET_coltypGUID
+from impacket.examples.eseexport import ESETableExporter
+from tests.misc.test_ese import COLUMNS, build_database, build_rows
+
+# GUIDs are decoded as raw bytes
+GUID_COLUMNS = COLUMNS + [("guid_col", 3, JET_coltypGUID, 16)]
+
+
+class ESETableExporterTests(unittest.TestCase):
+
+    rows = 95
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.directory, "test.dit")
+        self.outputFileName = os.path.join(self.directory, "output")
+        self.checkpointFileName = os.path.join(self.directory, "checkpoint")
+        rows = build_rows(self.rows)
+        for i, row in enumerate(rows):
+            if i % 5 == 0:
+                row["guid_col"] = self.guid(i)
+        build_database(self.fileName, {"datatable": (GUID_COLUMNS, rows)}, rowsPerPage=7)
+        self.db = ESENT_DB(self.fileName)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def guid(i):
+        return bytes((i + j * 17) % 256 for j in range(16))
+
+    def read(self):
+        with open(self.outputFileName, newline="") as fd:
+            return fd.read()
+
+    def test_json(self):
+        exporter = ESETableExporter(self.db, "datatable", ["DNT_col", "name_col", "blob_col"])
+        stats = exporter.export(self.outputFileName)
+        self.assertEqual(stats["rows"], self.rows)
+        self.assertEqual(stats["errors"], 0)
+
+        lines = self.read().splitlines()
+        self.assertEqual(len(lines), self.rows)
+        self.assertEqual(json.loads(lines[0]), {"DNT_col": 0, "name_col": "user0", "blob_col": ""})
+        self.assertEqual(json.loads(lines[5]), {"DNT_col": 5, "name_col": "user5", "blob_col": "01020102"})
+
+    def test_guid(self):
+        exporter = ESETableExporter(self.db, "datatable", ["DNT_col", "guid_col"])
+        stats = exporter.export(self.outputFileName)
+        self.assertEqual(stats["errors"], 0)
+
+        lines = [json.loads(line) for line in self.read().splitlines()]
+        self.assertEqual(lines[5], {"DNT_col": 5, "guid_col": hexlify(self.guid(5)).decode("utf-8")})
+        self.assertIsNone(lines[6]["guid_col"])
+
+    def test_csv(self):
+        exporter = ESETableExporter(self.db, "datatable", outputFormat="csv")
+        exporter.export(self.outputFileName)
+
+        with open(self.outputFileName, newline="") as fd:
+            rows = list(csv.reader(fd))
+        self.assertEqual(rows[0], [column[0] for column in GUID_COLUMNS])
+        self.assertEqual(len(rows), self.rows + 1)
+        self.assertEqual(rows[1], ["0", "0", "user0", "", "tagged0", "aaaaaaaa",
+                                   hexlify(self.guid(0)).decode("utf-8")])
+        self.assertEqual(rows[2], ["1", "1000", "user1", "0102", "", "", ""])
+
+    def test_resume(self):
+        ESETableExporter(self.db, "datatable", outputFormat="csv").export(self.outputFileName)
+        expected = self.read()
+
+        # Stops after 25 rows, the last checkpoint is the one of row 20
+        exporter = ESETableExporter(self.db, "datatable", outputFormat="csv", checkpointFile=self.checkpointFileName,
+                                    checkpointInterval=10)
+        getNextRow = self.db.getNextRow
+        calls = []
+
+        def interruptedGetNextRow(cursor, **kwargs):
+            # getNextRow calls itself when it moves to the next page
+            if len(kwargs) == 0:
+                calls.append(cursor)
+            if len(calls) > 25:
+                raise KeyboardInterrupt
+            return getNextRow(cursor, **kwargs)
+
+        self.db.getNextRow = interruptedGetNextRow
+        self.assertRaises(KeyboardInterrupt, exporter.export, self.outputFileName)
+        del self.db.getNextRow
+        self.assertEqual(exporter.loadCheckpoint()["rows"], 20)
+        self.assertEqual(len(self.read().splitlines()), 26)
+
+        stats = exporter.export(self.outputFileName)
+        self.assertEqual(stats["rows"], self.rows - 20)
+        self.assertEqual(self.read(), expected)
+        self.assertFalse(os.path.exists(self.checkpointFileName))
+
+    def test_checkpoint_mismatch(self):
+        with open(self.checkpointFileName, "w") as fd:
+            json.dump({"table": "datatable", "columns": ["DNT_col"], "format": "json"}, fd)
+        exporter = ESETableExporter(self.db, "datatable", ["name_col"], checkpointFile=self.checkpointFileName)
+        self.assertRaises(Exception, exporter.export, self.outputFileName)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
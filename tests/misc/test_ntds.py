@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Tests for the offline NTDS.DIT dump of secretsdump, run against a small
+#   synthetic database with Windows 2016 style (AES) encrypted hashes.
+#
+import os
+import shutil
+import tempfile
+import unittest
+from binascii import hexlify
+from struct import pack
+
+from Cryptodome.Cipher import AES, DES
+
+from impacket import ntlm
+from impacket.ese import JET_coltypLong, JET_coltypText, JET_coltypBinary
+from impacket.examples.secretsdump import NTDSHashes, CryptoCommon
+from tests.misc.test_ese import build_database
+
+BOOT_KEY = bytes(range(16))
+PEK = bytes(range(16, 32))
+DOMAIN_SID = (21, 1111, 2222, 3333)
+
+INTERNAL = dict((name, internal.decode("utf-8")) for name, internal in NTDSHashes.NAME_TO_INTERNAL.items())
+
+# Just the columns the dump needs
+COLUMNS = [
+    ("DNT_col", 1, JET_coltypLong, 4),
+    (INTERNAL["name"], 256, JET_coltypText, 0),
+    (INTERNAL["objectSid"], 257, JET_coltypBinary, 0),
+    (INTERNAL["sAMAccountName"], 258, JET_coltypText, 0),
+    (INTERNAL["sAMAccountType"], 259, JET_coltypLong, 4),
+    (INTERNAL["unicodePwd"], 260, JET_coltypBinary, 0),
+    (INTERNAL["pekList"], 261, JET_coltypBinary, 0),
+    (INTERNAL["instanceType"], 262, JET_coltypLong, 4),
+    (INTERNAL["supplementalCredentials"], 263, JET_coltypBinary, 0),
+]
+
+
+def aes_encrypt(key, iv, data):
+    data += b"\x00" * (-len(data) % 16)
+    return AES.new(key, AES.MODE_CBC, iv).encrypt(data)
+
+
+def build_pek_list():
+    keyMaterial = b"\x11" * 16
+    # A single PEK, the list ends with a non-sequential index
+    plainText = b"\x00" * 32 + pack("<L", 0) + PEK + pack("<L", 0x08080808)
+    return b"\x03\x00\x00\x00" + b"\x00" * 4 + keyMaterial + aes_encrypt(BOOT_KEY, keyMaterial, plainText)
+
+
+def build_unicode_pwd(ntHash, rid):
+    key1, key2 = CryptoCommon().deriveKey(rid)
+    desLayer = DES.new(key1, DES.MODE_ECB).encrypt(ntHash[:8]) + DES.new(key2, DES.MODE_ECB).encrypt(ntHash[8:])
+    return encrypt_secret(desLayer, rid)
+
+
+def encrypt_secret(data, rid):
+    keyMaterial = pack("<L", rid) * 4
+    return b"\x13\x00\x00\x00" + b"\x00" * 4 + keyMaterial + b"\x00" * 4 + aes_encrypt(PEK, keyMaterial, data)
+
+
+def build_supplemental_credentials(rid):
+    # An AES256 Kerberos key and the cleartext password, see [MS-SAMR] 2.2.10
+    key = pack("<L", rid) * 8
+    kerberosKeys = pack("<HHHHHHHHLL", 4, 0, 1, 0, 0, 0, 0, 0, 0, 4096) + \
+        pack("<HHLLLLL", 0, 0, 0, 4096, 18, len(key), 48) + key
+    properties = b""
+    for name, value in (("Primary:Kerberos-Newer-Keys", kerberosKeys),
+                        ("Primary:CLEARTEXT", ("Password%d" % rid).encode("utf-16le"))):
+        name = name.encode("utf-16le")
+        value = hexlify(value)
+        properties += pack("<HHH", len(name), len(value), 0) + name + value
+    userProperties = pack("<LLHH", 0, 0, 0, 0) + b"\x00" * 96 + pack("<HH", 0x50, 2) + properties
+    return encrypt_secret(userProperties, rid)
+
+
+def build_user(rid):
+    sid = b"\x01\x05" + b"\x00" * 5 + b"\x05" + pack(">LLLLL", *(DOMAIN_SID + (rid,)))
+    return {
+        "DNT_col": rid,
+        INTERNAL["name"]: "user%d" % rid,
+        INTERNAL["objectSid"]: sid,
+        INTERNAL["sAMAccountName"]: "user%d" % rid,
+        INTERNAL["sAMAccountType"]: NTDSHashes.SAM_NORMAL_USER_ACCOUNT,
+        INTERNAL["unicodePwd"]: build_unicode_pwd(ntlm.compute_nthash("Password%d" % rid), rid),
+        INTERNAL["instanceType"]: 4,
+    }
+
+
+class NTDSHashesTests(unittest.TestCase):
+
+    users = 150
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.directory, "ntds.dit")
+        # A user before the pekList, that has to be kept until it's decrypted, and objects that aren't users
+        rows = [build_user(1000), {"DNT_col": 1, INTERNAL["name"]: "domain", INTERNAL["pekList"]: build_pek_list()}]
+        for rid in range(1001, 1001 + self.users):
+            rows.append(build_user(rid))
+            if rid % 3 == 0:
+                rows[-1][INTERNAL["supplementalCredentials"]] = build_supplemental_credentials(rid)
+            if rid % 10 == 0:
+                rows.append({"DNT_col": rid, INTERNAL["name"]: "container%d" % rid})
+        build_database(self.fileName, {"datatable": (COLUMNS, rows)}, rowsPerPage=7, fanout=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def dump(self, workers, outputFileName=None, justNTLM=True):
+        secrets = []
+        ntdsHashes = NTDSHashes(self.fileName, BOOT_KEY, useVSSMethod=True, justNTLM=justNTLM, workers=workers,
+                                outputFileName=outputFileName,
+                                perSecretCallback=lambda secretType, secret: secrets.append((secretType, secret)))
+        try:
+            ntdsHashes.dump()
+        finally:
+            ntdsHashes.finish()
+        return secrets
+
+    def test_dump(self):
+        secrets = self.dump(1)
+        expected = []
+        for rid in range(1000, 1001 + self.users):
+            expected.append((NTDSHashes.SECRET_TYPE.NTDS, "user%d:%d:%s:%s:::" % (
+                rid, rid, hexlify(ntlm.LMOWFv1("", "")).decode("utf-8"),
+                hexlify(ntlm.compute_nthash("Password%d" % rid)).decode("utf-8"))))
+        self.assertEqual(secrets, expected)
+
+    def test_dump_workers(self):
+        expected = self.dump(1, os.path.join(self.directory, "sequential"))
+        for workers in (2, 3):
+            outputFileName = os.path.join(self.directory, "parallel%d" % workers)
+            self.assertEqual(self.dump(workers, outputFileName), expected)
+            with open(outputFileName + ".ntds") as fd:
+                self.assertEqual(fd.read(), "".join(secret + "\n" for _, secret in expected))
+
+    def test_dump_workers_supplemental_credentials(self):
+        expected = self.dump(1, os.path.join(self.directory, "sequential"), justNTLM=False)
+        kerberosKeys = [secret for secretType, secret in expected if secretType == NTDSHashes.SECRET_TYPE.NTDS_KERBEROS]
+        clearTextPwds = [secret for secretType, secret in expected
+                         if secretType == NTDSHashes.SECRET_TYPE.NTDS_CLEARTEXT]
+        rids = [rid for rid in range(1001, 1001 + self.users) if rid % 3 == 0]
+        self.assertEqual(kerberosKeys, ["user%d:aes256-cts-hmac-sha1-96:%s" % (rid, hexlify(pack("<L", rid) * 8)
+                                                                               .decode("utf-8")) for rid in rids])
+        self.assertEqual(clearTextPwds, ["user%d:CLEARTEXT:Password%d" % (rid, rid) for rid in rids])
+
+        for workers in (2, 3):
+            outputFileName = os.path.join(self.directory, "parallel%d" % workers)
+            self.assertEqual(self.dump(workers, outputFileName, justNTLM=False), expected)
+            with open(outputFileName + ".ntds.kerberos") as fd:
+                self.assertEqual(fd.read(), "".join(secret + "\n" for secret in kerberosKeys))
+            with open(outputFileName + ".ntds.cleartext") as fd:
+                self.assertEqual(fd.read(), "".join(secret + "\n" for secret in clearTextPwds))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Tests for the binary registry hive parser, run against small synthetic
+#   hives built here.
+#
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from io import BytesIO, StringIO
+from struct import pack
+
+from impacket.winregistry import REG_REGF, ROOT_KEY, REG_SZ, REG_DWORD, REG_BINARY, REG_MULTISZ, REG_QWORD, \
+    REG_EXPAND_SZ, REG_NK, HBIN_START, HBIN_HEADER_SIZE, BIG_DATA_SEGMENT_SIZE, saveRegistryParser, \
+    exportRegistryParser, get_registry_parser, exportRegFile, exportJsonLines, formatRegValue, decodeValueData
+
+HBIN_SIZE_ALIGNMENT = 4096
+
+
+def lh_hash(name):
+    res = 0
+    for char in name.upper():
+        res = (res * 37 + ord(char)) % 0x100000000
+    return res
+
+
+def encode_key_name(name):
+    # Compressed (latin-1) when possible, UTF-16LE otherwise
+    try:
+        return 0x20, name.encode("latin-1")
+    except UnicodeEncodeError:
+        return 0, name.encode("utf-16le")
+
+
+class HiveBuilder:
+    """Lays out the cells of a hive in a single hbin.
+
+    A key is a dict with optional "keys" (ordered dict of name -> key), "values" (list of (name, type, data),
+    an empty name for the default value and an int for inline DWORDs) and "class" (str) items.
+    """
+    def __init__(self, listType="lh", listSize=None):
+        self.listType = listType
+        self.listSize = listSize
+        self.cells = b""
+
+    def add_cell(self, data):
+        offset = HBIN_HEADER_SIZE + len(self.cells)
+        size = (len(data) + 4 + 7) & ~7
+        self.cells += pack("<l", -size) + data + b"\x00" * (size - len(data) - 4)
+        return offset
+
+    def add_subkey_list(self, children):
+        # Hash lists are sorted by upper case name
+        children = sorted(children, key=lambda child: child[0].upper())
+        listSize = self.listSize or len(children)
+        lists = []
+        for i in range(0, len(children), listSize):
+            records = b""
+            for name, offset in children[i:i+listSize]:
+                if self.listType == "lf":
+                    records += pack("<L", offset) + name[:4].encode("latin-1", "replace").ljust(4, b"\x00")
+                else:
+                    records += pack("<LL", offset, lh_hash(name))
+            lists.append(self.add_cell(self.listType.encode("utf-8") + pack("<H", len(records) // 8) + records))
+        if len(lists) == 1:
+            return lists[0]
+        return self.add_cell(b"ri" + pack("<H", len(lists)) + b"".join(pack("<L", offset) for offset in lists))
+
+    def add_value(self, name, valueType, data):
+        if isinstance(data, int):
+            # Inline data, DataLen has the high bit set
+            dataLen, offsetData = 0x80000004, data
+        elif len(data) > BIG_DATA_SEGMENT_SIZE:
+            # Big data, a db cell pointing to the list of segments
+            segments = [self.add_cell(data[i:i+BIG_DATA_SEGMENT_SIZE])
+                        for i in range(0, len(data), BIG_DATA_SEGMENT_SIZE)]
+            segmentList = self.add_cell(b"".join(pack("<L", offset) for offset in segments))
+            dataLen, offsetData = len(data), self.add_cell(b"db" + pack("<HL", len(segments), segmentList))
+        else:
+            dataLen, offsetData = len(data), self.add_cell(data) if len(data) > 0 else 0
+        return self.add_cell(b"vk" + pack("<HLLLHH", len(name), dataLen, offsetData, valueType,
+                                          1 if len(name) > 0 else 0, 0) + name.encode("utf-8"))
+
+    def add_key(self, name, key, skOffset, isRoot=False):
+        children = [(childName, self.add_key(childName, child, skOffset))
+                    for childName, child in key.get("keys", {}).items()]
+        subKeyList = self.add_subkey_list(children) if len(children) > 0 else -1
+
+        values = [self.add_value(*value) for value in key.get("values", [])]
+        valueList = self.add_cell(b"".join(pack("<L", offset) for offset in values)) if len(values) > 0 else -1
+
+        className = key.get("class", "").encode("utf-16le")
+        classOffset = self.add_cell(className) if len(className) > 0 else -1
+
+        keyType, keyName = encode_key_name(name)
+        return self.add_cell(b"nk" + pack("<HQLlLLlLLlll20sHH", ROOT_KEY if isRoot else keyType, 0, 0, 0,
+                                          len(children), 0, subKeyList, 0, len(values), valueList, skOffset,
+                                          classOffset, b"", len(keyName), len(className)) + keyName)
+
+    def build(self, root, rootName="ROOT", rootOffset=None):
+        # An unallocated cell first, so the root key isn't the first cell of the hbin
+        self.cells = pack("<l", 16) + b"\x00" * 12
+        skOffset = self.add_cell(b"sk" + pack("<HllLL", 0, 0, 0, 1, 0))
+        rootKey = self.add_key(rootName, root, skOffset, isRoot=True)
+
+        hbinSize = (HBIN_HEADER_SIZE + len(self.cells) + HBIN_SIZE_ALIGNMENT - 1) & ~(HBIN_SIZE_ALIGNMENT - 1)
+        cells = self.cells + b"\x00" * (hbinSize - HBIN_HEADER_SIZE - len(self.cells))
+        hbin = b"hbin" + pack("<LL", 0, hbinSize) + b"\x00" * (HBIN_HEADER_SIZE - 12) + cells
+
+        regf = REG_REGF()
+        regf["MajorVersion"] = 1
+        regf["MinorVersion"] = 5
+        regf["OffsetFirstRecord"] = rootKey if rootOffset is None else rootOffset
+        regf["DataSize"] = hbinSize
+        regf = regf.getData()
+        assert len(regf) == HBIN_START
+        return regf + hbin
+
+
+def build_hive(fileName, root, listType="lh", listSize=None, rootOffset=None):
+    with open(fileName, "wb") as fd:
+        fd.write(HiveBuilder(listType, listSize).build(root, rootOffset=rootOffset))
+
+
+def build_tree(keys=30, depth=2):
+    root = {"keys": {}, "values": [("", REG_SZ, "root".encode("utf-16le"))]}
+    for i in range(keys):
+        key = {"keys": {}, "values": [("Index", REG_DWORD, i), ("Name", REG_SZ, ("key%d" % i).encode("utf-16le")),
+                                      ("Blob", REG_BINARY, bytes([i]) * 20)],
+               "class": "%08x" % i}
+        parent = key
+        for level in range(depth):
+            child = {"keys": {}, "values": [("Level", REG_DWORD, level)]}
+            parent["keys"]["Level%d" % level] = child
+            parent = child
+        root["keys"]["Key%d" % i] = key
+    return root
+
+
+class RemoteBytesFile(BytesIO):
+    """Stands for secretsdump's RemoteFile, a file object that has to be opened.
+    """
+    def open(self):
+        self.seek(0)
+
+
+class RegistryHiveTests(unittest.TestCase):
+
+    keys = 30
+    listType = "lh"
+    listSize = None
+    subKeyIndexSize = 256
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.directory, "SYSTEM")
+        build_hive(self.fileName, build_tree(self.keys), self.listType, self.listSize)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_hive(self, reg):
+        self.assertEqual(reg.rootKey["KeyName"], b"ROOT")
+        self.assertEqual(reg.getValue("\\default"), (REG_SZ, "root".encode("utf-16le")))
+        for i in (0, 7, self.keys - 1):
+            self.assertEqual(reg.getValue("Key%d\\Index" % i), (REG_DWORD, i))
+            self.assertEqual(reg.getValue("\\Key%d\\Name" % i), (REG_SZ, ("key%d" % i).encode("utf-16le")))
+            self.assertEqual(reg.getValue("Key%d" % i, "Blob"), (REG_BINARY, bytes([i]) * 20))
+            self.assertEqual(reg.getValue("Key%d\\Level0\\Level1\\Level" % i), (REG_DWORD, 1))
+            # The class name comes with the cell padding
+            self.assertEqual(reg.getClass("Key%d" % i)[:16], ("%08x" % i).encode("utf-16le"))
+            self.assertEqual(reg.enumValues(reg.findKey("Key%d" % i)), [b"Index", b"Name", b"Blob"])
+        self.assertIsNone(reg.findKey("Key%d" % self.keys))
+        self.assertIsNone(reg.findKey("Key0\\Level1"))
+        self.assertIsNone(reg.getValue("Key0\\Missing"))
+        self.assertEqual(reg.enumKey(reg.rootKey), sorted(("Key%d" % i for i in range(self.keys)), key=str.upper))
+        self.assertEqual(reg.enumKey(reg.findKey("Key1\\Level0\\Level1")), [])
+
+    def test_local(self):
+        reg = get_registry_parser(self.fileName)
+        reg.close()
+        self.assertIsInstance(reg, saveRegistryParser)
+
+        reg = saveRegistryParser(self.fileName, subKeyIndexSize=self.subKeyIndexSize)
+        try:
+            self.check_hive(reg)
+        finally:
+            reg.close()
+
+    def test_remote(self):
+        with open(self.fileName, "rb") as fd:
+            reg = saveRegistryParser(RemoteBytesFile(fd.read()), isRemote=True, subKeyIndexSize=self.subKeyIndexSize)
+        self.check_hive(reg)
+        reg.close()
+
+    def test_find_keys(self):
+        reg = saveRegistryParser(self.fileName, subKeyIndexSize=self.subKeyIndexSize)
+        lookups = []
+        findSubKey = reg._saveRegistryParser__findSubKey
+
+        def countedFindSubKey(parentKey, subKey):
+            lookups.append(subKey)
+            return findSubKey(parentKey, subKey)
+
+        reg._saveRegistryParser__findSubKey = countedFindSubKey
+        try:
+            paths = ["Key2\\Level0\\Level1", "\\Key2\\Level0", "Key2", "Key3\\Level0", "\\", "Missing\\Level0",
+                     "Missing\\Level1", "Key2\\Level0\\Missing"]
+            keys = reg.findKeys(paths)
+            self.assertEqual(lookups, ["Key2", "Level0", "Level1", "Key3", "Level0", "Missing", "Missing"])
+            self.assertEqual([key["KeyName"] if key is not None else None for key in keys],
+                             [b"Level1", b"Level0", b"Key2", b"Level0", b"ROOT", None, None, None])
+            for path, key in zip(paths, keys):
+                self.assertIs(reg.findKey(path), key)
+        finally:
+            reg.close()
+
+    def test_root_key_scan(self):
+        # A base block not pointing to the root key
+        build_hive(self.fileName, build_tree(self.keys), self.listType, self.listSize, rootOffset=HBIN_HEADER_SIZE)
+        reg = saveRegistryParser(self.fileName)
+        try:
+            self.check_hive(reg)
+        finally:
+            reg.close()
+
+    def test_cell_cache(self):
+        reg = saveRegistryParser(self.fileName)
+        try:
+            key = reg.findKey("Key3\\Level0")
+            self.assertIsInstance(key, REG_NK)
+            self.assertIs(reg.findKey("Key3\\Level0"), key)
+        finally:
+            reg.close()
+
+        # Just the last cells decoded are kept
+        reg = saveRegistryParser(self.fileName, cellCacheSize=2)
+        try:
+            key = reg.findKey("Key3\\Level0")
+            reg.findKey("Key4\\Level0")
+            self.assertIsNot(reg.findKey("Key3\\Level0"), key)
+            self.assertEqual(reg.findKey("Key3\\Level0").getData(), key.getData())
+        finally:
+            reg.close()
+
+    def test_set_value(self):
+        reg = saveRegistryParser(self.fileName)
+        try:
+            self.assertEqual(reg.getValue("Key5\\Blob"), (REG_BINARY, b"\x05" * 20))
+            reg.setValue("Key5\\Blob", b"\xff" * 20)
+            self.assertEqual(reg.getValue("Key5\\Blob"), (REG_BINARY, b"\xff" * 20))
+        finally:
+            reg.close()
+
+        reg = saveRegistryParser(self.fileName)
+        try:
+            self.assertEqual(reg.getValue("Key5\\Blob"), (REG_BINARY, b"\xff" * 20))
+        finally:
+            reg.close()
+
+    def test_walk_keys(self):
+        reg = saveRegistryParser(self.fileName, subKeyIndexSize=self.subKeyIndexSize)
+        try:
+            names = sorted(("Key%d" % i for i in range(self.keys)), key=str.upper)
+            expected = [""]
+            for name in names:
+                expected.extend([name, name + "\\Level0", name + "\\Level0\\Level1"])
+            walked = list(reg.walkKeys())
+            self.assertEqual([path for path, _, _ in walked], expected)
+            self.assertEqual(walked[0][2], [("", REG_SZ, "root".encode("utf-16le"))])
+            self.assertEqual(walked[1][1]["KeyName"], names[0].encode("utf-8"))
+            self.assertEqual(walked[1][2], [("Index", REG_DWORD, pack("<L", int(names[0][3:]))),
+                                            ("Name", REG_SZ, names[0].lower().encode("utf-16le")),
+                                            ("Blob", REG_BINARY, bytes([int(names[0][3:])]) * 20)])
+
+            self.assertEqual([(path, values) for path, _, values in reg.walkKeys("\\Key4\\Level0", False)],
+                             [("Key4\\Level0", None), ("Key4\\Level0\\Level1", None)])
+            self.assertEqual(list(reg.walkKeys("Missing")), [])
+
+            output = StringIO()
+            with redirect_stdout(output):
+                reg.walk("\\")
+            self.assertEqual(output.getvalue().splitlines()[:3], [names[0], "  Level0", "    Level1"])
+            self.assertEqual(len(output.getvalue().splitlines()), self.keys * 3)
+        finally:
+            reg.close()
+
+    def test_key_name_encoding(self):
+        # Compressed latin-1 names and UTF-16LE ones, looked up by the paths walkKeys yields
+        names = ["Cl\xe9", "\u041a\u043b\u044e\u0447", "Key"]
+        build_hive(self.fileName, {"keys": {name: {"keys": {"Sub\xe9": {}}} for name in names}}, self.listType,
+                   self.listSize)
+        reg = saveRegistryParser(self.fileName, subKeyIndexSize=self.subKeyIndexSize)
+        try:
+            walked = list(reg.walkKeys())
+            self.assertEqual(sorted(path for path, _, _ in walked if "\\" not in path), sorted([""] + names))
+            for path, key, _ in walked[1:]:
+                self.assertEqual(reg.findKey(path).getData(), key.getData())
+                self.assertEqual([subPath for subPath, _, _ in reg.walkKeys(path, False)],
+                                 [subPath for subPath, _, _ in walked if subPath == path or
+                                  subPath.startswith(path + "\\")])
+            self.assertEqual(sorted(reg.enumKey(reg.rootKey)), sorted(names))
+            self.assertIsNone(reg.findKey("Cle"))
+        finally:
+            reg.close()
+
+    def test_export_reg(self):
+        reg = saveRegistryParser(self.fileName, subKeyIndexSize=self.subKeyIndexSize)
+        exportFileName = os.path.join(self.directory, "export.reg")
+        try:
+            with open(exportFileName, "w", encoding="utf-16le", newline="\r\n") as fd:
+                fd.write("\ufeff")
+                self.assertEqual(exportRegFile(reg, fd, rootName="HKEY_LOCAL_MACHINE\\SYSTEM"), self.keys * 3 + 1)
+        finally:
+            reg.close()
+
+        with open(exportFileName, "rb") as fd:
+            lines = fd.read().decode("utf-16").split("\r\n")
+        self.assertEqual(lines[:5], ["Windows Registry Editor Version 5.00", "", "[HKEY_LOCAL_MACHINE\\SYSTEM]",
+                                     '@="root"', ""])
+        self.assertEqual(lines[5:10], ["[HKEY_LOCAL_MACHINE\\SYSTEM\\Key0]", '"Index"=dword:00000000',
+                                       '"Name"="key0"', '"Blob"=hex:' + ",".join(["00"] * 20), ""])
+
+        # And it can be read back
+        exported = get_registry_parser(exportFileName)
+        try:
+            self.assertIsInstance(exported, exportRegistryParser)
+            self.assertEqual(exported.getValue("Key7\\Name"), (REG_SZ, "key7".encode("utf-16le")))
+            self.assertEqual(exported.getValue("Key7\\Blob"), (REG_BINARY, b"\x07" * 20))
+            self.assertEqual(exported.enumKey("Key7\\Level0"), ["Level1"])
+        finally:
+            exported.close()
+
+    def test_export_json(self):
+        reg = saveRegistryParser(self.fileName, subKeyIndexSize=self.subKeyIndexSize)
+        output = StringIO()
+        try:
+            self.assertEqual(exportJsonLines(reg, output, "Key5"), 3)
+        finally:
+            reg.close()
+
+        keys = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([key["path"] for key in keys], ["Key5", "Key5\\Level0", "Key5\\Level0\\Level1"])
+        self.assertEqual(keys[0]["last_write"], "1601-01-01T00:00:00")
+        self.assertEqual(keys[0]["values"], [{"name": "Index", "type": "REG_DWORD", "data": 5},
+                                             {"name": "Name", "type": "REG_SZ", "data": "key5"},
+                                             {"name": "Blob", "type": "REG_BINARY", "data": "05" * 20}])
+
+    def test_big_data(self):
+        # Split into three segments, the last one not full
+        blob = os.urandom(2 * BIG_DATA_SEGMENT_SIZE + 100)
+        build_hive(self.fileName, {"keys": {"Big": {"values": [("Blob", REG_BINARY, blob)]}}}, self.listType,
+                   self.listSize)
+        reg = saveRegistryParser(self.fileName, subKeyIndexSize=self.subKeyIndexSize)
+        output = StringIO()
+        try:
+            self.assertEqual(reg.getValue("Big\\Blob"), (REG_BINARY, blob))
+            self.assertEqual([values for _, _, values in reg.walkKeys("Big")], [[("Blob", REG_BINARY, blob)]])
+            self.assertEqual(exportJsonLines(reg, output, "Big"), 1)
+        finally:
+            reg.close()
+
+        self.assertEqual(json.loads(output.getvalue())["values"],
+                         [{"name": "Blob", "type": "REG_BINARY", "data": blob.hex()}])
+
+
+class RegistryValueFormatTests(unittest.TestCase):
+
+    def test_format_reg_value(self):
+        self.assertEqual(formatRegValue("", REG_SZ, "a\\b\"c\x00".encode("utf-16le")), '@="a\\\\b\\"c"')
+        self.assertEqual(formatRegValue("Count", REG_DWORD, pack("<L", 0x1234)), '"Count"=dword:00001234')
+        self.assertEqual(formatRegValue("Big", REG_QWORD, pack("<Q", 1)), '"Big"=hex(b):01,00,00,00,00,00,00,00')
+        self.assertEqual(formatRegValue("Path", REG_EXPAND_SZ, "%a%".encode("utf-16le")),
+                         '"Path"=hex(2):25,00,61,00,25,00')
+        self.assertEqual(formatRegValue("List", REG_MULTISZ, b""), '"List"=hex(7):')
+        self.assertEqual(formatRegValue("Odd", REG_SZ, b"\x00"), '"Odd"=hex(1):00')
+
+    def test_decode_value_data(self):
+        self.assertEqual(decodeValueData(REG_MULTISZ, "a\x00bc\x00\x00".encode("utf-16le")), ["a", "bc"])
+        self.assertEqual(decodeValueData(REG_MULTISZ, b"\x00\x00"), [])
+        self.assertEqual(decodeValueData(REG_QWORD, pack("<Q", 2 ** 40)), 2 ** 40)
+        self.assertEqual(decodeValueData(REG_DWORD, b"\x01\x02"), "0102")
+        self.assertEqual(decodeValueData(0x20, b"\xff"), "ff")
+
+
+class RegistryHiveLfTests(RegistryHiveTests):
+    listType = "lf"
+
+
+class RegistryHiveRiTests(RegistryHiveTests):
+    # ri list pointing to lh lists
+    keys = 50
+    listSize = 8
+
+
+class RegistryHiveHashTests(RegistryHiveRiTests):
+    # Subkeys looked up through the hash lists
+    subKeyIndexSize = 0
+
+
+class RegistryHiveLfHashTests(RegistryHiveLfTests):
+    subKeyIndexSize = 0
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)